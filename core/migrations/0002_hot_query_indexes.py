@@ -0,0 +1,17 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='useraddress',
+            index=models.Index(fields=['user', 'is_default'], name='idx_useraddress_user_default'),
+        ),
+    ]
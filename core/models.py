@@ -62,6 +62,9 @@ class UserAddress(models.Model):
     subtitle = models.CharField(max_length=100, default='hey')
     
     class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_default'], name='idx_useraddress_user_default'),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=models.Q(address_type__in=[choice.value for choice in AddressTypeChoices]),
@@ -29,6 +29,8 @@ admin.site.register(CartOffer)
 admin.site.register(CartItemCustomization)
 admin.site.register(PaymentMethod)
 admin.site.register(Transaction)
+admin.site.register(StripeEvent)
+admin.site.register(BookingSlot)
 admin.site.register(CarouselCard)
 admin.site.register(CarouselSchedule)
 admin.site.register(Invoice)
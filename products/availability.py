@@ -0,0 +1,186 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .caching import get_catalog_version
+from .models import Branch, Deal, DealBranchStock, Product, ProductBranchStock
+
+logger = logging.getLogger(__name__)
+
+#? Branch availability as bitsets, shared by every web worker through one memory-mapped file.
+#? Each product/deal has a catalog position; per branch there is an "offered" bitset (no stock row,
+#? or effective_status isn't 'unavailable') and an "available" bitset (no row, or 'available');
+#? out of stock is offered & ~available. "Blocked at every one of these branches" is then an OR of
+#? a few bitsets instead of an aggregate query. A builder process (run_availability_indexer) rewrites
+#? the file whenever the catalog version moves; workers only trust a file built for the current
+#? version and fall back to the database query meanwhile.
+MAGIC = b'VAIX'
+HEADER = struct.Struct('<4sI')  # magic, length of the JSON layout that follows
+KINDS = {
+    'product': (Product, ProductBranchStock, 'product_id'),
+    'deal': (Deal, DealBranchStock, 'deal_id'),
+}
+FLAGS = ('offered', 'available')
+# Blocking statuses of <Stock>.unavailable_everywhere -> the bitset whose cleared bits mean blocked
+BITSET_FOR_STATUSES = {
+    frozenset(['unavailable']): 'offered',
+    frozenset(['unavailable', 'out_of_stock']): 'available',
+}
+
+
+def _bitset_bytes(count):
+    return (count + 7) // 8
+
+
+def build_index(path=None):
+    """Write the index for the current catalog version (atomically replacing the old file). Returns the version."""
+    path = path or settings.AVAILABILITY_INDEX_PATH
+    version = get_catalog_version()  # Read first: rows changed after this belong to a newer version
+    branch_ids = sorted(Branch.objects.values_list('id', flat=True))
+    branch_positions = {branch_id: position for position, branch_id in enumerate(branch_ids)}
+
+    layout = {'version': version, 'branch_ids': branch_ids, 'kinds': {}}
+    chunks, offset = [], 0
+    for kind, (model, stock_model, item_field) in KINDS.items():
+        item_ids = sorted(model.objects.values_list('id', flat=True))
+        positions = {item_id: position for position, item_id in enumerate(item_ids)}
+        size = _bitset_bytes(len(item_ids))
+        # Everything starts offered and available everywhere, only rows that say otherwise clear bits
+        bitsets = [bytearray(b'\xff' * size) for _ in range(len(branch_ids) * len(FLAGS))]
+        rows = stock_model.objects.exclude(effective_status='available').values_list(item_field, 'branch_id', 'effective_status')
+        for item_id, branch_id, effective_status in rows:
+            position = positions.get(item_id)
+            branch_position = branch_positions.get(branch_id)
+            if position is None or branch_position is None:
+                continue
+            byte, mask = position // 8, ~(1 << (position % 8)) & 0xFF
+            bitsets[branch_position * 2 + 1][byte] &= mask  # Not 'available'
+            if effective_status == 'unavailable':
+                bitsets[branch_position * 2][byte] &= mask
+
+        ids_blob = struct.pack(f'<{len(item_ids)}q', *item_ids)
+        layout['kinds'][kind] = {'count': len(item_ids), 'ids_offset': offset, 'bitsets_offset': offset + len(ids_blob)}
+        chunks.append(ids_blob)
+        chunks.extend(bytes(bitset) for bitset in bitsets)
+        offset += len(ids_blob) + size * len(bitsets)
+
+    layout_blob = json.dumps(layout).encode()
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(temp_path, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(layout_blob)))
+        index_file.write(layout_blob)
+        for chunk in chunks:
+            index_file.write(chunk)
+    os.replace(temp_path, path)
+    return version
+
+
+class AvailabilityIndex:
+    """Read-only view of an index file; the bitsets and id arrays stay in the shared page cache."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            stat = os.fstat(index_file.fileno())
+            self.file_key = (stat.st_ino, stat.st_mtime_ns)
+            self.buffer = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, layout_length = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an availability index')
+        layout = json.loads(self.buffer[HEADER.size:HEADER.size + layout_length])
+        self.version = layout['version']
+        self.branch_positions = {branch_id: position for position, branch_id in enumerate(layout['branch_ids'])}
+        data_start = HEADER.size + layout_length
+        view = memoryview(self.buffer)
+        self.kinds = {}
+        for kind, info in layout['kinds'].items():
+            count = info['count']
+            ids_start = data_start + info['ids_offset']
+            self.kinds[kind] = {
+                'count': count,
+                'ids': view[ids_start:ids_start + count * 8].cast('q'),
+                'bitsets_start': data_start + info['bitsets_offset'],
+            }
+
+    def _bitset(self, kind, branch_position, flag):
+        info = self.kinds[kind]
+        size = _bitset_bytes(info['count'])
+        start = info['bitsets_start'] + (branch_position * len(FLAGS) + FLAGS.index(flag)) * size
+        return int.from_bytes(self.buffer[start:start + size], 'little')
+
+    def blocked_ids(self, kind, branch_ids, flag):
+        """Ids whose `flag` bit is clear at every one of branch_ids."""
+        info = self.kinds[kind]
+        anywhere = 0
+        for branch_id in {int(branch_id) for branch_id in branch_ids}:
+            branch_position = self.branch_positions.get(branch_id)
+            if branch_position is None:
+                return []  # No stock rows at that branch, everything counts as available there
+            anywhere |= self._bitset(kind, branch_position, flag)
+        blocked = ~anywhere & ((1 << info['count']) - 1)
+        item_ids = []
+        while blocked:
+            lowest = blocked & -blocked
+            item_ids.append(info['ids'][lowest.bit_length() - 1])
+            blocked ^= lowest
+        return item_ids
+
+
+_mapped = {}
+
+
+def get_index():
+    """This process's mapping of the index file if it was built for the current catalog version, else None."""
+    path = settings.AVAILABILITY_INDEX_PATH
+    version = get_catalog_version()
+    index = _mapped.get(path)
+    if index is not None and index.version == version:
+        return index
+    try:
+        stat = os.stat(path)
+        if index is None or index.file_key != (stat.st_ino, stat.st_mtime_ns):
+            index = _mapped[path] = AvailabilityIndex(path)  # The builder replaced the file, remap it
+    except (OSError, ValueError):
+        return None
+    return index if index.version == version else None
+
+
+def unavailable_everywhere(kind, branch_ids, statuses=('unavailable', 'out_of_stock')):
+    """
+    Ids of products/deals blocked at every one of branch_ids -- <Stock>.unavailable_everywhere, read
+    from the shared index when it is current. Otherwise the database subquery is returned; both work
+    with `id__in`.
+    """
+    flag = BITSET_FOR_STATUSES.get(frozenset(statuses))
+    index = get_index() if flag and branch_ids else None
+    if index is not None:
+        return index.blocked_ids(kind, branch_ids, flag)
+    _, stock_model, _ = KINDS[kind]
+    return stock_model.unavailable_everywhere(branch_ids, statuses)
+
+
+def unavailable_everywhere_set(kind, branch_ids, statuses=('unavailable', 'out_of_stock')):
+    """unavailable_everywhere() as a set of ids, for membership checks in Python."""
+    blocked = unavailable_everywhere(kind, branch_ids, statuses)
+    if isinstance(blocked, list):
+        return set(blocked)
+    _, _, item_field = KINDS[kind]
+    return set(blocked.values_list(item_field, flat=True))
+
+
+def run_indexer(poll_interval=1.0, path=None):
+    """Rebuild the index every time the catalog version moves."""
+    built_version = None
+    while True:
+        close_old_connections()
+        if get_catalog_version() != built_version:
+            started = time.monotonic()
+            built_version = build_index(path)
+            logger.info('availability index: built version %s in %.3fs', built_version, time.monotonic() - started)
+        time.sleep(poll_interval)
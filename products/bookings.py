@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import BOOKING_SLOT_MINUTES, Booking, BookingSlot, Branch
+
+#? Table booking capacity. Every branch with a seating_capacity gets a BookingSlot row per slot the
+#? first time someone books it; the row keeps the running booked_seats total so checking a slot (or a
+#? whole day across branches) is an index lookup on booking slots and never counts Booking rows.
+
+
+class BookingUnavailable(Exception):
+    """The requested slot doesn't have room for the party."""
+
+
+def slot_start_for(booking_date):
+    """Floor a booking time to the start of its slot."""
+    booking_date = timezone.localtime(booking_date) if timezone.is_aware(booking_date) else booking_date
+    minute = booking_date.minute - booking_date.minute % BOOKING_SLOT_MINUTES
+    return booking_date.replace(minute=minute, second=0, microsecond=0)
+
+
+def _ensure_slot(branch, slot_start):
+    """
+    Create the slot row on first use, before anything locks it. A SELECT ... FOR UPDATE of a missing
+    row takes a gap lock on MySQL, and two first bookings holding it then deadlock on their INSERTs.
+    """
+    try:
+        with transaction.atomic():
+            BookingSlot.objects.get_or_create(
+                branch=branch, slot_start=slot_start, defaults={'capacity': branch.seating_capacity},
+            )
+    except IntegrityError:
+        pass  # Another booking created it first
+
+
+def _hold_seats(slot, branch, party_size):
+    """Add party_size seats to the locked `slot`, raising BookingUnavailable when they don't fit."""
+    slot.capacity = branch.seating_capacity  # Follows capacity changes made after the slot was created
+    if slot.booked_seats + party_size > slot.capacity:
+        raise BookingUnavailable(f'Only {slot.remaining_seats} seats left at this time')
+    BookingSlot.objects.filter(pk=slot.pk).update(capacity=slot.capacity, booked_seats=F('booked_seats') + party_size)
+    slot.booked_seats += party_size
+
+
+def _release_seats(slot_id, party_size):
+    BookingSlot.objects.filter(pk=slot_id).update(booked_seats=Greatest(F('booked_seats') - party_size, 0))
+
+
+def reserve_booking(user_id, branch, booking_date, party_size, **fields):
+    """
+    Create a booking, holding party_size seats in its slot. Raises BookingUnavailable when the slot
+    is full. Branches without a seating_capacity book without any capacity check, as before.
+    """
+    if branch is None or branch.seating_capacity is None:
+        return Booking.objects.create(
+            user_id=user_id, branch=branch, booking_date=booking_date, party_size=party_size, **fields
+        )
+
+    slot_start = slot_start_for(booking_date)
+    _ensure_slot(branch, slot_start)
+    with transaction.atomic():
+        slot = BookingSlot.objects.select_for_update().get(branch=branch, slot_start=slot_start)
+        _hold_seats(slot, branch, party_size)
+        return Booking.objects.create(
+            user_id=user_id, branch=branch, booking_date=booking_date, party_size=party_size, slot=slot, **fields
+        )
+
+
+def move_held_seats(booking, loaded):
+    """
+    Called by Booking.save() for an existing booking. `loaded` is its (status, branch_id, booking_date,
+    party_size, slot_id) as read from the database. Cancelling releases the held seats. Changing the
+    branch, slot or party size moves them, raising BookingUnavailable when the new slot is full.
+    """
+    status, branch_id, booking_date, party_size, slot_id = loaded
+    held_slot_id = slot_id if status != 'CANCELLED' else None
+    branch = booking.branch if booking.status != 'CANCELLED' else None
+    wants_slot = branch is not None and branch.seating_capacity is not None
+    slot_start = slot_start_for(booking.booking_date) if wants_slot else None
+    unchanged = (
+        (status == 'CANCELLED') == (booking.status == 'CANCELLED')
+        and branch_id == booking.branch_id
+        and party_size == booking.party_size
+        and (booking_date == booking.booking_date or slot_start_for(booking_date) == slot_start)
+    )
+    if unchanged:
+        return
+
+    held_key = new_key = None
+    if held_slot_id:
+        held_key = BookingSlot.objects.values_list('branch_id', 'slot_start').get(pk=held_slot_id)
+    if wants_slot:
+        _ensure_slot(branch, slot_start)
+        new_key = (branch.id, slot_start)
+    # Lock in (branch, slot_start) order so two bookings swapping slots can't deadlock
+    keys = sorted({key for key in (held_key, new_key) if key})
+    slots = {key: BookingSlot.objects.select_for_update().get(branch_id=key[0], slot_start=key[1]) for key in keys}
+    if held_key:
+        _release_seats(held_slot_id, party_size)
+        slots[held_key].booked_seats = max(slots[held_key].booked_seats - party_size, 0)
+    if new_key:
+        _hold_seats(slots[new_key], branch, booking.party_size)
+        booking.slot = slots[new_key]
+    elif booking.status != 'CANCELLED':
+        booking.slot = None  # Moved to a branch without a seating capacity
+
+
+
+def find_open_slots(branch_ids, day, party_size):
+    """
+    {branch_id: [(slot_start, remaining_seats), ...]} for every slot of `day` within each branch's
+    opening hours that can still seat the party. Two queries: the branches and their booked slots.
+    """
+    branches = list(Branch.objects.filter(id__in=branch_ids, is_active=True, seating_capacity__isnull=False))
+    day_start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    day_end = day_start + timedelta(days=2)  # Covers branches that close after midnight
+    booked = {
+        (branch_id, timezone.localtime(slot_start)): seats
+        for branch_id, slot_start, seats in BookingSlot.objects.filter(
+            branch__in=branches, slot_start__gte=day_start, slot_start__lt=day_end,
+        ).values_list('branch_id', 'slot_start', 'booked_seats')
+    }
+
+    now = timezone.localtime(timezone.now())
+    step = timedelta(minutes=BOOKING_SLOT_MINUTES)
+    open_slots = {}
+    for branch in branches:
+        opening_time = branch.opening_time or datetime.min.time()
+        closing_time = branch.closing_time or datetime.max.time()
+        start = timezone.make_aware(datetime.combine(day, opening_time))
+        end = timezone.make_aware(datetime.combine(day, closing_time))
+        if closing_time <= opening_time:
+            end += timedelta(days=1)
+
+        slots = []
+        current = slot_start_for(start)
+        while current < end:
+            remaining = branch.seating_capacity - booked.get((branch.id, current), 0)
+            if current >= now and remaining >= party_size:
+                slots.append((current, remaining))
+            current += step
+        open_slots[branch.id] = slots
+    return open_slots
@@ -0,0 +1,42 @@
+from django.core.cache import cache
+
+from .events import publish_stock_changes
+
+#? Every cached catalog payload (menus, suggestions, price/availability snapshots) is keyed
+#? under the current catalog version, so invalidating them is a single INCR instead of
+#? hunting down keys one by one -- old entries simply age out with their TTL
+CATALOG_VERSION_KEY = 'catalog_version'
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, 1, timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # Key was evicted or never created, start a fresh version line
+        cache.set(CATALOG_VERSION_KEY, 2, timeout=None)
+        return 2
+
+
+def catalog_cache_key(*parts):
+    """Build a cache key that is automatically invalidated on the next catalog version bump."""
+    return ':'.join(['catalog', str(get_catalog_version()), *[str(part) for part in parts]])
+
+
+def invalidate_stock_caches(branch_ids=None, changes=None):
+    """
+    Called once per batch of branch stock changes (scheduler tick, bulk upsert, admin save).
+    branch_ids is the set of branches touched, None means unknown/all. changes, when known, is a list
+    of (branch_id, kind, item_id, status) that is pushed to live clients as one event per branch.
+    Returns the new catalog version.
+    """
+    version = bump_catalog_version()
+    publish_stock_changes(branch_ids, changes)
+    return version
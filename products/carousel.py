@@ -0,0 +1,72 @@
+from datetime import datetime, time, timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from .caching import catalog_cache_key
+from .models import CarouselCard
+
+#? The home screen carousel only changes when a schedule boundary passes (a start/end time today or
+#? midnight, when the date based rules move on) or a card/schedule is saved (catalog version bump).
+#? The serialized active set is cached until the next boundary instead of filtering schedules per request.
+AFTER_END = timedelta(microseconds=1)  # end_time is inclusive, the card drops out right after it
+
+
+def is_scheduled_now(schedule, now):
+    """Same rules the carousel query used: start/end dates gate the day, times apply on those days."""
+    if schedule is None:
+        return True
+    today, now_time = now.date(), now.time()
+    started = schedule.start_date is None or (
+        schedule.start_date <= today and (schedule.start_time is None or schedule.start_time <= now_time)
+    )
+    not_ended = schedule.end_date is None or (
+        schedule.end_date >= today and (
+            schedule.end_time is None or schedule.end_time >= now_time or schedule.end_date > today
+        )
+    )
+    return started and not_ended
+
+
+def next_boundary(schedules, now):
+    """The first moment after `now` at which any schedule can flip: a start/end time today, or midnight."""
+    today = now.date()
+    boundary = datetime.combine(today + timedelta(days=1), time.min, tzinfo=now.tzinfo)
+    for schedule in schedules:
+        if schedule is None:
+            continue
+        candidates = []
+        if schedule.start_time is not None:
+            candidates.append(datetime.combine(today, schedule.start_time, tzinfo=now.tzinfo))
+        if schedule.end_time is not None:
+            candidates.append(datetime.combine(today, schedule.end_time, tzinfo=now.tzinfo) + AFTER_END)
+        for candidate in candidates:
+            if now < candidate < boundary:
+                boundary = candidate
+    return boundary
+
+
+def _schedule_of(card):
+    try:
+        return card.carouselschedule
+    except CarouselCard.carouselschedule.RelatedObjectDoesNotExist:
+        return None
+
+
+def get_active_carousel(serialize):
+    """
+    Serialized published cards that are scheduled right now. `serialize(cards)` turns the active cards
+    into response data; the result is shared through the cache until the next schedule boundary.
+    """
+    now = timezone.now()
+    key = catalog_cache_key('carousel')
+    entry = cache.get(key)
+    if entry is not None and now < entry['valid_until']:
+        return entry['cards']
+
+    cards = list(CarouselCard.objects.filter(status='published').select_related('carouselschedule'))
+    schedules = [_schedule_of(card) for card in cards]
+    data = serialize([card for card, schedule in zip(cards, schedules) if is_scheduled_now(schedule, now)])
+    valid_until = next_boundary(schedules, now)
+    cache.set(key, {'cards': data, 'valid_until': valid_until}, timeout=max(int((valid_until - now).total_seconds()) + 1, 1))
+    return data
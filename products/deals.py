@@ -0,0 +1,73 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from .caching import catalog_cache_key
+from .models import DealProduct, ExpandableChoices, Product
+from .pricing import get_flash_sale
+from .serializers import CustomizationSerializer, DealProductSerializer, expandable_customizations_data
+
+#? A deal's composition -- its components with their customization trees and categories, and its
+#? deal-specific plus global expandable choices -- is the same for every customer and branch, so it
+#? is built in bulk for a whole listing and cached under the catalog version. Customization prices
+#? include the running flash sale, so the active sale is part of the key as well.
+#? DealSerializer only adds the branch dependent parts (availability, price) on top.
+DEAL_COMPOSITION_TIMEOUT = 60 * 60
+
+
+def customization_trees(product_ids):
+    """{product id: serialized customizations}, the same data CustomizationSerializer gives per header."""
+    products = Product.objects.filter(id__in=product_ids).prefetch_related(*CustomizationSerializer.product_prefetch_graph())
+    return {product.id: CustomizationSerializer(product.prefetched_headers, many=True).data for product in products}
+
+
+def build_deal_compositions(deals):
+    """{deal id: composition} for `deals`, a fixed number of queries however many deals there are."""
+    deal_ids = [deal.id for deal in deals]
+    deal_products = list(
+        DealProduct.objects.filter(deal_id__in=deal_ids).select_related('product__category').order_by('id')
+    )
+    trees = customization_trees({dp.product_id for dp in deal_products if dp.product.is_customizable})
+    components = defaultdict(list)
+    serialized = DealProductSerializer(deal_products, many=True, context={'customization_trees': trees}).data
+    for deal_product, data in zip(deal_products, serialized):
+        data.pop('branch_availability')  # Depends on the request's branches, DealSerializer adds it
+        components[deal_product.deal_id].append(data)
+
+    expandable_ids = [deal.id for deal in deals if deal.is_expandable]
+    deal_choices, global_choices = defaultdict(list), []
+    if expandable_ids:
+        choices = ExpandableChoices.objects.filter(
+            Q(deal_id__in=expandable_ids, is_deal_global=False) | Q(deal__isnull=True, is_deal_global=True)
+        ).select_related('expandable_header').order_by('id')
+        for choice in choices:
+            if choice.deal_id is None:
+                global_choices.append(choice)
+            else:
+                deal_choices[choice.deal_id].append(choice)
+
+    return {
+        deal.id: {
+            'components': components[deal.id],
+            'expandable_customizations': expandable_customizations_data(
+                sorted(deal_choices[deal.id] + global_choices, key=lambda choice: choice.id)
+            ) if deal.is_expandable else [],
+        }
+        for deal in deals
+    }
+
+
+def load_deal_compositions(deals):
+    """{deal id: composition}, from the cache where possible; the missing ones are built together."""
+    sale = get_flash_sale()
+    prefix = catalog_cache_key('deal', sale['id'] if sale else 0)
+    keys = {deal.id: f'{prefix}:{deal.id}' for deal in deals}
+    cached = cache.get_many(keys.values())
+    compositions = {deal_id: cached[key] for deal_id, key in keys.items() if key in cached}
+    missing = [deal for deal in deals if deal.id not in compositions]
+    if missing:
+        built = build_deal_compositions(missing)
+        cache.set_many({keys[deal_id]: composition for deal_id, composition in built.items()}, timeout=DEAL_COMPOSITION_TIMEOUT)
+        compositions.update(built)
+    return compositions
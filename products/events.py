@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+#? Channels are plain strings: 'branch:<id>' for stock/open-close changes of one branch,
+#? 'catalog' for catalog wide changes (flash sale start/end), 'user:<id>' for per-customer events.
+#? Every redis channel is prefixed so a psubscribe on the prefix sees all of them.
+CHANNEL_PREFIX = 'vroom:events:'
+SUBSCRIBER_QUEUE_SIZE = 100
+CATALOG_CHANNEL = 'catalog'
+
+
+def branch_channel(branch_id):
+    return f'branch:{branch_id}'
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def _backend():
+    return getattr(settings, 'EVENTS_BACKEND', 'redis')
+
+
+def publish(channel, event):
+    """
+    Fire-and-forget publish from sync code (views, commit hooks, workers).
+    A broken event bus must never fail the write that produced the event.
+    """
+    try:
+        if _backend() == 'memory':
+            broker.dispatch_threadsafe(channel, event)
+        else:
+            from django_redis import get_redis_connection
+            get_redis_connection('default').publish(CHANNEL_PREFIX + channel, json.dumps(event))
+    except Exception as e:
+        logger.warning('event publish to %s failed: %s', channel, e)
+
+
+def publish_stock_changes(branch_ids=None, changes=None):
+    """
+    changes is an iterable of (branch_id, kind, item_id, status) with kind 'product' or 'deal'.
+    Without changes the clients of the touched branches are told to refetch.
+    """
+    if changes is None:
+        if branch_ids is None:
+            publish(CATALOG_CHANNEL, {'type': 'stock', 'refresh': True})
+        for branch_id in branch_ids or ():
+            publish(branch_channel(branch_id), {'type': 'stock', 'branch_id': branch_id, 'refresh': True})
+        return
+
+    per_branch = {}
+    for branch_id, kind, item_id, item_status in changes:
+        event = per_branch.setdefault(branch_id, {'type': 'stock', 'branch_id': branch_id, 'products': {}, 'deals': {}})
+        event[f'{kind}s'][item_id] = item_status
+    for branch_id, event in per_branch.items():
+        publish(branch_channel(branch_id), event)
+
+
+class Subscription:
+    def __init__(self, channels):
+        self.channels = set(channels)
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow client: drop events and tell it to refetch once it catches up
+            self.overflowed = True
+
+    async def get(self):
+        if self.overflowed and self.queue.empty():
+            self.overflowed = False
+            return {'type': 'refresh'}
+        return await self.queue.get()
+
+
+class EventBroker:
+    """
+    One broker per worker process. Subscribers are local asyncio queues; with the redis backend a
+    single pattern subscription per process feeds all of them, so an idle SSE client costs a queue
+    and a parked coroutine instead of a redis connection or a polling loop.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._loop = None
+        self._listener = None
+        self._lock = threading.Lock()
+
+    @asynccontextmanager
+    async def subscribe(self, channels):
+        subscription = Subscription(channels)
+        self._loop = asyncio.get_running_loop()
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions.setdefault(channel, set()).add(subscription)
+        if _backend() != 'memory':
+            self._ensure_listener()
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                for channel in subscription.channels:
+                    subscribers = self._subscriptions.get(channel)
+                    if subscribers:
+                        subscribers.discard(subscription)
+                        if not subscribers:
+                            del self._subscriptions[channel]
+
+    def dispatch(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscriptions.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def dispatch_threadsafe(self, channel, event):
+        # Publishers run in sync threads, queues belong to the event loop
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self.dispatch, channel, event)
+
+    def _ensure_listener(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def _listen(self):
+        import redis.asyncio as aioredis
+
+        while True:
+            client = aioredis.from_url(settings.EVENTS_REDIS_URL)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.psubscribe(CHANNEL_PREFIX + '*')
+                async for message in pubsub.listen():
+                    if message['type'] != 'pmessage':
+                        continue
+                    channel = message['channel'].decode().removeprefix(CHANNEL_PREFIX)
+                    self.dispatch(channel, json.loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('event listener lost redis, reconnecting: %s', e)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+
+broker = EventBroker()
+
+
+def format_sse(event):
+    return f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+
+async def sse_stream(channels, keepalive=15):
+    """Async generator for a StreamingHttpResponse: SSE frames for `channels`, with comment pings."""
+    async with broker.subscribe(channels) as subscription:
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing the idle connection
+                yield ': ping\n\n'
+                continue
+            yield format_sse(event)
@@ -0,0 +1,149 @@
+import csv
+import json
+from datetime import datetime, timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+from django.utils import timezone
+
+from .models import Order, OrderItem, Transaction
+
+#? Finance exports. Orders are read with a server-side cursor (iterator) and their items, offers and
+#? transactions are prefetched one chunk at a time, so memory stays flat however many orders match.
+EXPORT_CHUNK_SIZE = 500
+EXPORT_FORMATS = ('csv', 'ndjson')
+LINES_PER_SEND = 100  # aiter_export: lines joined per thread hop
+
+CSV_COLUMNS = [
+    'order_id', 'created_at', 'status', 'payment_status', 'branch_id', 'user_id', 'user_email',
+    'subtotal', 'discount_amount', 'delivery_fee', 'tax_amount', 'total_amount', 'offers', 'transactions',
+    'item_id', 'item_type', 'item_title', 'quantity', 'unit_price', 'unit_sale_price', 'item_subtotal',
+    'is_free', 'customizations', 'expandable_choices',
+]
+
+
+def _start_of(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+
+def export_queryset(since=None, until=None):
+    orders = Order.objects.select_related('user').prefetch_related(
+        Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('product', 'deal').prefetch_related(
+            'orderitemcustomization_set__customization_choice',
+            'orderitemexpandablechoice_set__expandable_choice__product',
+        )),
+        'orderoffer_set__offer',
+        Prefetch('transaction_set', queryset=Transaction.objects.order_by('id')),
+    ).order_by('id')
+    # Bare created_at bounds (not created_at__date) so the range can use idx_order_created
+    if since:
+        orders = orders.filter(created_at__gte=_start_of(since))
+    if until:
+        orders = orders.filter(created_at__lt=_start_of(until + timedelta(days=1)))
+    return orders
+
+
+def _item(item):
+    return {
+        'id': item.id,
+        'type': 'product' if item.product_id else 'deal',
+        'title': item.product.title if item.product_id else item.deal.title if item.deal_id else None,
+        'quantity': item.quantity,
+        'unit_price': item.unit_price,
+        'unit_sale_price': item.unit_sale_price,
+        'subtotal': item.subtotal,
+        'is_free': item.is_free,
+        'customizations': [
+            {'title': c.customization_choice.title, 'price': c.price} for c in item.orderitemcustomization_set.all()
+        ],
+        'expandable_choices': [
+            {'title': e.expandable_choice.title or (e.expandable_choice.product.title if e.expandable_choice.product_id else None), 'price': e.price}
+            for e in item.orderitemexpandablechoice_set.all()
+        ],
+    }
+
+
+def order_record(order):
+    """One order with everything finance needs, as plain data."""
+    return {
+        'id': order.id,
+        'created_at': order.created_at,
+        'status': order.status,
+        'payment_status': order.payment_status,
+        'branch_id': order.branch_id,
+        'user_id': order.user_id,
+        'user_email': order.user.email if order.user_id else None,
+        'subtotal': order.subtotal,
+        'discount_amount': order.discount_amount,
+        'delivery_fee': order.delivery_fee,
+        'tax_amount': order.tax_amount,
+        'total_amount': order.total_amount,
+        'offers': [{'code': o.offer.code, 'discount_amount': o.discount_amount} for o in order.orderoffer_set.all()],
+        'transactions': [
+            {'transaction_id': t.transaction_id, 'status': t.status, 'amount': t.amount, 'created_at': t.created_at}
+            for t in order.transaction_set.all()
+        ],
+        'items': [_item(item) for item in order.orderitem_set.all()],
+    }
+
+
+def iter_order_records(since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    for order in export_queryset(since, until).iterator(chunk_size=chunk_size):
+        yield order_record(order)
+
+
+class _Echo:
+    """csv.writer target that hands each row back instead of buffering it."""
+
+    def write(self, value):
+        return value
+
+
+def _joined(entries, *fields):
+    return '; '.join(':'.join(str(entry[field]) for field in fields) for entry in entries)
+
+
+def iter_csv(records):
+    """One line per order item (order columns repeated), orders without items get one line."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for record in records:
+        order_columns = [
+            record['id'], record['created_at'].isoformat(), record['status'], record['payment_status'],
+            record['branch_id'], record['user_id'], record['user_email'], record['subtotal'],
+            record['discount_amount'], record['delivery_fee'], record['tax_amount'], record['total_amount'],
+            _joined(record['offers'], 'code', 'discount_amount'),
+            _joined(record['transactions'], 'transaction_id', 'status', 'amount'),
+        ]
+        for item in record['items'] or [None]:
+            item_columns = [''] * 10 if item is None else [
+                item['id'], item['type'], item['title'], item['quantity'], item['unit_price'],
+                item['unit_sale_price'], item['subtotal'], item['is_free'],
+                _joined(item['customizations'], 'title', 'price'),
+                _joined(item['expandable_choices'], 'title', 'price'),
+            ]
+            yield writer.writerow(order_columns + item_columns)
+
+
+def iter_ndjson(records):
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder) + '\n'
+
+
+def iter_export(export_format, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    records = iter_order_records(since, until, chunk_size)
+    return iter_csv(records) if export_format == 'csv' else iter_ndjson(records)
+
+
+async def aiter_export(export_format, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    iter_export() for ASGI. StreamingHttpResponse reads a sync iterator into a list there before the
+    first byte goes out, so pull LINES_PER_SEND lines per sync_to_async hop instead (thread sensitive:
+    the ORM cursor stays on the request's thread).
+    """
+    lines = iter_export(export_format, since, until, chunk_size)
+    take = sync_to_async(lambda: ''.join(islice(lines, LINES_PER_SEND)))
+    while chunk := await take():
+        yield chunk
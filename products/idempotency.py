@@ -0,0 +1,88 @@
+import functools
+import hashlib
+
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from rest_framework.response import Response
+
+from core.views import decode_jwt
+
+#? Mobile clients send an Idempotency-Key header on writes they may retry. The first request runs
+#? the view and its response is kept in the cache for IDEMPOTENCY_TTL; replays with the same key get
+#? that response back without touching the DB or Stripe. A short lock covers the request in flight.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_LOCK_TTL = 60
+
+
+def _scope(request):
+    # Keys are only unique per client, so namespace them by the JWT user when there is one
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        user_id = decode_jwt(auth_header.split(' ')[1])
+        if user_id:
+            return f'user:{user_id}'
+    return 'anon'
+
+
+def _fingerprint(request):
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.get_full_path().encode())
+    digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _stored_response(response):
+    if isinstance(response, Response):
+        return {'kind': 'drf', 'status': response.status_code, 'data': response.data}
+    return {
+        'kind': 'django',
+        'status': response.status_code,
+        'content': response.content,
+        'content_type': response.get('Content-Type'),
+    }
+
+
+def _replay(stored):
+    if stored['kind'] == 'drf':
+        response = Response(stored['data'], status=stored['status'])
+    else:
+        response = HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Put under @api_view. Requests without an Idempotency-Key header run as before.
+    Server errors (5xx) are not stored so the client can retry them with the same key.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(request, *args, **kwargs)
+
+        key_hash = hashlib.sha256(key.encode()).hexdigest()
+        cache_key = f'idempotency:{view.__name__}:{_scope(request)}:{key_hash}'
+        fingerprint = _fingerprint(request)
+
+        stored = cache.get(cache_key)
+        if stored is not None:
+            if stored['fingerprint'] != fingerprint:
+                return JsonResponse({'error': f'{IDEMPOTENCY_HEADER} was already used for a different request'}, status=422)
+            return _replay(stored['response'])
+
+        lock_key = f'{cache_key}:lock'
+        if not cache.add(lock_key, 1, timeout=IDEMPOTENCY_LOCK_TTL):
+            return JsonResponse({'error': 'A request with this Idempotency-Key is still in progress'}, status=409)
+        try:
+            response = view(request, *args, **kwargs)
+            if response.status_code < 500:
+                cache.set(cache_key, {'fingerprint': fingerprint, 'response': _stored_response(response)}, timeout=IDEMPOTENCY_TTL)
+            return response
+        finally:
+            cache.delete(lock_key)
+
+    return wrapper
@@ -0,0 +1,143 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+#? Snowflake-style ids: 41 bits of milliseconds since ID_EPOCH_MS, 10 bits of worker id, 12 bits of
+#? per-millisecond sequence. They sort by creation time, need no DB round trip and stay unique across
+#? gunicorn/uvicorn workers as long as every live process has its own worker id. Worker ids are leases
+#? in the shared cache (one key per id, claimed with add(), renewed while the process keeps issuing
+#? ids, released at exit), so ids of dead processes are reused and two live ones never share one.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_COUNTER_KEY = 'id_worker_counter'
+WORKER_LEASE_KEY = 'id_worker:{}'
+WORKER_LEASE_SECONDS = 10 * 60
+WORKER_LEASE_RENEW_SECONDS = WORKER_LEASE_SECONDS / 3
+
+# Crockford base32, fixed width so string order == numeric order
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+ENCODED_LENGTH = 13  # 63 bits
+
+
+class WorkerIdUnavailable(RuntimeError):
+    """No worker id could be leased, issuing ids now could duplicate another process's."""
+
+
+def _claim_worker_id(token):
+    """Lease a free worker id for `token`, starting the scan at the next slot of a shared counter."""
+    try:
+        cache.add(WORKER_COUNTER_KEY, 0, timeout=None)
+        start = cache.incr(WORKER_COUNTER_KEY)
+        for offset in range(MAX_WORKER_ID + 1):
+            worker_id = (start + offset) & MAX_WORKER_ID
+            if cache.add(WORKER_LEASE_KEY.format(worker_id), token, timeout=WORKER_LEASE_SECONDS):
+                return worker_id
+    except Exception as e:
+        raise WorkerIdUnavailable(f'could not lease an id worker id from the cache: {e}') from e
+    raise WorkerIdUnavailable(f'all {MAX_WORKER_ID + 1} id worker ids are leased by live processes')
+
+
+def _renew_worker_id(worker_id, token):
+    """Extend our lease, False when it expired (and may have been claimed by another process)."""
+    key = WORKER_LEASE_KEY.format(worker_id)
+    try:
+        return cache.get(key) == token and cache.touch(key, WORKER_LEASE_SECONDS)
+    except Exception as e:
+        raise WorkerIdUnavailable(f'could not renew id worker id {worker_id}: {e}') from e
+
+
+class IdGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._worker_id = None
+        self._token = None
+        self._renew_at = 0
+        self._last_ms = -1
+        self._sequence = 0
+        atexit.register(self._release)
+
+    def _lease_worker_id(self):
+        now = time.monotonic()
+        if now < self._renew_at:
+            return
+        configured = os.environ.get('ID_WORKER_ID')
+        if configured is not None:
+            worker_id = int(configured)
+            if not 0 <= worker_id <= MAX_WORKER_ID:
+                raise WorkerIdUnavailable(f'ID_WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+            self._worker_id, self._renew_at = worker_id, float('inf')
+            return
+        if self._token is None or not _renew_worker_id(self._worker_id, self._token):
+            self._token = uuid.uuid4().hex
+            self._worker_id = _claim_worker_id(self._token)
+            logger.info('id generator: leased worker id %s', self._worker_id)
+        self._renew_at = now + WORKER_LEASE_RENEW_SECONDS
+
+    def _release(self):
+        if self._pid == os.getpid() and self._token is not None:
+            try:
+                key = WORKER_LEASE_KEY.format(self._worker_id)
+                if cache.get(key) == self._token:
+                    cache.delete(key)
+            except Exception:
+                pass  # The lease expires on its own
+
+    def next_id(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # First call, or we are a freshly forked worker that inherited the parent's state
+                self._pid = os.getpid()
+                self._token = None  # The parent keeps its lease, claim our own
+                self._renew_at = 0
+                self._last_ms = -1
+                self._sequence = 0
+            self._lease_worker_id()
+
+            now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond, or the clock stepped back: keep counting on the last timestamp
+                # and borrow the next millisecond when the sequence runs out, ids never go backwards
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return (self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self._worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_generator = IdGenerator()
+
+
+def min_id_at(timestamp):
+    """The smallest id generated at or after `timestamp` (unix seconds), for time based cursors."""
+    return (int(timestamp * 1000) - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def next_id():
+    return _generator.next_id()
+
+
+def encode_id(value):
+    chars = []
+    for _ in range(ENCODED_LENGTH):
+        value, remainder = divmod(value, 32)
+        chars.append(CROCKFORD_ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def new_reference(prefix):
+    """Human facing reference like TXN-0G4J1Z5K8M2QD (17 chars), for transactions, invoices and orders."""
+    return f'{prefix}-{encode_id(next_id())}'
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from products.models import SALES_STATUSES, DailyDealSales, DailyProductSales, Order
+from products.sales import sync_order_sales
+
+
+class Command(BaseCommand):
+    help = 'Add orders that are not in the daily sales rollups yet, in id order and in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Empty the rollups and recount every order from scratch.')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            with transaction.atomic():
+                DailyProductSales.objects.all().delete()
+                DailyDealSales.objects.all().delete()
+                Order.objects.filter(sales_recorded=True).update(sales_recorded=False)
+
+        pending = Order.objects.filter(sales_recorded=False, status__in=SALES_STATUSES).order_by('id')
+        last_id, total = 0, 0
+        while True:
+            order_ids = list(pending.filter(id__gt=last_id).values_list('id', flat=True)[:options['chunk_size']])
+            if not order_ids:
+                break
+            added, _ = sync_order_sales(order_ids)
+            total += added
+            last_id = order_ids[-1]
+            self.stdout.write(f'{total} orders recorded (up to order {last_id})')
+        self.stdout.write(f'Done, {total} orders added to the sales rollups')
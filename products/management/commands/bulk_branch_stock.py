@@ -0,0 +1,47 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.models import Branch
+from products.serializers import BranchStockBulkSerializer
+from products.stock import InvalidStockChange, apply_branch_stock_changes
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply many product/deal stock changes to one branch in a single transaction. '
+        'The file has the same shape as the bulk endpoint body: {"products": [...], "deals": [...]}.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('branch_id', type=int)
+        parser.add_argument('changes_file', help='Path to the JSON file, "-" reads stdin.')
+
+    def handle(self, *args, **options):
+        branch_id = options['branch_id']
+        if not Branch.objects.filter(id=branch_id).exists():
+            raise CommandError(f'Branch {branch_id} not found')
+
+        try:
+            if options['changes_file'] == '-':
+                payload = json.load(sys.stdin)
+            else:
+                with open(options['changes_file']) as changes_file:
+                    payload = json.load(changes_file)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read changes: {e}')
+
+        serializer = BranchStockBulkSerializer(data=payload)
+        if not serializer.is_valid():
+            raise CommandError(json.dumps(serializer.errors))
+
+        try:
+            written = apply_branch_stock_changes(
+                branch_id,
+                products=serializer.validated_data['products'],
+                deals=serializer.validated_data['deals'],
+            )
+        except InvalidStockChange as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Updated {written['products']} product and {written['deals']} deal stock rows at branch {branch_id}")
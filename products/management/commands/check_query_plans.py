@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core.models import UserAddress
+from products.models import Cart, DealBranchStock, Favorite, Offer, Order, OrderItem, ProductBranchStock
+
+SALES_STATUSES = ['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
+
+
+def hot_queries():
+    """(name, table that must be read through an index, queryset) for the hot access paths."""
+    now = timezone.now()
+    month_ago = now - timedelta(days=30)
+    return [
+        ('orders of a user (get_orders)', Order._meta.db_table,
+         Order.objects.filter(user_id=1).order_by('-created_at')),
+        ('sales window by status', Order._meta.db_table,
+         Order.objects.filter(status__in=SALES_STATUSES, created_at__gte=month_ago)),
+        ('product sales (best seller / popular)', OrderItem._meta.db_table,
+         OrderItem.objects.filter(product_id=1, order__status__in=SALES_STATUSES, order__created_at__gte=month_ago)),
+        ('deal sales (best seller / popular)', OrderItem._meta.db_table,
+         OrderItem.objects.filter(deal_id=1, order__status__in=SALES_STATUSES, order__created_at__gte=month_ago)),
+        ('active flash sale', Offer._meta.db_table,
+         Offer.objects.filter(offer_type='FLASH_SALE', is_active=True, valid_from__lte=now, valid_until__gte=now)),
+        ('unavailable products of a branch', ProductBranchStock._meta.db_table,
+         ProductBranchStock.objects.filter(branch_id=1, is_available=False)),
+        ('unavailable deals of a branch', DealBranchStock._meta.db_table,
+         DealBranchStock.objects.filter(branch_id=1, is_available=False)),
+        ('cart of a user', Cart._meta.db_table,
+         Cart.objects.filter(user_id=1)),
+        ('favorites of a user', Favorite._meta.db_table,
+         Favorite.objects.filter(user_id=1).order_by('-created_at')),
+        ('default address of a user', UserAddress._meta.db_table,
+         UserAddress.objects.filter(user_id=1, is_default=True)),
+    ]
+
+
+def full_scans(queryset, table):
+    """The EXPLAIN lines showing a full scan of `table`, empty when it is read through an index."""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            details = [row[-1] for row in cursor.fetchall()]
+            # "SEARCH t USING INDEX ..." is an index lookup, a bare "SCAN t" reads every row
+            return [detail for detail in details if detail.split()[:2] == ['SCAN', table] and 'INDEX' not in detail]
+        if connection.vendor == 'mysql':
+            cursor.execute(f'EXPLAIN {sql}', params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            return [
+                f"{row['table']}: type={row['type']} rows={row['rows']}"
+                for row in rows if row['table'] == table and row['type'] in ('ALL', 'index')
+            ]
+    raise CommandError(f'EXPLAIN checks support sqlite and mysql, not {connection.vendor}')
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot query shapes and fail if any of them falls back to a full table scan.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--show-sql', action='store_true', help='Print each query before its verdict.')
+
+    def handle(self, *args, **options):
+        failures = []
+        for name, table, queryset in hot_queries():
+            if options['show_sql']:
+                self.stdout.write(str(queryset.query))
+            scans = full_scans(queryset, table)
+            if scans:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f'FULL SCAN  {name}: ' + '; '.join(scans)))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'ok         {name}'))
+        if failures:
+            raise CommandError(f'{len(failures)} hot queries fall back to a full scan')
@@ -0,0 +1,30 @@
+import sys
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from products.exports import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, iter_export
+
+
+def _date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class Command(BaseCommand):
+    help = 'Stream orders with items, customizations, offers and transactions as CSV or NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--from', dest='since', type=_date, help='First order day (YYYY-MM-DD).')
+        parser.add_argument('--to', dest='until', type=_date, help='Last order day (YYYY-MM-DD).')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('--output', help='File to write, stdout when omitted.')
+
+    def handle(self, *args, **options):
+        out = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            for chunk in iter_export(options['format'], options['since'], options['until'], options['chunk_size']):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import json
+import random
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from products.models import Order
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header value for payload, same scheme Stripe uses (t=..,v1=HMAC-SHA256)."""
+    timestamp = timestamp or int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def fake_payment_event(order, event_type):
+    intent_id = f'pi_fake_{order.id}'
+    return {
+        'id': f'evt_fake_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'data': {'object': {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': int(order.total_amount * 100),
+            'amount_received': int(order.total_amount * 100) if event_type == 'payment_intent.succeeded' else 0,
+            'currency': 'usd',
+            'metadata': {'order_id': str(order.id)},
+        }},
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Local stand-in for Stripe: posts signed payment_intent events for pending orders to the webhook, '
+        'replaying each one a few times the way Stripe retries.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000/webhook/')
+        parser.add_argument('--count', type=int, default=10, help='Number of distinct events (default 10).')
+        parser.add_argument('--retries', type=int, default=3, help='Deliveries per event (default 3).')
+        parser.add_argument('--fail-rate', type=float, default=0.1, help='Share of payment_failed events.')
+
+    def handle(self, *args, **options):
+        secret = settings.STRIPE_WEBHOOK_SECRET
+        if not secret:
+            raise CommandError('STRIPE_WEBHOOK_SECRET is not set')
+
+        orders = list(Order.objects.exclude(payment_status='PAID')[:options['count']])
+        if not orders:
+            raise CommandError('No unpaid orders to generate events for')
+
+        session = requests.Session()
+        delivered = rejected = 0
+        for order in orders:
+            event_type = 'payment_intent.payment_failed' if random.random() < options['fail_rate'] else 'payment_intent.succeeded'
+            payload = json.dumps(fake_payment_event(order, event_type))
+            for _ in range(options['retries']):
+                response = session.post(
+                    options['url'],
+                    data=payload,
+                    headers={'Content-Type': 'application/json', 'Stripe-Signature': sign_payload(payload, secret)},
+                    timeout=10,
+                )
+                if response.status_code == 200:
+                    delivered += 1
+                else:
+                    rejected += 1
+        self.stdout.write(f'Delivered {delivered} webhook calls for {len(orders)} events, {rejected} rejected')
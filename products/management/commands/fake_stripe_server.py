@@ -0,0 +1,134 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+from django.core.management.base import BaseCommand
+
+#? Just enough of the Stripe API for the payment endpoints: create/retrieve PaymentIntent and
+#? retrieve Charge. Run it, set STRIPE_API_BASE=http://127.0.0.1:12111 and load-test offline.
+INTENT_PATH = re.compile(r'^/v1/payment_intents/(?P<id>[\w-]+)$')
+CHARGE_PATH = re.compile(r'^/v1/charges/(?P<id>[\w-]+)$')
+
+
+def _form_to_params(body):
+    """Stripe's form encoding (metadata[order_id]=1, payment_method_types[0]=card) back to dicts/lists."""
+    params = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        match = re.match(r'^(\w+)\[(\w*)\]$', key)
+        if not match:
+            params[key] = value
+        elif match.group(2).isdigit() or match.group(2) == '':
+            params.setdefault(match.group(1), []).append(value)
+        else:
+            params.setdefault(match.group(1), {})[match.group(2)] = value
+    return params
+
+
+def _fake_charge(charge_id):
+    return {
+        'id': charge_id,
+        'object': 'charge',
+        'paid': True,
+        'status': 'succeeded',
+        'currency': 'usd',
+        'outcome': {'seller_message': 'Payment complete.'},
+        'billing_details': {'address': {'country': 'US'}},
+        'payment_method_details': {'card': {
+            'brand': 'visa', 'country': 'US', 'exp_month': 12, 'exp_year': 2030, 'last4': '4242', 'funding': 'credit',
+        }},
+    }
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    intents = {}
+    lock = threading.Lock()
+    latency = 0.0
+    error_rate = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Request-Id', f'req_fake_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _simulate_conditions(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self._reply(500, {'error': {'type': 'api_error', 'message': 'Simulated Stripe outage'}})
+            return False
+        return True
+
+    def _not_found(self, object_id):
+        self._reply(404, {'error': {'type': 'invalid_request_error', 'message': f"No such object: '{object_id}'"}})
+
+    def do_POST(self):
+        if not self._simulate_conditions():
+            return
+        if self.path != '/v1/payment_intents':
+            return self._not_found(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+        params = _form_to_params(body)
+        intent_id = f'pi_fake_{uuid.uuid4().hex[:24]}'
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': int(params.get('amount', 0)),
+            'currency': params.get('currency', 'usd'),
+            'status': 'requires_payment_method',
+            'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:16]}',
+            'payment_method_types': params.get('payment_method_types', ['card']),
+            'metadata': params.get('metadata', {}),
+            'created': int(time.time()),
+            'latest_charge': f'ch_fake_{uuid.uuid4().hex[:24]}',
+            'last_payment_error': None,
+        }
+        with self.lock:
+            self.intents[intent_id] = intent
+        self._reply(200, intent)
+
+    def do_GET(self):
+        if not self._simulate_conditions():
+            return
+        intent_match = INTENT_PATH.match(self.path)
+        if intent_match:
+            with self.lock:
+                intent = self.intents.get(intent_match.group('id'))
+            return self._reply(200, intent) if intent else self._not_found(intent_match.group('id'))
+        charge_match = CHARGE_PATH.match(self.path)
+        if charge_match:
+            return self._reply(200, _fake_charge(charge_match.group('id')))
+        self._not_found(self.path)
+
+
+class Command(BaseCommand):
+    help = 'Run a local fake Stripe API (payment intents, charges) for offline load tests of the payment endpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every response.')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of requests answered with a 500.')
+
+    def handle(self, *args, **options):
+        FakeStripeHandler.latency = options['latency_ms'] / 1000
+        FakeStripeHandler.error_rate = options['error_rate']
+        server = ThreadingHTTPServer((options['host'], options['port']), FakeStripeHandler)
+        self.stdout.write(f"Fake Stripe API on http://{options['host']}:{options['port']} (STRIPE_API_BASE)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
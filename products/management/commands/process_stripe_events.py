@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from products.webhooks import process_stripe_events
+
+
+class Command(BaseCommand):
+    help = 'Apply stored Stripe webhook events to orders, invoices and transactions in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to sleep when the queue is empty (default 1).')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the pending events and exit.')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            close_old_connections()
+            handled = process_stripe_events(batch_size=options['batch_size'])
+            total += handled
+            if handled:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+        self.stdout.write(f'Processed {total} Stripe events')
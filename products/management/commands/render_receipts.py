@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from products.receipts import render_pending_receipts
+
+
+class Command(BaseCommand):
+    help = 'Render and store receipts for paid invoices that do not have one yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Seconds to sleep when nothing is waiting (default 5).')
+        parser.add_argument('--once', action='store_true',
+                            help='Render everything pending and exit.')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            close_old_connections()
+            rendered = render_pending_receipts(batch_size=options['batch_size'])
+            total += rendered
+            if rendered:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+        self.stdout.write(f'Rendered {total} receipts')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from products.availability import build_index, run_indexer
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the memory-mapped branch availability index whenever the catalog version changes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds between catalog version checks (default 1).')
+        parser.add_argument('--path', default=None,
+                            help='Index file to write, defaults to settings.AVAILABILITY_INDEX_PATH.')
+        parser.add_argument('--once', action='store_true',
+                            help='Build the index once and exit, e.g. from a deploy hook.')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            version = build_index(options['path'])
+            self.stdout.write(f'Built availability index for catalog version {version}')
+            return
+        run_indexer(poll_interval=options['poll_interval'], path=options['path'])
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from products.scheduling import ScheduledOrderReleaser
+
+
+class Command(BaseCommand):
+    help = 'Release scheduled orders (PENDING -> CONFIRMED) a prep lead time before their scheduled_at.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lead-minutes', type=int, default=None,
+                            help='Prep lead time (default settings.ORDER_PREP_LEAD_MINUTES).')
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Max seconds between checks for new scheduled orders (default 5).')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Max orders released per UPDATE (default 500).')
+        parser.add_argument('--once', action='store_true',
+                            help='Release everything that is due and exit.')
+
+    def handle(self, *args, **options):
+        releaser = ScheduledOrderReleaser(
+            lead=timedelta(minutes=options['lead_minutes']) if options['lead_minutes'] is not None else None,
+            poll_interval=options['poll_interval'],
+            batch_size=options['batch_size'],
+        )
+        queued = releaser.load()
+        self.stdout.write(f'Loaded {queued} scheduled orders')
+        if options['once']:
+            released = releaser.run_due()
+            self.stdout.write(f'Released {released} orders')
+            return
+        releaser.run_forever()
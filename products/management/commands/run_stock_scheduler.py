@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from products.scheduling import StockBoundaryScheduler
+
+
+class Command(BaseCommand):
+    help = 'Flip branch stock effective_status exactly when out_of_stock_from/out_of_stock_until boundaries pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help='Max seconds between checks for edited stock rows (default 5).')
+        parser.add_argument('--horizon-hours', type=float, default=6.0,
+                            help='How far ahead boundaries are loaded into the queue (default 6).')
+        parser.add_argument('--once', action='store_true',
+                            help='Repair every drifted row once and exit, e.g. from a deploy hook.')
+
+    def handle(self, *args, **options):
+        scheduler = StockBoundaryScheduler(
+            horizon=timedelta(hours=options['horizon_hours']),
+            poll_interval=options['poll_interval'],
+        )
+        queued = scheduler.load()
+        self.stdout.write(f'Loaded {queued} pending stock boundaries')
+        if options['once']:
+            return
+        scheduler.run_forever()
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:39
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_effective_status(apps, schema_editor):
+    now = timezone.now()
+    for model_name in ('ProductBranchStock', 'DealBranchStock'):
+        model = apps.get_model('products', model_name)
+        model.objects.filter(is_available=False).update(effective_status='unavailable')
+        model.objects.filter(
+            is_available=True,
+            is_out_of_stock=True,
+            out_of_stock_from__lte=now,
+            out_of_stock_until__gte=now,
+        ).update(effective_status='out_of_stock')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dealbranchstock',
+            name='effective_status',
+            field=models.CharField(choices=[('available', 'Available'), ('out_of_stock', 'Out of stock'), ('unavailable', 'Unavailable')], default='available', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='productbranchstock',
+            name='effective_status',
+            field=models.CharField(choices=[('available', 'Available'), ('out_of_stock', 'Out of stock'), ('unavailable', 'Unavailable')], default='available', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='dealbranchstock',
+            index=models.Index(fields=['branch', 'effective_status'], name='idx_dealstock_branch_status'),
+        ),
+        migrations.AddIndex(
+            model_name='productbranchstock',
+            index=models.Index(fields=['branch', 'effective_status'], name='idx_productstock_branch_status'),
+        ),
+        migrations.RunPython(backfill_effective_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_branch_stock_effective_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='estimated_arrival',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
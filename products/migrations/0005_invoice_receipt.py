@@ -0,0 +1,22 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_stripe_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='receipt_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['status', 'receipt_sha256'], name='idx_invoice_receipt_pending'),
+        ),
+    ]
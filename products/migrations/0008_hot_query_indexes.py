@@ -0,0 +1,46 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_hot_query_indexes'),
+        ('products', '0007_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dealbranchstock',
+            index=models.Index(fields=['branch', 'is_available'], name='idx_dealstock_branch_avail'),
+        ),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['user', '-created_at'], name='idx_favorite_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='offer',
+            index=models.Index(fields=['offer_type', 'is_active', 'valid_from', 'valid_until'], name='idx_offer_type_active_window'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at'], name='idx_order_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='idx_order_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['product', 'order'], name='idx_orderitem_product_order'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['deal', 'order'], name='idx_orderitem_deal_order'),
+        ),
+        migrations.AddIndex(
+            model_name='productbranchstock',
+            index=models.Index(fields=['branch', 'is_available'], name='idx_productstock_branch_avail'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_hot_query_indexes'),
+        ('products', '0010_order_kitchen_queue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'scheduled_at'], name='idx_order_status_scheduled'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.5 on 2026-10-19 16:37
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_branchless_duplicates(apps, schema_editor):
+    # NULL branches never collided under the old constraint, so concurrent recorders may have split a
+    # branchless (day, item) across rows; fold them into one before the new constraint is added
+    for model_name, item_field in (('DailyProductSales', 'product'), ('DailyDealSales', 'deal')):
+        model = apps.get_model('products', model_name)
+        duplicates = model.objects.filter(branch__isnull=True).values('day', f'{item_field}_id').annotate(
+            keep_id=Min('id'), rows=Count('id'), total_quantity=Sum('quantity'), total_revenue=Sum('revenue'),
+        ).filter(rows__gt=1).order_by()
+        for row in duplicates:
+            key = {'branch__isnull': True, 'day': row['day'], f'{item_field}_id': row[f'{item_field}_id']}
+            model.objects.filter(pk=row['keep_id']).update(quantity=row['total_quantity'], revenue=row['total_revenue'])
+            model.objects.filter(**key).exclude(pk=row['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_order_scheduled_index'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='dailydealsales',
+            name='daily_deal_sales_uniq',
+        ),
+        migrations.RemoveConstraint(
+            model_name='dailyproductsales',
+            name='daily_product_sales_uniq',
+        ),
+        migrations.AlterField(
+            model_name='dailydealsales',
+            name='branch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='products.branch'),
+        ),
+        migrations.AlterField(
+            model_name='dailyproductsales',
+            name='branch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='products.branch'),
+        ),
+        migrations.RunPython(merge_branchless_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dailydealsales',
+            constraint=models.UniqueConstraint(models.F('day'), django.db.models.functions.comparison.Coalesce('branch', models.Value(0)), models.F('deal'), name='daily_deal_sales_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyproductsales',
+            constraint=models.UniqueConstraint(models.F('day'), django.db.models.functions.comparison.Coalesce('branch', models.Value(0)), models.F('product'), name='daily_product_sales_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_hot_query_indexes'),
+        ('products', '0012_daily_sales_branchless_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at'], name='idx_order_created'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.5 on 2026-10-19 16:53
+
+from decimal import Decimal
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def drop_duplicate_reviews(apps, schema_editor):
+    # Concurrent posts could each create a review, keep the first and re-derive the ratings they counted in
+    Product = apps.get_model('products', 'Product')
+    Review = apps.get_model('products', 'Review')
+    product_ids = set()
+    for field in ('product', 'order'):
+        duplicates = Review.objects.filter(**{f'{field}__isnull': False}).values('user_id', f'{field}_id').annotate(
+            keep_id=Min('id'), reviews=Count('id'),
+        ).filter(reviews__gt=1).order_by()
+        for row in duplicates:
+            extra = Review.objects.filter(user_id=row['user_id'], **{f'{field}_id': row[f'{field}_id']}).exclude(pk=row['keep_id'])
+            product_ids.update(extra.exclude(product__isnull=True).values_list('product_id', flat=True))
+            extra.delete()
+    for product_id in product_ids:
+        totals = Review.objects.filter(product_id=product_id).aggregate(total=Sum('rating'), count=Count('id'))
+        Product.objects.filter(pk=product_id).update(
+            rating_sum=totals['total'] or 0,
+            rating_count=totals['count'],
+            rating_avg=(Decimal(totals['total']) / totals['count']).quantize(Decimal('0.01')) if totals['count'] else 0,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_hot_query_indexes'),
+        ('products', '0013_order_created_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_reviews, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='review',
+            constraint=models.UniqueConstraint(models.F('user'), django.db.models.functions.comparison.Coalesce('product', models.Value(0)), django.db.models.functions.comparison.Coalesce('order', models.Value(0)), name='review_user_item_uniq'),
+        ),
+    ]
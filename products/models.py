@@ -1,10 +1,14 @@
 from datetime import timedelta
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Cast, Coalesce, Round
 from django.forms import ValidationError
 from decimal import Decimal
 from django.core.validators import MinValueValidator, MaxValueValidator
 from core.models import User, UserAddress
+from .caching import bump_catalog_version, invalidate_stock_caches
+from .events import publish, user_channel
+from .ids import new_reference, next_id
 
 #? Category is food category like 'Biriyani','Pizza'... and more food drink related only 
 #? not 'Best Seller','New','Popular' -- these can be tags as well as computed and given based on sales and ratings
@@ -12,6 +16,15 @@ class Category(models.Model):
     title = models.CharField(max_length=100,unique=True)
     image = models.ImageField(upload_to='images/categories/', null=True, blank=True)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return self.title
     
@@ -36,43 +49,35 @@ class Product(models.Model):
     is_customizable = models.BooleanField(default=False)
     flash_sale_discount = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
     flash_sale_is_percentage = models.BooleanField(default=False)
+    #? Review aggregates, kept up to date by Review.save/delete so product cards never run AVG()
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_avg = models.DecimalField(max_digits=3, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Compiled customization prices (pricing.py) are keyed by catalog version
+        transaction.on_commit(bump_catalog_version)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     @property
     def flash_sale_price(self):
         """Calculate flash sale price if eligible, respecting applicable_products."""
-        active_flash_sale = Offer.get_active_flash_sale()
-        if not active_flash_sale:
-            return None
+        # Same rules against the cached active flash sale, so listings don't query offers per product
+        from .pricing import get_flash_sale, product_sale_price
+        return product_sale_price(self, get_flash_sale())
 
-        # Stricter eligibility check
-        if active_flash_sale.applicable_products.exists():
-            # If applicable_products is set, only those products are eligible
-            if self not in active_flash_sale.applicable_products.all():
-                return None
-            # Apply product-level discount if available
-            if self.flash_sale_discount is not None:
-                if self.flash_sale_is_percentage:
-                    discount = self.price * (self.flash_sale_discount / Decimal('100'))
-                else:
-                    discount = self.flash_sale_discount
-                return max(self.price - discount, Decimal('0.00'))
-            # Fallback to offer-level discount
-            elif active_flash_sale.discount_value is not None:
-                if active_flash_sale.is_percentage:
-                    discount = self.price * (active_flash_sale.discount_value / Decimal('100'))
-                else:
-                    discount = active_flash_sale.discount_value
-                return max(self.price - discount, Decimal('0.00'))
-        else:
-            # No applicable_products: only apply to items with flash_sale_discount
-            if self.flash_sale_discount is not None:
-                if self.flash_sale_is_percentage:
-                    discount = self.price * (self.flash_sale_discount / Decimal('100'))
-                else:
-                    discount = self.flash_sale_discount
-                return max(self.price - discount, Decimal('0.00'))
-        return None
+    def has_tag(self, title):
+        """Manual tag override, read from the serializer's prefetched tags when they were loaded."""
+        product_tags = getattr(self, 'prefetched_tags', None)
+        if product_tags is not None:
+            return any(product_tag.tag.title == title for product_tag in product_tags)
+        return ProductTags.objects.filter(product=self, tag__title=title).exists()
 
     @property
     def has_flash_sale(self):
@@ -81,28 +86,15 @@ class Product(models.Model):
     @property
     def is_best_seller(self):
         """Computed: Top 10% of products by sales in the last 30 days."""
-        if ProductTags.objects.filter(product=self, tag__title='Best Seller').exists():
+        if self.has_tag('Best Seller'):
             return True  # Manual override
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        sales = OrderItem.objects.filter(
-            product=self,
-            order__created_at__gte=thirty_days_ago,
-            order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-        ).aggregate(total=models.Sum('quantity'))['total'] or 0
-        all_products = Product.objects.annotate(
-            sales=models.Sum('orderitem__quantity', filter=models.Q(
-                orderitem__order__created_at__gte=thirty_days_ago,
-                orderitem__order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-            ))
-        ).order_by('-sales')
-        threshold = max(1, int(all_products.count() * 0.1))  # Top 10%
-        top_sellers = all_products[:threshold]
-        return self in [p for p in top_sellers if p.sales]
+        from .sales import top_seller_ids
+        return self.id in top_seller_ids('product', 0.1)  # Top 10% over 30 days, from the daily rollups
 
     @property
     def is_new(self):
         """Computed: Created within the last 7 days."""
-        if ProductTags.objects.filter(product=self, tag__title='New').exists():
+        if self.has_tag('New'):
             return True  # Manual override
         seven_days_ago = timezone.now() - timedelta(days=7)
         # Assuming you add a `created_at` field to Product
@@ -111,24 +103,11 @@ class Product(models.Model):
     @property
     def is_popular(self):
         """Computed: Top 20% by sales or manual tag."""
-        if ProductTags.objects.filter(product=self, tag__title='Popular').exists():
+        if self.has_tag('Popular'):
             return True  # Manual override
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        sales = OrderItem.objects.filter(
-            product=self,
-            order__created_at__gte=thirty_days_ago,
-            order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-        ).aggregate(total=models.Sum('quantity'))['total'] or 0
-        all_products = Product.objects.annotate(
-            sales=models.Sum('orderitem__quantity', filter=models.Q(
-                orderitem__order__created_at__gte=thirty_days_ago,
-                orderitem__order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-            ))
-        ).order_by('-sales')
-        threshold = max(1, int(all_products.count() * 0.2))  # Top 20%
-        top_popular = all_products[:threshold]
-        return self in [p for p in top_popular if p.sales]
-    
+        from .sales import top_seller_ids
+        return self.id in top_seller_ids('product', 0.2)  # Top 20% over 30 days, from the daily rollups
+
     def __str__(self):
         return f'{self.title} - {self.price}'
     
@@ -155,41 +134,21 @@ class Deal(models.Model):
     flash_sale_is_percentage = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True,)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     @property
     def flash_sale_price(self):
         """Calculate flash sale price if eligible, respecting applicable_deals."""
-        active_flash_sale = Offer.get_active_flash_sale()
-        if not active_flash_sale:
-            return None
-
-        # Stricter eligibility check
-        if active_flash_sale.applicable_deals.exists():
-            # If applicable_deals is set, only those deals are eligible
-            if self not in active_flash_sale.applicable_deals.all():
-                return None
-            # Apply deal-level discount if available
-            if self.flash_sale_discount is not None:
-                if self.flash_sale_is_percentage:
-                    discount = self.price * (self.flash_sale_discount / Decimal('100'))
-                else:
-                    discount = self.flash_sale_discount
-                return max(self.price - discount, Decimal('0.00'))
-            # Fallback to offer-level discount
-            elif active_flash_sale.discount_value is not None:
-                if active_flash_sale.is_percentage:
-                    discount = self.price * (active_flash_sale.discount_value / Decimal('100'))
-                else:
-                    discount = active_flash_sale.discount_value
-                return max(self.price - discount, Decimal('0.00'))
-        else:
-            # No applicable_deals: only apply to items with flash_sale_discount
-            if self.flash_sale_discount is not None:
-                if self.flash_sale_is_percentage:
-                    discount = self.price * (self.flash_sale_discount / Decimal('100'))
-                else:
-                    discount = self.flash_sale_discount
-                return max(self.price - discount, Decimal('0.00'))
-        return None
+        # Same rules against the cached active flash sale, so listings don't query offers per deal
+        from .pricing import deal_sale_price, get_flash_sale
+        return deal_sale_price(self, get_flash_sale())
 
     @property
     def has_flash_sale(self):
@@ -199,21 +158,8 @@ class Deal(models.Model):
     def is_best_seller(self):
         if DealTags.objects.filter(deal=self, tag__title='Best Seller').exists():
             return True
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        sales = OrderItem.objects.filter(
-            deal=self,
-            order__created_at__gte=thirty_days_ago,
-            order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-        ).aggregate(total=models.Sum('quantity'))['total'] or 0
-        all_deals = Deal.objects.annotate(
-            sales=models.Sum('orderitem__quantity', filter=models.Q(
-                orderitem__order__created_at__gte=thirty_days_ago,
-                orderitem__order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-            ))
-        ).order_by('-sales')
-        threshold = max(1, int(all_deals.count() * 0.1))
-        top_sellers = all_deals[:threshold]
-        return self in [d for d in top_sellers if d.sales]
+        from .sales import top_seller_ids
+        return self.id in top_seller_ids('deal', 0.1)  # Top 10% over 30 days, from the daily rollups
 
     @property
     def is_new(self):
@@ -227,22 +173,9 @@ class Deal(models.Model):
     def is_popular(self):
         if DealTags.objects.filter(deal=self, tag__title='Popular').exists():
             return True
-        thirty_days_ago = timezone.now() - timedelta(days=30)
-        sales = OrderItem.objects.filter(
-            deal=self,
-            order__created_at__gte=thirty_days_ago,
-            order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-        ).aggregate(total=models.Sum('quantity'))['total'] or 0
-        all_deals = Deal.objects.annotate(
-            sales=models.Sum('orderitem__quantity', filter=models.Q(
-                orderitem__order__created_at__gte=thirty_days_ago,
-                orderitem__order__status__in=['CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED']
-            ))
-        ).order_by('-sales')
-        threshold = max(1, int(all_deals.count() * 0.2))
-        top_popular = all_deals[:threshold]
-        return self in [d for d in top_popular if d.sales]
-    
+        from .sales import top_seller_ids
+        return self.id in top_seller_ids('deal', 0.2)  # Top 20% over 30 days, from the daily rollups
+
     def __str__(self):
         return self.title
     
@@ -270,6 +203,9 @@ class Favorite(models.Model):
             models.UniqueConstraint(fields=['user', 'product'], name='unique_user_product_favorite'),
             models.UniqueConstraint(fields=['user', 'deal'], name='unique_user_deal_favorite'),
         ]
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='idx_favorite_user_created'),
+        ]
 
     def clean(self):
         if self.product and self.deal:
@@ -280,6 +216,17 @@ class Favorite(models.Model):
     def __str__(self):
         item = self.product.title if self.product else self.deal.title
         return f"{self.user} - {item}"
+
+    @classmethod
+    def ids_for_user(cls, user_id):
+        """(product ids, deal ids) the user has favorited, in one query."""
+        product_ids, deal_ids = set(), set()
+        for product_id, deal_id in cls.objects.filter(user_id=user_id).values_list('product_id', 'deal_id'):
+            if product_id:
+                product_ids.add(product_id)
+            if deal_id:
+                deal_ids.add(deal_id)
+        return product_ids, deal_ids
     
 class DealProduct(models.Model):
     deal = models.ForeignKey(to=Deal,on_delete=models.CASCADE, related_name='dealproduct_set')
@@ -290,12 +237,30 @@ class DealProduct(models.Model):
     #         models.UniqueConstraint(fields=['product', 'deal'], 
     #                                 name='product_and_deal_uniq')
     #     ]
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return f'{self.deal.title} - {self.product.title}'
 
 class ExpandableHeader(models.Model):
     title = models.CharField(max_length=100)
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return self.title  
     
@@ -315,6 +280,15 @@ class ExpandableChoices(models.Model):
     is_veg = models.BooleanField(default=False)
     price = models.DecimalField(decimal_places=2,max_digits=8) #? if any difference from original amount
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return self.title  
     
@@ -345,6 +319,15 @@ class CustomizationHeader(models.Model):
     
     def __str__(self):
         return self.title  
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Cached deal compositions (deals.py) embed it
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
      
      
 #? pan, medium, tomato
@@ -354,6 +337,15 @@ class CustomizationChoice(models.Model):
     is_veg = models.BooleanField(default=False)
     price = models.DecimalField(decimal_places=2,max_digits=8)
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Recompiles the product prices (pricing.py)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return self.title  
 
@@ -379,6 +371,15 @@ class ProductCustomizationHeader(models.Model):
                                   a product and a product price should match combined preselected options \
                                   so giving it a max discount may lead to mismatch of both prices making it a very bad UX')
             
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Recompiles the product prices (pricing.py)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return f'{self.product} - {self.customization_header}'
 
@@ -406,6 +407,15 @@ class CustomizationPriceRule(models.Model):
     price = models.DecimalField(decimal_places=2,max_digits=8)
     is_base = models.BooleanField(default=False)  # New field: marks this rule as base price
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Recompiles the product prices (pricing.py)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         if self.customization_price_rules_self != None:
             return f'{self.product.id} - {self.product} - {self.customization_choice.title} - |{self.customization_price_rules_self.customization_choice.title} - {self.customization_price_rules_self.product}| - {self.price}'
@@ -430,6 +440,15 @@ class ProductChoicesUnavailablility(models.Model):
     product = models.ForeignKey(to=Product,on_delete=models.CASCADE)
     customization_choice = models.ForeignKey(to=CustomizationChoice,on_delete=models.CASCADE)
     
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Recompiles the product prices (pricing.py)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     def __str__(self):
         return f'{self.product} - {self.customization_choice}'
 
@@ -486,10 +505,16 @@ class Branch(models.Model):
     delivery_radius = models.DecimalField(max_digits=5, decimal_places=2, default=5.00)
     min_order_amount = models.DecimalField(max_digits=8, decimal_places=2, default=10.00)
     delivery_fee = models.DecimalField(max_digits=8, decimal_places=2, default=5.00)
+    seating_capacity = models.PositiveIntegerField(null=True, blank=True)  #? seats per booking slot, empty = table bookings aren't capacity managed
 
     def __str__(self):
         return f"{self.name} - {self.city}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Lets the stock scheduler pick up new opening hours for open/close events
+        transaction.on_commit(bump_catalog_version)
+
     def is_open(self):
         if not (self.opening_time and self.closing_time):
             return True
@@ -499,6 +524,15 @@ class Branch(models.Model):
         else:  # Overnight hours
             return now >= self.opening_time or now <= self.closing_time
 
+#? effective_status is the materialized result of is_available + the out_of_stock_from/until window
+#? at the current moment, it is written on save and flipped by the stock scheduler worker exactly
+#? when a window boundary passes (see products/scheduling.py) so list endpoints can filter in SQL
+STOCK_STATUSES = (
+    ('available', 'Available'),
+    ('out_of_stock', 'Out of stock'),
+    ('unavailable', 'Unavailable'),
+)
+
 class ProductBranchStock(models.Model):
     branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -507,13 +541,72 @@ class ProductBranchStock(models.Model):
     out_of_stock_from = models.DateTimeField(null=True, blank=True)  # When out-of-stock starts
     out_of_stock_until = models.DateTimeField(null=True, blank=True)  # When it becomes available again
     price = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)  # Optional branch-specific price override
+    effective_status = models.CharField(max_length=20, choices=STOCK_STATUSES, default='available')
+
+    STOCK_ITEM_FIELD = 'product_id'
 
     class Meta:
         unique_together = ('branch', 'product')
+        indexes = [
+            models.Index(fields=['branch', 'effective_status'], name='idx_productstock_branch_status'),
+            models.Index(fields=['branch', 'is_available'], name='idx_productstock_branch_avail'),
+        ]
 
     def __str__(self):
         return f"{self.product.title} at {self.branch.name}"
 
+    def save(self, *args, **kwargs):
+        self.effective_status = self.compute_effective_status()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'effective_status' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'effective_status']
+        super().save(*args, **kwargs)
+        change = (self.branch_id, 'product', self.product_id, self.effective_status)
+        transaction.on_commit(lambda: invalidate_stock_caches([change[0]], [change]))
+
+    def delete(self, *args, **kwargs):
+        change = (self.branch_id, 'product', self.product_id, 'available')  # No row counts as available
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: invalidate_stock_caches([change[0]], [change]))
+        return result
+
+    def compute_effective_status(self, now=None):
+        """Status this row has at `now` -- the value that gets materialized into effective_status."""
+        now = now or timezone.now()
+        if not self.is_available:
+            return 'unavailable'
+        if self.is_out_of_stock and self.out_of_stock_from and self.out_of_stock_until:
+            if self.out_of_stock_from <= now <= self.out_of_stock_until:
+                return 'out_of_stock'
+        return 'available'
+
+    def next_status_change(self, now=None):
+        """Next moment effective_status flips on its own, None if there is no pending boundary."""
+        if not (self.is_available and self.is_out_of_stock and self.out_of_stock_from and self.out_of_stock_until):
+            return None
+        now = now or timezone.now()
+        # out_of_stock_until is inclusive, the item is back right after it
+        for boundary in (self.out_of_stock_from, self.out_of_stock_until + timedelta(microseconds=1)):
+            if boundary > now:
+                return boundary
+        return None
+
+    @classmethod
+    def unavailable_everywhere(cls, branch_ids, statuses=('unavailable', 'out_of_stock')):
+        """
+        Ids of items that have a stock row at every one of branch_ids and none of those rows is
+        available (effective_status in `statuses`). Items without a row count as available, same
+        as before. Returned as a values queryset so callers can use it as a subquery.
+        """
+        branch_ids = {int(branch_id) for branch_id in branch_ids}
+        return (
+            cls.objects.filter(branch_id__in=branch_ids, effective_status__in=statuses)
+            .values(cls.STOCK_ITEM_FIELD)
+            .annotate(blocked_branches=models.Count('branch_id', distinct=True))
+            .filter(blocked_branches=len(branch_ids))
+            .values(cls.STOCK_ITEM_FIELD)
+        )
+
     def get_availability_status(self):
         """Determine current status and a dynamic message based on out_of_stock_until."""
         now = timezone.now()
@@ -561,13 +654,45 @@ class DealBranchStock(models.Model):
     out_of_stock_from = models.DateTimeField(null=True, blank=True)
     out_of_stock_until = models.DateTimeField(null=True, blank=True)
     price = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)  # Optional branch-specific price override
+    effective_status = models.CharField(max_length=20, choices=STOCK_STATUSES, default='available')
+
+    STOCK_ITEM_FIELD = 'deal_id'
 
     class Meta:
         unique_together = ('branch', 'deal')
+        indexes = [
+            models.Index(fields=['branch', 'effective_status'], name='idx_dealstock_branch_status'),
+            models.Index(fields=['branch', 'is_available'], name='idx_dealstock_branch_avail'),
+        ]
 
     def __str__(self):
         return f"{self.deal.title} at {self.branch.name}"
 
+    def save(self, *args, **kwargs):
+        self.effective_status = self.compute_effective_status()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'effective_status' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'effective_status']
+        super().save(*args, **kwargs)
+        change = (self.branch_id, 'deal', self.deal_id, self.effective_status)
+        transaction.on_commit(lambda: invalidate_stock_caches([change[0]], [change]))
+
+    def delete(self, *args, **kwargs):
+        change = (self.branch_id, 'deal', self.deal_id, 'available')  # No row counts as available
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: invalidate_stock_caches([change[0]], [change]))
+        return result
+
+    def compute_effective_status(self, now=None):
+        return ProductBranchStock.compute_effective_status(self, now)
+
+    def next_status_change(self, now=None):
+        return ProductBranchStock.next_status_change(self, now)
+
+    @classmethod
+    def unavailable_everywhere(cls, branch_ids, statuses=('unavailable', 'out_of_stock')):
+        return ProductBranchStock.unavailable_everywhere.__func__(cls, branch_ids, statuses)
+
     def get_availability_status(self):
         return ProductBranchStock.get_availability_status(self)
 
@@ -611,6 +736,12 @@ class Offer(models.Model):
     branch = models.ForeignKey('Branch', on_delete=models.SET_NULL, null=True, blank=True)
     applicable_headers = models.ManyToManyField(ProductCustomizationHeader, blank=True)
 
+    class Meta:
+        indexes = [
+            # get_active_flash_sale / active offer lookups
+            models.Index(fields=['offer_type', 'is_active', 'valid_from', 'valid_until'], name='idx_offer_type_active_window'),
+        ]
+
     def clean(self):
         if not self.is_percentage and self.applicable_headers.filter(
             customization_header__is_required=True
@@ -624,6 +755,8 @@ class Offer(models.Model):
             self.auto_apply = True
             
         super().save(*args, **kwargs)
+        # Flash sale prices are part of cached catalog payloads, and the scheduler reloads on a new version
+        transaction.on_commit(bump_catalog_version)
         
     @classmethod
     def get_active_flash_sale(cls):
@@ -775,7 +908,7 @@ class CartItem(models.Model):
             ":".join(expandable_ids)
         ])
 
-    def calculate_unit_prices(self, deal_price = None):
+    def calculate_unit_prices(self):
         """Calculate unit_price and unit_sale_price for one item, tracing parent-child hierarchy."""
         if self.is_free:
             self.unit_price = Decimal('0.00')
@@ -793,13 +926,20 @@ class CartItem(models.Model):
                 total_original = self.product.price
         
         if self.deal:
-            total_original = Decimal(deal_price)
+            # The deal's price at the cart's branch plus its components' choices, all from the catalog
+            from .pricing import branch_price
+            branch_id = self.cart.branch_id
+            deal_price = branch_price('deal', self.deal, branch_id) if branch_id else self.deal.price
+            total_original = deal_price + sum((c.original_price for c in customizations), Decimal('0.00'))
         
         expandable_total = sum(e.price for e in self.cartitemexpandablechoice_set.all()) or Decimal('0.00')
         self.unit_price = total_original + expandable_total
 
         # Sale unit price
-        if self.product and self.product.has_flash_sale:
+        if self.deal and self.deal.has_flash_sale:
+            total_sale = self.deal.flash_sale_price + sum((c.price for c in customizations), Decimal('0.00'))
+            self.unit_sale_price = total_sale + expandable_total
+        elif self.product and self.product.has_flash_sale:
             total_sale = Decimal('0.00')
             for c in customizations:
                 total_sale += c.price
@@ -821,8 +961,9 @@ class CartItem(models.Model):
         total = expandable_total
         
         if self.deal:
-            total += self.unit_price
-            return total * Decimal(str(self.quantity))
+            # unit prices already include the expandable choices
+            unit = self.unit_sale_price if self.unit_sale_price is not None else self.unit_price
+            return unit * Decimal(str(self.quantity))
         for c in customizations:
             total += c.price  # Use discounted price from frontend
         if self.product and self.product.has_flash_sale and total == 0:
@@ -842,8 +983,7 @@ class CartItem(models.Model):
         total = expandable_total
         
         if self.deal:
-            total += self.unit_price
-            return total * Decimal(str(self.quantity))
+            return self.unit_price * Decimal(str(self.quantity))
         for c in customizations:
             total += c.original_price  # Use discounted price from frontend
         if self.product and total == 0:
@@ -896,6 +1036,15 @@ class SpecialSuggestionsBranchWise(models.Model):
         if self.product and self.deal:
             raise ValidationError("Only one of it can be added")
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)  # Visible suggestions (suggestions.py) are cached per version
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
     
 class Order(models.Model):
     ORDER_STATUS = (
@@ -919,14 +1068,105 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     scheduled_at = models.DateTimeField(null=True, blank=True)  # New field for scheduling
+    branch = models.ForeignKey(Branch, on_delete=models.SET_NULL, null=True, blank=True)  # Cart branch at checkout
+    sales_recorded = models.BooleanField(default=False)  # Counted in the daily sales rollups
+    change_seq = models.BigIntegerField(default=0)  # next_id() of the last change, kitchen queue cursor
 
     class Meta:
         ordering = ['-id']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='idx_order_user_created'),  # Order history
+            models.Index(fields=['status', 'created_at'], name='idx_order_status_created'),  # Sales windows
+            models.Index(fields=['branch', 'status', 'created_at'], name='idx_order_branch_status'),  # Kitchen queue
+            models.Index(fields=['branch', 'change_seq'], name='idx_order_branch_change_seq'),  # Kitchen polling
+            models.Index(fields=['status', 'scheduled_at'], name='idx_order_status_scheduled'),  # Scheduled releases
+            models.Index(fields=['created_at'], name='idx_order_created'),  # Finance export ranges
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded status so save() only publishes real transitions
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
 
     def clean(self):
         if self.scheduled_at and self.scheduled_at <= timezone.now():
             raise ValidationError("Scheduled time must be in the future.")
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        status_changed = adding or getattr(self, '_loaded_status', None) != self.status
+        self.change_seq = next_id()
+        if not adding and kwargs.get('update_fields') is None:
+            # sales_recorded belongs to products/sales.py, never write back a stale in-memory copy
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields if not field.primary_key and field.name != 'sales_recorded'
+            ]
+        elif kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'change_seq'}
+        super().save(*args, **kwargs)
+        if status_changed:
+            self._loaded_status = self.status
+            Order.publish_status_events([self.id])
+            if not adding:
+                # New orders are recorded once their items exist, see OrderCreateSerializer.create
+                Order.sync_sales([self.id])
+
+    @classmethod
+    def set_status(cls, order_ids, new_status):
+        """
+        Central transition for many orders at once (kitchen/dispatch tools): one UPDATE, then one
+        status event per order after commit. Returns the number of orders that changed.
+        """
+        order_ids = list(cls.objects.filter(id__in=order_ids).exclude(status=new_status).values_list('id', flat=True))
+        if order_ids:
+            cls.objects.filter(id__in=order_ids).update(
+                status=new_status,
+                updated_at=timezone.now(),
+                # A distinct sequence per order keeps the kitchen queue cursor unambiguous
+                change_seq=models.Case(*[models.When(id=order_id, then=models.Value(next_id())) for order_id in order_ids]),
+            )
+            cls.publish_status_events(order_ids)
+            cls.sync_sales(order_ids)
+        return len(order_ids)
+
+    @classmethod
+    def sync_sales(cls, order_ids):
+        """Bring the daily sales rollups in line with the orders' status once the transaction commits."""
+        from .sales import sync_order_sales
+        order_ids = list(order_ids)
+        transaction.on_commit(lambda: sync_order_sales(order_ids))
+
+    @classmethod
+    def publish_status_events(cls, order_ids):
+        """Push the current status/ETA of `order_ids` to their owners once the transaction commits."""
+        order_ids = list(order_ids)
+
+        def send():
+            orders = cls.objects.filter(id__in=order_ids, user__isnull=False).select_related('delivery')
+            for order in orders:
+                publish(user_channel(order.user_id), order.status_event())
+
+        transaction.on_commit(send)
+
+    def status_event(self):
+        """Compact live event for this order, only what changes between PENDING and DELIVERED."""
+        try:
+            delivery = self.delivery
+        except Delivery.DoesNotExist:
+            delivery = None
+        return {
+            'type': 'order',
+            'order_id': self.id,
+            'status': self.status,
+            'payment_status': self.payment_status,
+            'delivery_status': delivery.status if delivery else None,
+            'estimated_arrival': delivery.estimated_arrival.isoformat() if delivery and delivery.estimated_arrival else None,
+            'tracking_url': delivery.tracking_url if delivery else '',
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
@@ -938,6 +1178,13 @@ class OrderItem(models.Model):
     subtotal = models.DecimalField(max_digits=10, decimal_places=2)  # quantity * unit_price
     is_free = models.BooleanField(default=False)  # Add this
 
+    class Meta:
+        indexes = [
+            # Per item sales joins (best sellers, popular)
+            models.Index(fields=['product', 'order'], name='idx_orderitem_product_order'),
+            models.Index(fields=['deal', 'order'], name='idx_orderitem_deal_order'),
+        ]
+
     def save(self, *args, **kwargs):
         # item = self.product or self.deal
         # self.unit_price = item.price if item else 0
@@ -971,10 +1218,84 @@ class OrderOffer(models.Model):
 
     class Meta:
         unique_together = ('order', 'offer') 
-               
-           
+
+
+#? Sales rollups, one row per (day, branch, item) with the quantity/revenue of orders in a sales
+#? status. Maintained incrementally by products/sales.py so N-day windows read at most N rows per
+#? item instead of re-aggregating OrderItem history. Branchless orders share one NULL-branch row per
+#? (day, item): the uniqueness is on Coalesce(branch, 0) because NULLs are distinct in a plain unique
+#? index (and MySQL supports neither nulls_distinct nor partial constraints). Sales history pins a
+#? branch (PROTECT) -- nulling it on delete could collide with that shared row; retire via is_active.
+SALES_STATUSES = ('CONFIRMED', 'PREPARING', 'DISPATCHED', 'DELIVERED')
+
+class DailyProductSales(models.Model):
+    day = models.DateField()
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                'day', Coalesce('branch', models.Value(0)), 'product', name='daily_product_sales_uniq',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'product'], name='idx_dailyproductsales_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.product_id}@{self.branch_id}: {self.quantity}"
+
+
+class DailyDealSales(models.Model):
+    day = models.DateField()
+    branch = models.ForeignKey(Branch, on_delete=models.PROTECT, null=True, blank=True)
+    deal = models.ForeignKey(Deal, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                'day', Coalesce('branch', models.Value(0)), 'deal', name='daily_deal_sales_uniq',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'deal'], name='idx_dailydealsales_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.deal_id}@{self.branch_id}: {self.quantity}"
+
+
 
 # Booking Management
+#? One row per branch per booking slot (BOOKING_SLOT_MINUTES long), created lazily by the first
+#? reservation. booked_seats is the running total of active bookings in the slot, reservations take
+#? the row lock so two concurrent bookings can never both squeeze into the last seats.
+BOOKING_SLOT_MINUTES = 30
+
+class BookingSlot(models.Model):
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
+    slot_start = models.DateTimeField()
+    capacity = models.PositiveIntegerField()
+    booked_seats = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['branch', 'slot_start'], name='booking_slot_branch_start_uniq'),
+        ]
+
+    @property
+    def remaining_seats(self):
+        return max(self.capacity - self.booked_seats, 0)
+
+    def __str__(self):
+        return f"{self.branch_id} @ {self.slot_start} ({self.booked_seats}/{self.capacity})"
+
+
 class Booking(models.Model):
     BOOKING_STATUS = (
         ('PENDING', 'Pending'),
@@ -988,11 +1309,30 @@ class Booking(models.Model):
     party_size = models.PositiveSmallIntegerField()
     status = models.CharField(max_length=20, choices=BOOKING_STATUS, default='PENDING')
     notes = models.TextField(blank=True)
+    slot = models.ForeignKey(BookingSlot, on_delete=models.SET_NULL, null=True, blank=True)  # Seats held, see products/bookings.py
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"Booking #{self.id} - {self.user.email} ({self.booking_date})"
+
+    SEAT_FIELDS = ('status', 'branch_id', 'booking_date', 'party_size', 'slot_id')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_seats = tuple(instance.__dict__.get(field) for field in cls.SEAT_FIELDS)
+        return instance
+
+    def save(self, *args, **kwargs):
+        from .bookings import move_held_seats
+        loaded = getattr(self, '_loaded_seats', None)
+        with transaction.atomic():
+            if loaded is not None and None not in loaded[:4]:
+                # Cancelling hands the seats back, rescheduling moves them (see products/bookings.py)
+                move_held_seats(self, loaded)
+            super().save(*args, **kwargs)
+        self._loaded_seats = tuple(getattr(self, field) for field in self.SEAT_FIELDS)
     
     def clean(self):
         if self.booking_date <= timezone.now():
@@ -1014,6 +1354,13 @@ class Invoice(models.Model):
     status = models.CharField(max_length=20, choices=INVOICE_STATUS, default='PENDING')
     issued_at = models.DateTimeField(auto_now_add=True)
     paid_at = models.DateTimeField(null=True, blank=True)
+    #? sha256 of the rendered receipt, also its file name under media/receipts (see products/receipts.py)
+    receipt_sha256 = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'receipt_sha256'], name='idx_invoice_receipt_pending'),
+        ]
 
     def clean(self):
         if (self.order is None and self.booking is None) or (self.order is not None and self.booking is not None):
@@ -1021,7 +1368,8 @@ class Invoice(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.invoice_number:
-            self.invoice_number = f"INV-{timezone.now().strftime('%Y%m%d')}-{self.order.id}"
+            # Generated id instead of date + order id, booking invoices have no order
+            self.invoice_number = new_reference('INV')
         super().save(*args, **kwargs)
 
     def __str__(self):
@@ -1086,12 +1434,43 @@ class Transaction(models.Model):
         if sum(1 for x in [self.invoice, self.order, self.booking] if x is not None) != 1:
             raise ValidationError("Exactly one of invoice, order, or booking must be set.")
 
+    def save(self, *args, **kwargs):
+        if not self.transaction_id:
+            self.transaction_id = new_reference('TXN')
+        super().save(*args, **kwargs)
+
     def __str__(self):
         if self.invoice != None:
             return f"Transaction {self.transaction_id} - {self.invoice.invoice_number}"
         else:
             return f"Transaction {self.transaction_id} - {self.invoice}"
 
+#? Raw Stripe webhook events. The webhook only verifies the signature and inserts here (event_id
+#? is the dedupe key, so Stripe retries cost one ignored insert), process_stripe_events applies them
+class StripeEvent(models.Model):
+    PROCESSING_STATUS = (
+        ('PENDING', 'Pending'),
+        ('PROCESSED', 'Processed'),
+        ('IGNORED', 'Ignored'),
+        ('FAILED', 'Failed'),
+    )
+    event_id = models.CharField(max_length=255, unique=True)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=PROCESSING_STATUS, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='idx_stripeevent_status'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
+
 # Delivery Management
 class DeliveryAgent(models.Model):
     name = models.CharField(max_length=100)
@@ -1117,10 +1496,24 @@ class Delivery(models.Model):
     assigned_at = models.DateTimeField(auto_now_add=True)
     delivered_at = models.DateTimeField(null=True, blank=True)
     tracking_url = models.URLField(blank=True)
+    estimated_arrival = models.DateTimeField(null=True, blank=True)  # ETA shown on the live order tracker
 
     def __str__(self):
         return f"Delivery for Order #{self.order.id}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_tracking = (instance.__dict__.get('status'), instance.__dict__.get('estimated_arrival'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        tracking_changed = self._state.adding or getattr(self, '_loaded_tracking', None) != (self.status, self.estimated_arrival)
+        super().save(*args, **kwargs)
+        if tracking_changed:
+            self._loaded_tracking = (self.status, self.estimated_arrival)
+            Order.publish_status_events([self.order_id])
+
 # Review and Rating
 class Review(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -1132,6 +1525,17 @@ class Review(models.Model):
 
     class Meta:
         unique_together = ('user', 'product', 'order')
+        constraints = [
+            # One review per user and product/order. The other column is always NULL, and NULLs are distinct
+            # in unique_together (MySQL has no partial constraints), so the uniqueness is on Coalesce
+            models.UniqueConstraint(
+                'user', Coalesce('product', models.Value(0)), Coalesce('order', models.Value(0)), name='review_user_item_uniq',
+            ),
+        ]
+        indexes = [
+            # Keyset pagination of a product's reviews, newest first
+            models.Index(fields=['product', '-created_at', '-id'], name='idx_review_product_created'),
+        ]
 
     def clean(self):
         if (self.product is None and self.order is None) or (self.product is not None and self.order is not None):
@@ -1141,6 +1545,48 @@ class Review(models.Model):
 
     def __str__(self):
         return f"Review by {self.user.email} - Rating: {self.rating}"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rating = (instance.__dict__.get('product_id'), instance.__dict__.get('rating'))
+        return instance
+
+    @staticmethod
+    def _adjust_product_rating(product_id, rating_delta, count_delta):
+        if not product_id or (not rating_delta and not count_delta):
+            return
+        new_sum = models.F('rating_sum') + rating_delta
+        new_count = models.F('rating_count') + count_delta
+        # rating_avg comes first: MySQL evaluates SET left to right with already updated values,
+        # so it must be computed from the old sum/count like every other backend does
+        Product.objects.filter(pk=product_id).update(
+            rating_avg=models.Case(
+                models.When(rating_count__gt=-count_delta, then=Round(Cast(new_sum, models.FloatField()) / new_count, 2)),
+                default=Decimal('0'),
+                output_field=models.DecimalField(max_digits=3, decimal_places=2),
+            ),
+            rating_sum=new_sum,
+            rating_count=new_count,
+        )
+
+    def save(self, *args, **kwargs):
+        old_product_id, old_rating = getattr(self, '_loaded_rating', (None, None))
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_product_id == self.product_id:
+                self._adjust_product_rating(self.product_id, self.rating - (old_rating or 0), 0 if old_rating else 1)
+            else:
+                self._adjust_product_rating(old_product_id, -(old_rating or 0), -1)
+                self._adjust_product_rating(self.product_id, self.rating, 1)
+        self._loaded_rating = (self.product_id, self.rating)
+
+    def delete(self, *args, **kwargs):
+        old_product_id, old_rating = getattr(self, '_loaded_rating', (self.product_id, self.rating))
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self._adjust_product_rating(old_product_id, -(old_rating or 0), -1)
+        return result
     
     
 class CarouselCard(models.Model):
@@ -1161,6 +1607,16 @@ class CarouselCard(models.Model):
     class Meta:
         ordering = ['sort_order']
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # The cached active carousel is keyed by catalog version
+        transaction.on_commit(bump_catalog_version)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
+
 
 class CarouselSchedule(models.Model):
     carousel_card = models.OneToOneField(CarouselCard,on_delete=models.CASCADE)
@@ -1200,4 +1656,10 @@ class CarouselSchedule(models.Model):
     def save(self, *args, **kwargs):
         # Run validation before saving
         self.full_clean()  # This calls clean() and other built-in validations
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(bump_catalog_version)
+        return result
\ No newline at end of file
@@ -0,0 +1,258 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+from .caching import catalog_cache_key
+from .models import (
+    CustomizationChoice, CustomizationPriceRule, DealBranchStock, DealProduct, ExpandableChoices, Offer, ProductBranchStock,
+    ProductChoicesUnavailablility, ProductCustomizationHeader,
+)
+
+#? Authoritative customization prices for cart writes. A product's price rules, standalone choices,
+#? unavailable choices and header discount caps are compiled once into a {choice id: entry} table and
+#? cached under the catalog version (any save to those models bumps it), the active flash sale is
+#? cached until it starts/ends. Pricing a selection is then a dict lookup per selected choice and no
+#? queries, with the same results CustomizationSerializer.get_choices shows the customer.
+#? Branch price overrides live in one small matrix per catalog version next to the flash sale overlay,
+#? so a whole menu's prices resolve from memory.
+PRICING_TIMEOUT = 60 * 60
+FLASH_SALE_MAX_TIMEOUT = 5 * 60
+CENT = Decimal('0.01')
+
+
+class InvalidSelection(Exception):
+    """A selected choice isn't offered for the product (unknown, unavailable or missing its parent choice)."""
+
+
+def compile_product_prices(product_id):
+    """
+    {'headers': {header id: (product header id, max_discount, is_percentage)},
+     'choices': {choice id: {'header': header id, 'price': standalone price or None, 'rules': {parent choice id or None: price}}}}
+    """
+    headers = {
+        header_id: (product_header_id, max_discount, is_percentage)
+        for product_header_id, header_id, max_discount, is_percentage in ProductCustomizationHeader.objects.filter(
+            product_id=product_id,
+        ).values_list('id', 'customization_header_id', 'max_discount', 'is_percentage')
+    }
+    choices = {}
+    rules = CustomizationPriceRule.objects.filter(product_id=product_id).order_by('id').values_list(
+        'customization_choice_id', 'customization_choice__customization_header_id',
+        'customization_price_rules_self__customization_choice_id', 'price',
+    )
+    ruled_choice_ids = set()
+    for choice_id, header_id, parent_choice_id, price in rules:
+        ruled_choice_ids.add(choice_id)
+        if header_id not in headers:
+            continue  # Rules of headers the product doesn't show are never offered
+        entry = choices.setdefault(choice_id, {'header': header_id, 'price': None, 'rules': {}})
+        entry['rules'].setdefault(parent_choice_id, price)  # Same as the menu, the first matching rule wins
+
+    unavailable = ProductChoicesUnavailablility.objects.filter(product_id=product_id).values_list('customization_choice_id', flat=True)
+    standalone = CustomizationChoice.objects.filter(customization_header_id__in=headers).exclude(
+        id__in=ruled_choice_ids,
+    ).exclude(id__in=unavailable).values_list('id', 'customization_header_id', 'price')
+    for choice_id, header_id, price in standalone:
+        choices[choice_id] = {'header': header_id, 'price': price, 'rules': {}}
+    return {'headers': headers, 'choices': choices}
+
+
+def get_product_prices(product_id):
+    key = catalog_cache_key('pricing', product_id)
+    compiled = cache.get(key)
+    if compiled is None:
+        compiled = compile_product_prices(product_id)
+        cache.set(key, compiled, timeout=PRICING_TIMEOUT)
+    return compiled
+
+
+def get_flash_sale():
+    """
+    The active flash sale as plain data ({'id', 'discount_value', 'is_percentage', 'product_ids', 'deal_ids', 'header_ids'})
+    or None, cached until it ends or the next one starts.
+    """
+    key = catalog_cache_key('flash_sale')
+    entry = cache.get(key)
+    now = timezone.now()
+    if entry is not None and now < entry['valid_until']:
+        return entry['sale']
+
+    sale, valid_until = None, now + timedelta(seconds=FLASH_SALE_MAX_TIMEOUT)
+    offer = Offer.get_active_flash_sale()
+    if offer is not None:
+        sale = {
+            'id': offer.id,
+            'discount_value': offer.discount_value,
+            'is_percentage': offer.is_percentage,
+            'product_ids': frozenset(offer.applicable_products.values_list('id', flat=True)),
+            'deal_ids': frozenset(offer.applicable_deals.values_list('id', flat=True)),
+            'header_ids': frozenset(offer.applicable_headers.values_list('id', flat=True)),
+        }
+        valid_until = min(valid_until, offer.valid_until)
+    next_start = Offer.objects.filter(
+        offer_type='FLASH_SALE', is_active=True, valid_from__gt=now,
+    ).order_by('valid_from').values_list('valid_from', flat=True).first()
+    if next_start is not None:
+        valid_until = min(valid_until, next_start)
+    cache.set(key, {'sale': sale, 'valid_until': valid_until}, timeout=max(int((valid_until - now).total_seconds()) + 1, 1))
+    return sale
+
+
+def _discount_of(item, sale):
+    """The (discount, is_percentage) a product/deal gets from the flash sale: its own override, else the offer's."""
+    if item.flash_sale_discount is not None:
+        return item.flash_sale_discount, item.flash_sale_is_percentage
+    return sale['discount_value'], sale['is_percentage']
+
+
+def _sale_price(item, sale, applicable_ids):
+    if sale is None:
+        return None
+    if applicable_ids and item.id not in applicable_ids:
+        return None
+    if not applicable_ids and item.flash_sale_discount is None:
+        return None
+    discount, is_percentage = _discount_of(item, sale)
+    if discount is None:
+        return None
+    discount = item.price * (discount / Decimal('100')) if is_percentage else discount
+    return max(item.price - discount, Decimal('0.00'))
+
+
+def product_sale_price(product, sale):
+    """Product.flash_sale_price against a cached flash sale."""
+    return _sale_price(product, sale, sale and sale['product_ids'])
+
+
+def deal_sale_price(deal, sale):
+    """Deal.flash_sale_price against a cached flash sale."""
+    return _sale_price(deal, sale, sale and sale['deal_ids'])
+
+
+def _price_overrides(model, item_field):
+    overrides = {}
+    rows = model.objects.filter(price__isnull=False).values_list(item_field, 'branch_id', 'price')
+    for item_id, branch_id, price in rows:
+        overrides.setdefault(item_id, {})[branch_id] = price
+    return overrides
+
+
+def get_branch_prices():
+    """
+    Branch price overrides as {'product': {product id: {branch id: price}}, 'deal': {...}}. Only stock
+    rows with a price are in it, so it stays small; loaded once per catalog version (stock saves bump it).
+    """
+    key = catalog_cache_key('branch_prices')
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = {
+            'product': _price_overrides(ProductBranchStock, 'product_id'),
+            'deal': _price_overrides(DealBranchStock, 'deal_id'),
+        }
+        cache.set(key, matrix, timeout=PRICING_TIMEOUT)
+    return matrix
+
+
+def branch_price(kind, item, branch_id):
+    """A product's/deal's price at one branch: the branch override, else the catalog price."""
+    return get_branch_prices()[kind].get(item.id, {}).get(int(branch_id), item.price)
+
+
+def lowest_branch_price(kind, item, branch_ids):
+    """The cheapest override among branch_ids, None when none of them overrides the price."""
+    overrides = get_branch_prices()[kind].get(item.id)
+    if not overrides:
+        return None
+    prices = [overrides[branch_id] for branch_id in {int(branch_id) for branch_id in branch_ids} if branch_id in overrides]
+    return min(prices) if prices else None
+
+
+def choice_sale_price(price, product, sale, header):
+    """The discounted choice price, capped by the header's max_discount, as get_choices computes it."""
+    _, max_discount, header_is_percentage = header
+    discount, is_percentage = _discount_of(product, sale)
+    if discount is None:
+        return price
+    discount = Decimal(str(discount))
+    if is_percentage:
+        if max_discount and header_is_percentage:
+            discount = min(discount, Decimal(str(max_discount)))
+        return price * (1 - discount / 100)
+    if max_discount:
+        max_flat = price * Decimal(str(max_discount)) / 100 if header_is_percentage else Decimal(str(max_discount))
+        return price - min(discount, max_flat)
+    return price - discount
+
+
+def price_selection(product, choice_ids):
+    """
+    Price the selected customization choices of `product` as {choice id: (price, original_price)}.
+    Raises InvalidSelection for a choice the product doesn't offer.
+    """
+    compiled = get_product_prices(product.id)
+    sale = get_flash_sale()
+    selected = set(choice_ids)
+    prices = {}
+    for choice_id in selected:
+        entry = compiled['choices'].get(choice_id)
+        if entry is None:
+            raise InvalidSelection(f'Choice {choice_id} is not available for {product.title}')
+        # A rule under a selected parent choice takes precedence over the choice's root rule
+        original_price = next(
+            (price for parent_id, price in entry['rules'].items() if parent_id is not None and parent_id in selected),
+            entry['rules'].get(None, entry['price']),
+        )
+        if original_price is None:
+            raise InvalidSelection(f'Choice {choice_id} needs another choice selected first')
+        header = compiled['headers'][entry['header']]
+        price = original_price
+        if sale is not None and header[0] in sale['header_ids']:
+            price = max(choice_sale_price(original_price, product, sale, header), Decimal('0.00'))
+        prices[choice_id] = (price.quantize(CENT), original_price)
+    return prices
+
+
+def price_deal_selection(deal, selections):
+    """
+    Price the customizations picked for a deal's components, each component priced like the product
+    on its own (which is what the deal listing shows). selections is [(deal product id, choice id)];
+    returns {(deal product id, choice id): (price, original_price)}.
+    """
+    deal_products = {dp.id: dp for dp in DealProduct.objects.filter(deal=deal).select_related('product')}
+    by_component = {}
+    for deal_product_id, choice_id in selections:
+        if deal_product_id not in deal_products:
+            raise InvalidSelection(f'Choice {choice_id} is not for a product of {deal.title}')
+        by_component.setdefault(deal_product_id, []).append(choice_id)
+    prices = {}
+    for deal_product_id, choice_ids in by_component.items():
+        for choice_id, price in price_selection(deal_products[deal_product_id].product, choice_ids).items():
+            prices[deal_product_id, choice_id] = price
+    return prices
+
+
+def expandable_choice_prices(choice_ids, product=None, deal=None):
+    """
+    {expandable choice id: price} for "make it a meal" choices picked with a product or a deal, at
+    the catalog price. Only the choices the listing offers for that item can be picked: the product's
+    own and its category's, or the deal's own and the global deal ones when the deal is expandable.
+    """
+    choice_ids = set(choice_ids)
+    if not choice_ids:
+        return {}
+    if product is not None:
+        offered = Q(deal__isnull=True, is_deal_global=False) & (
+            Q(base_product=product) | Q(category_id=product.category_id, base_product__isnull=True)
+        )
+    elif deal.is_expandable:
+        offered = Q(deal=deal, is_deal_global=False) | Q(deal__isnull=True, is_deal_global=True)
+    else:
+        offered = Q(pk__in=[])
+    prices = dict(ExpandableChoices.objects.filter(offered, id__in=choice_ids).values_list('id', 'price'))
+    missing = sorted(choice_ids - set(prices))
+    if missing:
+        raise InvalidSelection(f'Expandable choice {missing[0]} is not available for {(product or deal).title}')
+    return prices
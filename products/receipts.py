@@ -0,0 +1,91 @@
+import hashlib
+import logging
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.template.loader import render_to_string
+
+from .models import Invoice, OrderItem
+
+logger = logging.getLogger(__name__)
+
+#? Receipts are rendered once per paid invoice by the render_receipts worker and stored under
+#? media/receipts/<sha[:2]>/<sha>.html. The file name is the sha256 of the content, so it doubles as
+#? the ETag, identical receipts share one file and a stored file never changes.
+RECEIPT_DIR = 'receipts'
+RECEIPT_CONTENT_TYPE = 'text/html; charset=utf-8'
+RECEIPT_POINTER_TIMEOUT = 24 * 60 * 60
+
+
+def receipt_path(sha256):
+    return f'{RECEIPT_DIR}/{sha256[:2]}/{sha256}.html'
+
+
+def receipt_pointer_key(invoice_id):
+    return f'receipt:{invoice_id}'
+
+
+def render_receipt(invoice):
+    return render_to_string('receipts/invoice_receipt.html', {
+        'invoice': invoice,
+        'order': invoice.order,
+        'booking': invoice.booking,
+        'items': invoice.order.orderitem_set.all() if invoice.order else [],
+        'offers': invoice.order.orderoffer_set.all() if invoice.order else [],
+    })
+
+
+def store_receipt(content):
+    """Write content under its own hash (once) and return the hash."""
+    data = content.encode('utf-8')
+    sha256 = hashlib.sha256(data).hexdigest()
+    path = receipt_path(sha256)
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(data))
+    return sha256
+
+
+def render_pending_receipts(batch_size=50):
+    """Render receipts for paid invoices that don't have one yet. Returns how many were rendered."""
+    invoices = list(
+        Invoice.objects.filter(status='PAID', receipt_sha256='')
+        .select_related('order__address', 'order__user', 'booking__branch', 'booking__user')
+        .prefetch_related(
+            Prefetch('order__orderitem_set', queryset=OrderItem.objects.select_related('product', 'deal').prefetch_related(
+                'orderitemcustomization_set__customization_choice',
+                'orderitemexpandablechoice_set__expandable_choice',
+            )),
+            'order__orderoffer_set__offer',
+        )
+        .order_by('id')[:batch_size]
+    )
+    rendered = []
+    for invoice in invoices:
+        try:
+            invoice.receipt_sha256 = store_receipt(render_receipt(invoice))
+            rendered.append(invoice)
+        except Exception:
+            logger.exception('receipt rendering failed for invoice %s', invoice.id)
+    if rendered:
+        Invoice.objects.bulk_update(rendered, ['receipt_sha256'])
+    return len(rendered)
+
+
+def get_receipt_pointer(invoice_id):
+    """
+    (owner user id, receipt sha256) for an invoice, from the cache when possible. Only finished
+    receipts are cached, so a download of an already rendered receipt needs no DB query at all.
+    """
+    key = receipt_pointer_key(invoice_id)
+    pointer = cache.get(key)
+    if pointer is not None:
+        return pointer
+    row = Invoice.objects.filter(id=invoice_id).values('receipt_sha256', 'order__user_id', 'booking__user_id').first()
+    if row is None:
+        return None
+    pointer = (row['order__user_id'] or row['booking__user_id'], row['receipt_sha256'])
+    if pointer[1]:
+        cache.set(key, pointer, timeout=RECEIPT_POINTER_TIMEOUT)
+    return pointer
@@ -0,0 +1,87 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import SALES_STATUSES, DailyDealSales, DailyProductSales, Deal, Order, OrderItem, Product
+
+#? An order is added to the rollups when it first reaches a sales status and taken out again if it
+#? leaves them (cancelled). Order.sales_recorded says which side it is on; it is flipped under the
+#? order's row lock in the same transaction as the rollup update, so an order is never counted twice.
+ROLLUPS = (
+    (DailyProductSales, 'product'),
+    (DailyDealSales, 'deal'),
+)
+TOP_SELLERS_TIMEOUT = 10 * 60
+
+
+def _apply(model, item_field, rows, sign):
+    for row in rows:
+        key = {'day': row['day'], 'branch_id': row['branch_id'], f'{item_field}_id': row['item_id']}
+        increments = {
+            'quantity': F('quantity') + sign * (row['quantity'] or 0),
+            'revenue': F('revenue') + sign * (row['revenue'] or 0),
+        }
+        if model.objects.filter(**key).update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(**key, quantity=sign * (row['quantity'] or 0), revenue=sign * (row['revenue'] or 0))
+        except IntegrityError:
+            # A concurrent recorder created the row first
+            model.objects.filter(**key).update(**increments)
+
+
+def _move_orders(orders, sign):
+    """Add (sign=1) or remove (sign=-1) the locked `orders` queryset's items to/from the rollups."""
+    order_ids = list(orders.select_for_update().values_list('id', flat=True))
+    if not order_ids:
+        return 0
+    for model, item_field in ROLLUPS:
+        rows = OrderItem.objects.filter(order_id__in=order_ids, **{f'{item_field}__isnull': False}).values(
+            day=TruncDate('order__created_at'), branch_id=F('order__branch_id'), item_id=F(f'{item_field}_id'),
+        ).annotate(quantity=Sum('quantity'), revenue=Sum('subtotal')).order_by()
+        _apply(model, item_field, rows, sign)
+    Order.objects.filter(id__in=order_ids).update(sales_recorded=sign > 0)
+    return len(order_ids)
+
+
+def sync_order_sales(order_ids):
+    """Record orders that reached a sales status and unrecord cancelled ones. Returns (added, removed)."""
+    with transaction.atomic():
+        added = _move_orders(
+            Order.objects.filter(id__in=order_ids, sales_recorded=False, status__in=SALES_STATUSES), 1,
+        )
+        removed = _move_orders(
+            Order.objects.filter(id__in=order_ids, sales_recorded=True).exclude(status__in=SALES_STATUSES), -1,
+        )
+    return added, removed
+
+
+def window_sales(model, item_field, days=30):
+    """{item id: quantity} over the last `days` days, read from the rollups."""
+    since = (timezone.now() - timedelta(days=days)).date()
+    rows = model.objects.filter(day__gte=since).values(f'{item_field}_id').annotate(total=Sum('quantity')).order_by()
+    return {row[f'{item_field}_id']: row['total'] for row in rows if row['total'] > 0}
+
+
+def top_seller_ids(kind, fraction, days=30):
+    """
+    Ids of the best selling products/deals: the top `fraction` of the whole catalog (at least one)
+    by quantity sold over `days` days, among items that sold at all. Cached for a few minutes.
+    """
+    key = f'sales:top:{kind}:{fraction}:{days}'
+    ids = cache.get(key)
+    if ids is not None:
+        return ids
+    if kind == 'product':
+        sales, catalog_size = window_sales(DailyProductSales, 'product', days), Product.objects.count()
+    else:
+        sales, catalog_size = window_sales(DailyDealSales, 'deal', days), Deal.objects.count()
+    threshold = max(1, int(catalog_size * fraction))
+    ids = frozenset(sorted(sales, key=sales.get, reverse=True)[:threshold])
+    cache.set(key, ids, timeout=TOP_SELLERS_TIMEOUT)
+    return ids
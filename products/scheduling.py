@@ -0,0 +1,259 @@
+import heapq
+import logging
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.utils import timezone
+
+from .caching import get_catalog_version, invalidate_stock_caches
+from .events import CATALOG_CHANNEL, branch_channel, publish
+from .models import Branch, DealBranchStock, Offer, Order, ProductBranchStock
+
+logger = logging.getLogger(__name__)
+
+STOCK_FIELDS = ('id', 'branch_id', 'is_available', 'is_out_of_stock', 'out_of_stock_from', 'out_of_stock_until', 'effective_status')
+
+#? Windows end inclusively (out_of_stock_until, valid_until, closing_time), the state flips right after
+AFTER_END = timedelta(microseconds=1)
+
+
+class StockBoundaryScheduler:
+    """
+    Keeps ProductBranchStock/DealBranchStock.effective_status in step with the clock and pushes
+    live events when time alone changes what customers see.
+
+    Every row with a pending out_of_stock_from/out_of_stock_until boundary inside the horizon
+    sits in a min-heap keyed by that boundary. The worker sleeps until the earliest boundary,
+    flips every row that is due with one UPDATE per model/status and invalidates the catalog
+    caches once for the whole tick. Flash sale start/end and branch opening/closing times are
+    queued the same way, when one passes the worker publishes the new state on the event bus.
+    Saves from the admin bump the catalog version, which makes the worker reload the heap on
+    its next wake-up so new windows are picked up quickly.
+    """
+    STOCK_MODELS = {
+        'product': ProductBranchStock,
+        'deal': DealBranchStock,
+    }
+
+    def __init__(self, horizon=timedelta(hours=6), poll_interval=5.0):
+        self.horizon = horizon
+        self.poll_interval = poll_interval
+        self._heap = []
+        self._horizon_end = None
+        self._seen_version = None
+        self._flash_sale_id = None
+        self._open_branches = None
+
+    def load(self, now=None):
+        """Rebuild the heap from the database and repair any row whose status drifted."""
+        now = now or timezone.now()
+        self._heap = []
+        self._horizon_end = now + self.horizon
+        changes = []
+        for kind, model in self.STOCK_MODELS.items():
+            # Rows that are (or should be) out of stock right now, plus windows starting soon
+            rows = model.objects.filter(
+                models.Q(effective_status='out_of_stock') |
+                models.Q(
+                    is_available=True,
+                    is_out_of_stock=True,
+                    out_of_stock_from__lte=self._horizon_end,
+                    out_of_stock_until__gte=now,
+                )
+            ).only(*STOCK_FIELDS, model.STOCK_ITEM_FIELD)
+            changes += self._apply(kind, rows, now)
+        if changes:
+            self._seen_version = invalidate_stock_caches({change[0] for change in changes}, changes)
+        else:
+            self._seen_version = get_catalog_version()
+
+        self._load_flash_sales(now)
+        self._load_branches(now)
+        return len(self._heap)
+
+    def run_due(self, now=None):
+        """Flip every row whose boundary has passed. Returns the number of rows that changed status."""
+        now = now or timezone.now()
+        due = {kind: set() for kind in (*self.STOCK_MODELS, 'flash_sale', 'branch')}
+        while self._heap and self._heap[0][0] <= now:
+            _, kind, pk = heapq.heappop(self._heap)
+            due[kind].add(pk)
+
+        changes = []
+        for kind, model in self.STOCK_MODELS.items():
+            if due[kind]:
+                rows = model.objects.filter(pk__in=due[kind]).only(*STOCK_FIELDS, model.STOCK_ITEM_FIELD)
+                changes += self._apply(kind, rows, now)
+        if changes:
+            self._seen_version = invalidate_stock_caches({change[0] for change in changes}, changes)
+
+        if due['flash_sale']:
+            self._load_flash_sales(now, offer_ids=due['flash_sale'])
+        if due['branch']:
+            self._load_branches(now, branch_ids=due['branch'])
+        return len(changes)
+
+    def _apply(self, kind, rows, now):
+        model = self.STOCK_MODELS[kind]
+        item_field = model.STOCK_ITEM_FIELD
+        transitions = {}
+        changes = []
+        for row in rows:
+            status = row.compute_effective_status(now)
+            if status != row.effective_status:
+                transitions.setdefault(status, []).append(row.pk)
+                changes.append((row.branch_id, kind, getattr(row, item_field), status))
+            boundary = row.next_status_change(now)
+            if boundary is not None and boundary <= self._horizon_end:
+                heapq.heappush(self._heap, (boundary, kind, row.pk))
+
+        for status, pks in transitions.items():
+            model.objects.filter(pk__in=pks).update(effective_status=status)
+            logger.info('stock scheduler: %s %s rows -> %s', len(pks), kind, status)
+        return changes
+
+    def _load_flash_sales(self, now, offer_ids=None):
+        """Queue flash sale start/end boundaries and publish when the active flash sale changed."""
+        offers = Offer.objects.filter(
+            offer_type='FLASH_SALE',
+            is_active=True,
+            valid_from__lte=self._horizon_end,
+            valid_until__gte=now,
+        ).only('id', 'valid_from', 'valid_until')
+        if offer_ids is not None:
+            offers = offers.filter(id__in=offer_ids)
+        for offer in offers:
+            for boundary in (offer.valid_from, offer.valid_until + AFTER_END):
+                if now < boundary <= self._horizon_end:
+                    heapq.heappush(self._heap, (boundary, 'flash_sale', offer.id))
+                    break
+
+        # Same lookup as Offer.get_active_flash_sale, pinned to this tick's clock
+        active = Offer.objects.filter(
+            offer_type='FLASH_SALE', is_active=True, valid_from__lte=now, valid_until__gte=now,
+        ).values_list('id', flat=True).first()
+        if active != self._flash_sale_id:
+            publish(CATALOG_CHANNEL, {'type': 'flash_sale', 'is_flash_sale_active': active is not None, 'offer_id': active})
+            self._flash_sale_id = active
+
+    def _load_branches(self, now, branch_ids=None):
+        """Queue the next opening/closing time of each branch and publish branches that opened or closed."""
+        branches = Branch.objects.filter(is_active=True).only('id', 'opening_time', 'closing_time')
+        open_now = set()
+        for branch in branches:
+            if branch.is_open():
+                open_now.add(branch.id)
+            if branch_ids is not None and branch.id not in branch_ids:
+                continue
+            boundary = self._next_branch_boundary(branch, now)
+            if boundary is not None and boundary <= self._horizon_end:
+                heapq.heappush(self._heap, (boundary, 'branch', branch.id))
+
+        if self._open_branches is not None:
+            for branch_id in open_now ^ self._open_branches:
+                publish(branch_channel(branch_id), {'type': 'branch', 'branch_id': branch_id, 'is_open': branch_id in open_now})
+        self._open_branches = open_now
+
+    @staticmethod
+    def _next_branch_boundary(branch, now):
+        if not (branch.opening_time and branch.closing_time):
+            return None
+        local_now = timezone.localtime(now)
+        candidates = []
+        for day in (local_now.date(), local_now.date() + timedelta(days=1)):
+            candidates.append(timezone.make_aware(datetime.combine(day, branch.opening_time)))
+            candidates.append(timezone.make_aware(datetime.combine(day, branch.closing_time)) + AFTER_END)
+        return min((boundary for boundary in candidates if boundary > now), default=None)
+
+    def seconds_until_next(self, now=None):
+        now = now or timezone.now()
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    def needs_reload(self, now):
+        return (
+            self._horizon_end is None
+            or now + self.horizon / 2 >= self._horizon_end
+            or get_catalog_version() != self._seen_version
+        )
+
+    def run_forever(self):
+        while True:
+            close_old_connections()
+            now = timezone.now()
+            if self.needs_reload(now):
+                self.load(now)
+            self.run_due(now)
+
+            sleep_for = self.poll_interval
+            next_boundary = self.seconds_until_next()
+            if next_boundary is not None:
+                sleep_for = min(sleep_for, next_boundary)
+            time.sleep(sleep_for)
+
+
+class ScheduledOrderReleaser:
+    """
+    Moves scheduled orders from PENDING into the kitchen flow (CONFIRMED) `lead` before their
+    scheduled_at. Pending orders due within the horizon are read with one range scan on
+    (status, scheduled_at) into a min-heap keyed by release time; every tick releases whatever is
+    due with a single Order.set_status UPDATE (which also sends the order events). The heap is
+    refreshed every poll so orders placed or rescheduled meanwhile are picked up.
+    """
+
+    def __init__(self, lead=None, horizon=timedelta(hours=1), poll_interval=5.0, batch_size=500):
+        self.lead = lead if lead is not None else timedelta(minutes=settings.ORDER_PREP_LEAD_MINUTES)
+        self.horizon = horizon
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._heap = []
+
+    def load(self, now=None):
+        now = now or timezone.now()
+        rows = Order.objects.filter(
+            status='PENDING',
+            scheduled_at__isnull=False,
+            scheduled_at__lte=now + self.lead + self.horizon,
+        ).values_list('scheduled_at', 'id')
+        self._heap = [(scheduled_at - self.lead, order_id) for scheduled_at, order_id in rows]
+        heapq.heapify(self._heap)
+        return len(self._heap)
+
+    def run_due(self, now=None):
+        """Release every order whose time has come, batch_size per UPDATE. Returns how many were released."""
+        now = now or timezone.now()
+        released = 0
+        while self._heap and self._heap[0][0] <= now:
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                due.append(heapq.heappop(self._heap)[1])
+            with transaction.atomic():
+                # Re-check under lock: the order may have been cancelled or rescheduled since loading
+                order_ids = list(Order.objects.select_for_update().filter(
+                    id__in=due, status='PENDING', scheduled_at__lte=now + self.lead,
+                ).values_list('id', flat=True))
+                released += Order.set_status(order_ids, 'CONFIRMED')
+        if released:
+            logger.info('order releaser: %s scheduled orders released to the kitchen', released)
+        return released
+
+    def seconds_until_next(self, now=None):
+        now = now or timezone.now()
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    def run_forever(self):
+        while True:
+            close_old_connections()
+            self.load()
+            self.run_due()
+
+            sleep_for = self.poll_interval
+            next_release = self.seconds_until_next()
+            if next_release is not None:
+                sleep_for = min(sleep_for, next_release)
+            time.sleep(sleep_for)
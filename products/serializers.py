@@ -2,10 +2,53 @@ from rest_framework import serializers
 
 from core.serializers import UserAddressSerializer
 from .models import *
+from . import availability
+from .pricing import branch_price, choice_sale_price, get_flash_sale, lowest_branch_price
 from django.contrib.auth.models import AnonymousUser
+from django.db.models import Prefetch, Q, QuerySet, prefetch_related_objects
 from django.utils import timezone
 
 
+def prefetched(obj, attr, fallback):
+    """obj.<attr> when a prefetch graph loaded it, else fallback() (nested or unprefetched use)."""
+    value = getattr(obj, attr, None)
+    return value if value is not None else fallback()
+
+
+class PrefetchGraphMixin:
+    """
+    Serializers list the relations their fields read in prefetch_graph(context): prefetch_related
+    lookups, mostly Prefetch objects with to_attr lists that the fields read through prefetched().
+    Querysets, lists and instances handed to the serializer get the graph applied automatically,
+    so serializing N objects costs the same handful of queries as serializing one.
+    """
+
+    @classmethod
+    def prefetch_graph(cls, context):
+        return []
+
+    @classmethod
+    def apply_prefetch_graph(cls, instance, context):
+        lookups = cls.prefetch_graph(context or {})
+        if isinstance(instance, QuerySet):
+            return instance.prefetch_related(*lookups)
+        if isinstance(instance, models.Model):
+            prefetch_related_objects([instance], *lookups)
+        elif isinstance(instance, (list, tuple)):
+            prefetch_related_objects(list(instance), *lookups)
+        return instance
+
+    def __init__(self, instance=None, *args, **kwargs):
+        if isinstance(instance, models.Model):  # many=True goes through many_init instead
+            self.apply_prefetch_graph(instance, kwargs.get('context'))
+        super().__init__(instance, *args, **kwargs)
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        if args and args[0] is not None:
+            args = (cls.apply_prefetch_graph(args[0], kwargs.get('context')), *args[1:])
+        return super().many_init(*args, **kwargs)
+
 
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
@@ -76,98 +119,72 @@ class CustomizationSerializer(serializers.ModelSerializer):
 
     #     return CustomizationChoiceWithPriceSerializer(result, many=True).data
 
+    @classmethod
+    def product_prefetch_graph(cls):
+        """What get_choices reads from a product: its headers with their choices, price rules and unavailable choices."""
+        return [
+            Prefetch(
+                'productcustomizationheader_set',
+                queryset=ProductCustomizationHeader.objects.select_related('customization_header').prefetch_related(
+                    Prefetch('customization_header__customizationchoice_set', queryset=CustomizationChoice.objects.order_by('id'), to_attr='prefetched_choices')
+                ).order_by('id'),
+                to_attr='prefetched_headers',
+            ),
+            Prefetch(
+                'customizationpricerule_set',
+                queryset=CustomizationPriceRule.objects.select_related('customization_choice', 'customization_price_rules_self').order_by('id'),
+                to_attr='prefetched_price_rules',
+            ),
+            Prefetch('productchoicesunavailablility_set', to_attr='prefetched_unavailable'),
+        ]
+
     def get_choices(self, obj):
         from decimal import Decimal
         product = obj.product
-        active_flash_sale = Offer.get_active_flash_sale()
-        price_rules = CustomizationPriceRule.objects.filter(product=product).select_related(
-            'customization_choice', 'customization_price_rules_self'
-        )
-        unavailable = ProductChoicesUnavailablility.objects.filter(product=product).values_list(
-            'customization_choice', flat=True
-        )
-        price_rule_choices = {rule.customization_choice.id for rule in price_rules}
-        all_choices = CustomizationChoice.objects.filter(customization_header=obj.customization_header)
+        active_flash_sale = get_flash_sale()
+        price_rules = prefetched(product, 'prefetched_price_rules', lambda: list(
+            CustomizationPriceRule.objects.filter(product=product).select_related(
+                'customization_choice', 'customization_price_rules_self'
+            ).order_by('id')
+        ))
+        unavailable = {u.customization_choice_id for u in prefetched(
+            product, 'prefetched_unavailable', lambda: ProductChoicesUnavailablility.objects.filter(product=product)
+        )}
+        price_rule_choices = {rule.customization_choice_id for rule in price_rules}
+        all_choices = prefetched(obj.customization_header, 'prefetched_choices', lambda: CustomizationChoice.objects.filter(
+            customization_header=obj.customization_header
+        ).order_by('id'))
         result = []
 
         # Check if this header is in the offer's applicable_headers
-        applies_discount = (
-            active_flash_sale and
-            obj in active_flash_sale.applicable_headers.all()
-        )
+        applies_discount = active_flash_sale is not None and obj.id in active_flash_sale['header_ids']
+        header = (obj.id, obj.max_discount, obj.is_percentage)
+
+        def sale_price(price):
+            if applies_discount:
+                price = choice_sale_price(price, product, active_flash_sale, header)
+            return max(price, Decimal('0.00'))
 
         # Add choices from price rules
         for rule in price_rules:
-            if rule.customization_choice.customization_header == obj.customization_header:
-                original_price = rule.price
-                price = rule.price
-                if applies_discount:
-                    discount = (
-                        product.flash_sale_discount
-                        if product.flash_sale_discount is not None
-                        else active_flash_sale.discount_value if active_flash_sale else None
-                    )
-                    is_percentage = (
-                        product.flash_sale_is_percentage
-                        if product.flash_sale_discount is not None
-                        else active_flash_sale.is_percentage if active_flash_sale else False
-                    )
-                    if discount is not None:
-                        if is_percentage:
-                            effective_discount = Decimal(str(discount))
-                            if obj.max_discount and obj.is_percentage:
-                                effective_discount = min(effective_discount, Decimal(str(obj.max_discount)))
-                            price = rule.price * (1 - effective_discount / 100)
-                        else:
-                            if obj.max_discount:
-                                max_flat = (rule.price * Decimal(str(obj.max_discount)) / 100
-                                            if obj.is_percentage else Decimal(str(obj.max_discount)))
-                                price = rule.price - min(Decimal(str(discount)), max_flat)
-                            else:
-                                price = rule.price - Decimal(str(discount))
+            if rule.customization_choice.customization_header_id == obj.customization_header_id:
                 result.append({
                     'customization_choice': rule.customization_choice,
-                    'parent_choice': (rule.customization_price_rules_self.customization_choice.id
+                    'parent_choice': (rule.customization_price_rules_self.customization_choice_id
                                      if rule.customization_price_rules_self else None),
-                    'price': max(price, Decimal('0.00')),
-                    'original_price':original_price,
+                    'price': sale_price(rule.price),
+                    'original_price': rule.price,
                     'is_base': rule.is_base,
                 })
 
         # Add remaining choices from CustomizationChoice
         for choice in all_choices:
             if choice.id not in price_rule_choices and choice.id not in unavailable:
-                original_price = choice.price
-                price = choice.price
-                if applies_discount:
-                    discount = (
-                        product.flash_sale_discount
-                        if product.flash_sale_discount is not None
-                        else active_flash_sale.discount_value if active_flash_sale else None
-                    )
-                    is_percentage = (
-                        product.flash_sale_is_percentage
-                        if product.flash_sale_discount is not None
-                        else active_flash_sale.is_percentage if active_flash_sale else False
-                    )
-                    if discount is not None:
-                        if is_percentage:
-                            effective_discount = Decimal(str(discount))
-                            if obj.max_discount and obj.is_percentage:
-                                effective_discount = min(effective_discount, Decimal(str(obj.max_discount)))
-                            price = choice.price * (1 - effective_discount / 100)
-                        else:
-                            if obj.max_discount:
-                                max_flat = (choice.price * Decimal(str(obj.max_discount)) / 100
-                                            if obj.is_percentage else Decimal(str(obj.max_discount)))
-                                price = choice.price - min(Decimal(str(discount)), max_flat)
-                            else:
-                                price = choice.price - Decimal(str(discount))
                 result.append({
                     'customization_choice': choice,
                     'parent_choice': None,
-                    'price': max(price, Decimal('0.00')),
-                    'original_price':original_price,
+                    'price': sale_price(choice.price),
+                    'original_price': choice.price,
                     'is_base': False,
                 })
 
@@ -183,6 +200,20 @@ class ExpandableChoiceSerializer(serializers.ModelSerializer):
         model = ExpandableChoices
         fields = ['id', 'title', 'price', 'is_veg']
 
+def expandable_customizations_data(choices):
+    """[{'expandable_header', 'choices'}] grouped by header (id order) from id ordered expandable choices."""
+    by_header = {}
+    for choice in choices:
+        by_header.setdefault(choice.expandable_header_id, (choice.expandable_header, []))[1].append(choice)
+    return [
+        {
+            'expandable_header': ExpandableHeaderSerializer(header).data,
+            'choices': ExpandableChoiceSerializer(header_choices, many=True).data,
+        }
+        for _, (header, header_choices) in sorted(by_header.items())
+    ]
+
+
 class DealProductCreationSerializer(serializers.Serializer):
     product = serializers.IntegerField()  # Explicitly expect an integer PK
     quantity = serializers.IntegerField(min_value=1, default=1)
@@ -225,6 +256,32 @@ class DealCreationSerializer(serializers.ModelSerializer):
         
         return deal
     
+def stock_rows_availability(stocks, total_branches):
+    """Availability of an item from its (id ordered) stock rows at the requested branches."""
+    # If no records exist, all branches have it available by default
+    if not stocks:
+        return {"status": "available", "message": "In stock"}
+
+    # Count branches with explicit unavailability or out-of-stock status
+    unavailable_count = 0
+    for stock in stocks:
+        status = stock.get_availability_status()
+        if status['status'] in ['unavailable', 'out_of_stock']:
+            unavailable_count += 1
+        # Early exit: If we find a branch with availability, stop and return
+        elif status['status'] == 'available':
+            return {"status": "available", "message": "In stock"}
+
+    # If the number of unavailable/out-of-stock records equals the number of branches,
+    # the item is unavailable across all specified branches
+    if unavailable_count == total_branches:
+        # Return the first status as a representative (could be out_of_stock or unavailable)
+        return stocks[0].get_availability_status()
+
+    # If fewer than all branches have a record, at least one branch has it available
+    return {"status": "available", "message": "In stock"}
+
+
 class DealProductSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='product.id', read_only=True)
     deal_product_id = serializers.IntegerField(source='id', read_only=True)
@@ -255,34 +312,15 @@ class DealProductSerializer(serializers.ModelSerializer):
         total_branches = len(branch_ids)
         
         # Fetch all stock records for this product across the provided branch_ids
-        stocks = ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj.product)
-        
-        # If no records exist, all branches have it available by default
-        if not stocks.exists():
-            return {"status": "available", "message": "In stock"}
-
-        # Count branches with explicit unavailability or out-of-stock status
-        unavailable_count = 0
-        for stock in stocks:
-            status = stock.get_availability_status()
-            if status['status'] in ['unavailable', 'out_of_stock']:
-                unavailable_count += 1
-            # Early exit: If we find a branch with availability, stop and return
-            elif status['status'] == 'available':
-                return {"status": "available", "message": "In stock"}
-
-        # If the number of unavailable/out-of-stock records equals the number of branches,
-        # the product is unavailable across all specified branches
-        if unavailable_count == total_branches:
-            # Return the first status as a representative (could be out_of_stock or unavailable)
-            return stocks.first().get_availability_status()
-
-        # If fewer than all branches have a record, at least one branch has it available
-        return {"status": "available", "message": "In stock"}
+        stocks = ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj.product).order_by('id')
+        return stock_rows_availability(list(stocks), total_branches)
     
     
     def get_customizations(self, obj):
         if hasattr(obj.product, 'is_customizable') and obj.product.is_customizable:
+            trees = self.context.get('customization_trees')
+            if trees is not None:  # Built in bulk for a deal listing (deals.py)
+                return trees.get(obj.product_id, [])
             product_customizations = ProductCustomizationHeader.objects.filter(product=obj.product)
             
             return CustomizationSerializer(product_customizations, many=True).data
@@ -317,42 +355,59 @@ class DealSerializer(serializers.ModelSerializer):
     is_best_seller = serializers.BooleanField(read_only=True)
     is_new = serializers.BooleanField(read_only=True)
     is_popular = serializers.BooleanField(read_only=True)
+    is_favorite = serializers.SerializerMethodField()
 
     class Meta:
         model = Deal
-        fields = ['id','is_new','is_popular','is_best_seller', 'title','description','image', 'price', 'is_active', 'is_expandable', 'products', 'expandable_customizations','branch_price','branch_availability','flash_sale_price', 'has_flash_sale']
+        fields = ['id','is_new','is_popular','is_best_seller', 'title','description','image', 'price', 'is_active', 'is_expandable', 'products', 'expandable_customizations','branch_price','branch_availability','flash_sale_price', 'has_flash_sale', 'is_favorite']
+
+    def get_is_favorite(self, obj):
+        return obj.id in self.context.get('favorite_deal_ids', ())
+
+    def _composition(self, obj):
+        # Views put the compositions of the whole listing in the context, anything else loads its own
+        compositions = self.context.setdefault('deal_compositions', {})
+        if obj.id not in compositions:
+            from .deals import load_deal_compositions
+            compositions.update(load_deal_compositions([obj]))
+        return compositions[obj.id]
+
+    def _branch_stocks(self, model, item_field):
+        """
+        {item id: [stock rows at the requested branches]}. Rows are loaded with one query for every
+        deal whose composition is in the context and hasn't been covered yet, so a listing pays once.
+        """
+        stocks = self.context.setdefault(f'{item_field}_branch_stocks', {})
+        compositions = self.context['deal_compositions']
+        if item_field == 'product':
+            item_ids = {component['id'] for composition in compositions.values() for component in composition['components']}
+        else:
+            item_ids = set(compositions)
+        missing = item_ids - stocks.keys()
+        if missing:
+            for item_id in missing:
+                stocks[item_id] = []
+            rows = model.objects.filter(branch_id__in=self.context['branch_ids'], **{f'{item_field}_id__in': missing}).order_by('id')
+            for stock in rows:
+                stocks[getattr(stock, f'{item_field}_id')].append(stock)
+        return stocks
 
     def get_products(self, obj):
         branch_ids = self.context.get('branch_ids', [])
-        deal_products = obj.dealproduct_set.all()
-        if branch_ids:
-            # Fetch all ProductBranchStock records for products in this deal
-            product_ids = deal_products.values_list('product__id', flat=True)
-            product_stocks = ProductBranchStock.objects.filter(
-                branch_id__in=branch_ids,
-                product_id__in=product_ids
-            )
+        components = self._composition(obj)['components']
+        if not branch_ids:
+            return [{**component, 'branch_availability': {"status": "available", "message": "In stock"}} for component in components]
 
-            # Determine availability for each product
-            product_availability = {}
-            total_branches = len(branch_ids)
-            for product_id in product_ids:
-                
-                stocks_for_product = product_stocks.filter(product_id=product_id)
-                total_branches_with_stock = stocks_for_product.count()
-                unavailable_count = sum(1 for stock in stocks_for_product if not stock.is_available)
-
-                # Exclude if unavailable at all branches
-                if total_branches_with_stock == total_branches and unavailable_count == total_branches:
-                    product_availability[product_id] = False
-                else:
-                    product_availability[product_id] = True
-
-            # Filter out unavailable products
-            available_product_ids = [pid for pid, available in product_availability.items() if available]
-            deal_products = deal_products.filter(product__id__in=available_product_ids)
-
-        return DealProductSerializer(deal_products, many=True, context=self.context).data
+        product_stocks = self._branch_stocks(ProductBranchStock, 'product')
+        total_branches = len(branch_ids)
+        products = []
+        for component in components:
+            stocks = product_stocks.get(component['id'], [])
+            # Exclude if unavailable at all branches
+            if len(stocks) == total_branches and all(not stock.is_available for stock in stocks):
+                continue
+            products.append({**component, 'branch_availability': stock_rows_availability(stocks, total_branches)})
+        return products
     
     def get_branch_availability(self, obj):
         # if not obj.is_active:
@@ -383,49 +438,19 @@ class DealSerializer(serializers.ModelSerializer):
         # If all products are unavailable or out of stock across all branches
         # if all_products_unavailable:
         #     # Return the availability of the first product as a representative status
-        # Fetch all stock records for this product across the provided branch_ids
-        stocks = DealBranchStock.objects.filter(branch_id__in=branch_ids, deal_id=obj.id)
-        
-        # If no records exist, all branches have it available by default
-        if not stocks.exists():
-            return {"status": "available", "message": "In stock"}
-
-        # Count branches with explicit unavailability or out-of-stock status
-        unavailable_count = 0
-        for stock in stocks:
-            status = stock.get_availability_status()
-            if status['status'] in ['unavailable', 'out_of_stock']:
-                unavailable_count += 1
-            # Early exit: If we find a branch with availability, stop and return
-            elif status['status'] == 'available':
-                return {"status": "available", "message": "In stock"}
-
-        # If the number of unavailable/out-of-stock records equals the number of branches,
-        # the product is unavailable across all specified branches
-        if unavailable_count == total_branches:
-            # Return the first status as a representative (could be out_of_stock or unavailable)
-            return stocks.first().get_availability_status()
-
-        # If fewer than all branches have a record, at least one branch has it available
-        return {"status": "available", "message": "In stock"}
+        # Stock records for this deal across the provided branch_ids, loaded for the whole listing at once
+        stocks = self._branch_stocks(DealBranchStock, 'deal').get(obj.id, [])
+        return stock_rows_availability(stocks, total_branches)
 
     def get_branch_price(self, obj):
         branch_id = self.context.get('branch_id')
         if branch_id:
-            stock = DealBranchStock.objects.filter(branch_id=branch_id, deal=obj).first()
-            return stock.price if stock and stock.price is not None else obj.price
+            return branch_price('deal', obj, branch_id)
         return obj.price
     
     def get_expandable_customizations(self, obj):
-        if not obj.is_expandable:
-            return []
-
-        deal_choices = ExpandableChoices.objects.filter(deal=obj, is_deal_global=False)
-        global_choices = ExpandableChoices.objects.filter(deal__isnull=True, is_deal_global=True)
-        expandable_headers = ExpandableHeader.objects.filter(
-            id__in=(deal_choices | global_choices).values_list('expandable_header', flat=True).distinct()
-        )
-        return ExpandableCustomizationSerializer(expandable_headers, many=True, context={'deal': obj}).data
+        # Deal-specific plus global choices grouped by header, from the cached composition
+        return self._composition(obj)['expandable_customizations']
         
         # # Pass context to DealProductSerializer about whether expandable_customizations is populated
         # self.context['deal_has_expandable'] = bool(expandable_data)  # True if not empty
@@ -482,6 +507,27 @@ class BookingSerializer(serializers.ModelSerializer):
         model = Booking
         fields = ['id', 'user', 'booking_date', 'party_size', 'status', 'notes', 'branch', 'created_at', 'updated_at']
         
+class ReviewSerializer(serializers.ModelSerializer):
+    user_name = serializers.CharField(source='user.name', read_only=True)
+
+    class Meta:
+        model = Review
+        fields = ['id', 'user', 'user_name', 'product', 'order', 'rating', 'comment', 'created_at']
+        read_only_fields = ['user', 'created_at']
+        validators = []  # (user, product, order) uniqueness is checked in the view, user comes from the token
+
+    def validate_rating(self, value):
+        if value < 1 or value > 5:
+            raise serializers.ValidationError("Rating must be between 1 and 5.")
+        return value
+
+    def validate(self, data):
+        product = data.get('product', getattr(self.instance, 'product', None))
+        order = data.get('order', getattr(self.instance, 'order', None))
+        if (product is None) == (order is None):
+            raise serializers.ValidationError("Exactly one of product or order must be set.")
+        return data
+
 class PaymentMethodSerializer(serializers.ModelSerializer):
     class Meta:
         model = PaymentMethod
@@ -500,9 +546,9 @@ class CancellationSerializer(serializers.ModelSerializer):
         
 
   
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductDetailSerializer(PrefetchGraphMixin, serializers.ModelSerializer):
     category = CategorySerializer(read_only=True)
-    customizations = CustomizationSerializer(source='productcustomizationheader_set', many=True, read_only=True)
+    customizations = serializers.SerializerMethodField()
     expandable_customizations = serializers.SerializerMethodField()
     image = serializers.ImageField(read_only=True, allow_null=True)  # Return image
     branch_availability = serializers.SerializerMethodField()
@@ -512,13 +558,49 @@ class ProductDetailSerializer(serializers.ModelSerializer):
     is_best_seller = serializers.BooleanField(read_only=True)
     is_new = serializers.BooleanField(read_only=True)
     is_popular = serializers.BooleanField(read_only=True)
+    is_favorite = serializers.SerializerMethodField()
 
     class Meta:
         model = Product
-        fields = ['id','is_new','is_popular','is_best_seller','title','description', 'image', 'category', 'is_veg','is_customizable', 'price', 'customizations', 'expandable_customizations','branch_price', 'branch_availability', 'flash_sale_price', 'has_flash_sale']
-    
-    
-    
+        fields = ['id','is_new','is_popular','is_best_seller','title','description', 'image', 'category', 'is_veg','is_customizable', 'price', 'customizations', 'expandable_customizations','branch_price', 'branch_availability', 'flash_sale_price', 'has_flash_sale', 'rating_avg', 'rating_count', 'is_favorite']
+
+    @classmethod
+    def prefetch_graph(cls, context):
+        graph = [
+            'category',
+            Prefetch('producttags_set', queryset=ProductTags.objects.select_related('tag'), to_attr='prefetched_tags'),
+            *CustomizationSerializer.product_prefetch_graph(),
+            # "Make it a Meal" options of the product itself and of its category
+            Prefetch(
+                'expandable_choices',
+                queryset=ExpandableChoices.objects.filter(deal__isnull=True, is_deal_global=False).select_related('expandable_header').order_by('id'),
+                to_attr='prefetched_expandables',
+            ),
+            Prefetch(
+                'category__expandablechoices_set',
+                queryset=ExpandableChoices.objects.filter(
+                    deal__isnull=True, base_product__isnull=True, is_deal_global=False
+                ).select_related('expandable_header').order_by('id'),
+                to_attr='prefetched_expandables',
+            ),
+        ]
+        if context.get('branch_ids'):
+            graph.append(Prefetch(
+                'productbranchstock_set',
+                queryset=ProductBranchStock.objects.filter(branch_id__in=context['branch_ids']).order_by('id'),
+                to_attr='prefetched_branch_stocks',
+            ))
+        return graph
+
+    def get_is_favorite(self, obj):
+        # The view puts the user's favorite ids in the context once per request
+        return obj.id in self.context.get('favorite_product_ids', ())
+
+    def get_customizations(self, obj):
+        headers = prefetched(obj, 'prefetched_headers', lambda: obj.productcustomizationheader_set.select_related(
+            'customization_header'
+        ).order_by('id'))
+        return CustomizationSerializer(headers, many=True, context=self.context).data
     
     def get_branch_availability(self, obj):
         # if not obj.is_active:
@@ -530,49 +612,27 @@ class ProductDetailSerializer(serializers.ModelSerializer):
 
         # Count the number of branches provided
         total_branches = len(branch_ids)
-        # Fetch all stock records for this product across the provided branch_ids
-        stocks = ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj)
-        # If no records exist, all branches have it available by default
-        if not stocks.exists():
-            return {"status": "available", "message": "In stock"}
-
-        # Count branches with explicit unavailability or out-of-stock status
-        unavailable_count = 0
-        for stock in stocks:
-            status = stock.get_availability_status()
-            if status['status'] in ['unavailable', 'out_of_stock']:
-                unavailable_count += 1
-            # Early exit: If we find a branch with availability, stop and return
-            elif status['status'] == 'available':
-                return {"status": "available", "message": "In stock"}
-        # If the number of unavailable/out-of-stock records equals the number of branches,
-        # the product is unavailable across all specified branches
-        if unavailable_count == total_branches:
-            # Return the first status as a representative (could be out_of_stock or unavailable)
-            return stocks.first().get_availability_status()
-
-        # If fewer than all branches have a record, at least one branch has it available
-        return {"status": "available", "message": "In stock"}
+        # All stock records for this product across the provided branch_ids
+        stocks = prefetched(obj, 'prefetched_branch_stocks', lambda: list(
+            ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj).order_by('id')
+        ))
+        return stock_rows_availability(stocks, total_branches)
 
     def get_branch_price(self, obj):
         branch_id = self.context.get('branch_id')
         if branch_id:
-            stock = ProductBranchStock.objects.filter(branch_id=branch_id, product=obj).first()
-            return stock.price if stock and stock.price is not None else obj.price
+            return branch_price('product', obj, branch_id)
         return obj.price
     
     def get_expandable_customizations(self, obj):
-        # Fetch headers for single product "Make it a Meal" options
-        category_choices = ExpandableChoices.objects.filter(
+        # Single product "Make it a Meal" options: category level ones plus the product's own
+        category_choices = prefetched(obj.category, 'prefetched_expandables', lambda: ExpandableChoices.objects.filter(
             category=obj.category, deal__isnull=True, base_product__isnull=True, is_deal_global=False
-        )
-        product_choices = ExpandableChoices.objects.filter(
+        ).select_related('expandable_header').order_by('id'))
+        product_choices = prefetched(obj, 'prefetched_expandables', lambda: ExpandableChoices.objects.filter(
             base_product=obj, deal__isnull=True, is_deal_global=False
-        )
-        expandable_headers = ExpandableHeader.objects.filter(
-            id__in=(category_choices | product_choices).values_list('expandable_header', flat=True).distinct()
-        )
-        return ExpandableCustomizationSerializer(expandable_headers, many=True, context={'product': obj}).data
+        ).select_related('expandable_header').order_by('id'))
+        return expandable_customizations_data(sorted([*category_choices, *product_choices], key=lambda choice: choice.id))
         
 
  
@@ -664,31 +724,28 @@ class MenuItemSerializer(serializers.ModelSerializer):
     def get_price(self, obj):
         branch_ids = self.context.get('branch_ids')
         if branch_ids:
+            # Cheapest branch override from the cached price matrix
             if obj.product:
-                stocks = ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj.product)
-                prices = [stock.price for stock in stocks if stock.price is not None]
-                return min(prices) if prices else obj.product.price
+                price = lowest_branch_price('product', obj.product, branch_ids)
+                return price if price is not None else obj.product.price
             elif obj.deal:
-                stocks = DealBranchStock.objects.filter(branch_id__in=branch_ids, deal=obj.deal)
-                prices = [stock.price for stock in stocks if stock.price is not None]
-                return min(prices) if prices else obj.deal.price
+                price = lowest_branch_price('deal', obj.deal, branch_ids)
+                return price if price is not None else obj.deal.price
         return obj.product.price if obj.product else obj.deal.price if obj.deal else None
     
     def get_flash_sale_price(self, obj):
         branch_ids = self.context.get('branch_ids')
         if branch_ids:
             if obj.product and obj.product.has_flash_sale:
-                stocks = ProductBranchStock.objects.filter(branch_id__in=branch_ids, product=obj.product)
-                prices = [stock.price for stock in stocks if stock.price is not None]
-                return min(prices) if prices else obj.product.flash_sale_price
+                price = lowest_branch_price('product', obj.product, branch_ids)
+                return price if price is not None else obj.product.flash_sale_price
             elif obj.deal and obj.deal.has_flash_sale:
-                stocks = DealBranchStock.objects.filter(branch_id__in=branch_ids, deal=obj.deal)
-                prices = [stock.price for stock in stocks if stock.price is not None]
-                return min(prices) if prices else obj.deal.flash_sale_price
-        elif obj.product.has_flash_sale:
-            return obj.product.flash_sale_price   
-        elif obj.product.has_flash_sale:
+                price = lowest_branch_price('deal', obj.deal, branch_ids)
+                return price if price is not None else obj.deal.flash_sale_price
+        elif obj.product and obj.product.has_flash_sale:
             return obj.product.flash_sale_price   
+        elif obj.deal and obj.deal.has_flash_sale:
+            return obj.deal.flash_sale_price   
         return None
 
 
@@ -743,105 +800,18 @@ class MenuSerializer(serializers.ModelSerializer):
         items = obj.menuitem_set.all()
 
         if branch_ids:
-            total_branches = len(branch_ids)
-
             # Step 1: Filter out products unavailable or out of stock at all branches
-            product_items = items.filter(product__isnull=False)
-            product_ids = product_items.values_list('product__id', flat=True)
-            product_stocks = ProductBranchStock.objects.filter(
-                branch_id__in=branch_ids,
-                product_id__in=product_ids
-            )
-
-            product_availability = {}
-            for product_id in product_ids:
-                stocks_for_product = product_stocks.filter(product_id=product_id)
-                total_branches_with_stock = stocks_for_product.count()
-                if total_branches_with_stock == 0:
-                    product_availability[product_id] = True
-                else:
-                    unavailable_count = 0
-                    for stock in stocks_for_product:
-                        status = stock.get_availability_status()
-                        if status['status'] in ['unavailable', 'out_of_stock']:
-                            unavailable_count += 1
-                    if total_branches_with_stock == total_branches and unavailable_count == total_branches:
-                        product_availability[product_id] = False
-                    else:
-                        product_availability[product_id] = True
-
-            unavailable_product_ids = [pid for pid, available in product_availability.items() if not available]
-            items = items.exclude(product__id__in=unavailable_product_ids)
-
-            # Step 2: Filter out deals unavailable or out of stock at all branches, or with all products unavailable/out of stock
-            deal_items = items.filter(deal__isnull=False)
-            deal_ids = deal_items.values_list('deal__id', flat=True)
-            deal_stocks = DealBranchStock.objects.filter(
-                branch_id__in=branch_ids,
-                deal_id__in=deal_ids
+            blocked_products = availability.unavailable_everywhere('product', branch_ids)
+            items = items.exclude(product__id__in=blocked_products)
+
+            # Step 2: Filter out deals unavailable or out of stock at all branches,
+            # and keep only deals that still have at least one orderable product
+            blocked_deals = availability.unavailable_everywhere('deal', branch_ids)
+            orderable_deals = DealProduct.objects.exclude(product_id__in=blocked_products).values('deal_id')
+            items = items.exclude(deal__id__in=blocked_deals).filter(
+                Q(deal__isnull=True) | Q(deal__id__in=orderable_deals)
             )
 
-            deal_availability = {}
-            for deal_id in deal_ids:
-                deal_stocks_for_deal = deal_stocks.filter(deal_id=deal_id)
-                total_branches_with_deal_stock = deal_stocks_for_deal.count()
-                
-                if total_branches_with_deal_stock == 0:
-                    deal_availability[deal_id] = True
-                else:
-                    deal_unavailable_count = 0
-                    for stock in deal_stocks_for_deal:
-                        status = stock.get_availability_status()
-                        if status['status'] in ['unavailable', 'out_of_stock']:
-                            deal_unavailable_count += 1
-                    if total_branches_with_deal_stock == total_branches and deal_unavailable_count == total_branches:
-                        deal_availability[deal_id] = False
-                    else:
-                        deal_availability[deal_id] = True
-
-            # For deals that are available, check their products
-            potentially_available_deal_ids = [did for did, available in deal_availability.items() if available]
-            deal_products = DealProduct.objects.filter(deal_id__in=potentially_available_deal_ids)
-            product_ids_in_deals = deal_products.values_list('product__id', flat=True)
-            product_stocks_in_deals = ProductBranchStock.objects.filter(
-                branch_id__in=branch_ids,
-                product_id__in=product_ids_in_deals
-            )
-
-            product_availability_in_deals = {}
-            for product_id in product_ids_in_deals:
-                
-                stocks_for_product = product_stocks_in_deals.filter(product_id=product_id)
-                total_branches_with_stock = stocks_for_product.count()
-                
-                if total_branches_with_stock == 0:
-                    product_availability_in_deals[product_id] = True
-                    
-                else:
-                    unavailable_count = 0
-                    
-                    for stock in stocks_for_product:
-                        status = stock.get_availability_status()
-                        if status['status'] in ['unavailable', 'out_of_stock']:
-                            unavailable_count += 1
-                    if total_branches_with_stock == total_branches and unavailable_count == total_branches:
-                        product_availability_in_deals[product_id] = False
-                    else:
-                        product_availability_in_deals[product_id] = True
-
-            # Exclude deals where all products are unavailable or out of stock
-            unavailable_deal_ids = []
-            for deal_id in potentially_available_deal_ids:
-                deal_product_ids = deal_products.filter(deal_id=deal_id).values_list('product__id', flat=True)
-                all_unavailable = all(not product_availability_in_deals.get(pid, True) for pid in deal_product_ids)
-                if all_unavailable:
-                    unavailable_deal_ids.append(deal_id)
-
-            # Combine deal-level and product-level unavailability
-            final_unavailable_deal_ids = [did for did, available in deal_availability.items() if not available] + unavailable_deal_ids
-            items = items.exclude(deal__id__in=final_unavailable_deal_ids)
-            
-
         return MenuItemSerializer(items, many=True, context=self.context).data
     
         
@@ -891,9 +861,47 @@ class DealBranchStockSerializer(serializers.ModelSerializer):
 
     def get_availability_status(self, obj):
         return obj.get_availability_status()
-    
-    
-        
+
+
+#? Bulk stock changes are partial: only the keys sent are changed, the rest keep their current value
+class StockChangeSerializer(serializers.Serializer):
+    is_available = serializers.BooleanField(required=False)
+    is_out_of_stock = serializers.BooleanField(required=False)
+    out_of_stock_from = serializers.DateTimeField(required=False, allow_null=True)
+    out_of_stock_until = serializers.DateTimeField(required=False, allow_null=True)
+    price = serializers.DecimalField(max_digits=8, decimal_places=2, required=False, allow_null=True)
+
+    def validate(self, data):
+        start, end = data.get('out_of_stock_from'), data.get('out_of_stock_until')
+        if start and end and start > end:
+            raise serializers.ValidationError('out_of_stock_from must be before out_of_stock_until')
+        return data
+
+
+class ProductStockChangeSerializer(StockChangeSerializer):
+    product_id = serializers.IntegerField()
+
+
+class DealStockChangeSerializer(StockChangeSerializer):
+    deal_id = serializers.IntegerField()
+
+
+class BranchStockBulkSerializer(serializers.Serializer):
+    products = ProductStockChangeSerializer(many=True, required=False, default=list)
+    deals = DealStockChangeSerializer(many=True, required=False, default=list)
+
+    def validate(self, data):
+        # Unknown ids would only surface as an IntegrityError halfway through the upsert
+        for key, model in (('products', Product), ('deals', Deal)):
+            ids = {change[f'{model._meta.model_name}_id'] for change in data[key]}
+            missing = ids - set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+            if missing:
+                raise serializers.ValidationError({key: f'Unknown ids: {sorted(missing)}'})
+        if not data['products'] and not data['deals']:
+            raise serializers.ValidationError('No stock changes given')
+        return data
+
+
 class OfferSerializer(serializers.ModelSerializer):
     free_products = ProductDetailSerializer(many=True, read_only=True)
     free_deals = DealSerializer(many=True, read_only=True)
@@ -1004,6 +1012,66 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'address', 'offers','scheduled_at', 'status', 'subtotal', 'discount_amount', 'delivery_fee', 'tax_amount', 'total_amount', 'payment_status', 'created_at', 'updated_at', 'items']
 
 
+class KitchenOrderItemSerializer(serializers.ModelSerializer):
+    title = serializers.SerializerMethodField()
+    customizations = serializers.SerializerMethodField()
+    expandable_choices = serializers.SerializerMethodField()
+
+    class Meta:
+        model = OrderItem
+        fields = ['id', 'title', 'quantity', 'customizations', 'expandable_choices', 'is_free']
+
+    def get_title(self, obj):
+        return obj.product.title if obj.product else obj.deal.title if obj.deal else None
+
+    def get_customizations(self, obj):
+        return [c.customization_choice.title for c in obj.orderitemcustomization_set.all()]
+
+    def get_expandable_choices(self, obj):
+        return [e.expandable_choice.title for e in obj.orderitemexpandablechoice_set.all()]
+
+
+class KitchenOrderSerializer(serializers.ModelSerializer):
+    """What a kitchen tablet needs per order, no pricing."""
+    items = KitchenOrderItemSerializer(source='orderitem_set', many=True, read_only=True)
+
+    class Meta:
+        model = Order
+        fields = ['id', 'status', 'scheduled_at', 'created_at', 'updated_at', 'change_seq', 'items']
+
+
+#? Kitchen moves only go forward. Cancelling isn't one of them: it goes through cancel_order_or_booking,
+#? which records the Cancellation and refund.
+class KitchenTransitionSerializer(serializers.Serializer):
+    # target status -> statuses an order may be in to move there
+    TRANSITIONS = {
+        'CONFIRMED': ('PENDING',),
+        'PREPARING': ('PENDING', 'CONFIRMED'),
+        'DISPATCHED': ('CONFIRMED', 'PREPARING'),
+        'DELIVERED': ('DISPATCHED',),
+    }
+
+    order_ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=500)
+    status = serializers.ChoiceField(choices=tuple(TRANSITIONS))
+
+    def validate(self, data):
+        """Locks the branch's matching orders; any order that can't make the move rejects the whole request."""
+        target, allowed = data['status'], self.TRANSITIONS[data['status']]
+        orders = dict(
+            Order.objects.select_for_update()
+            .filter(branch_id=self.context['branch_id'], id__in=data['order_ids'])
+            .values_list('id', 'status')
+        )
+        illegal = [
+            f"Order {order_id} can't move from {current} to {target}"
+            for order_id, current in sorted(orders.items()) if current != target and current not in allowed
+        ]
+        if illegal:
+            raise serializers.ValidationError({'order_ids': illegal})
+        data['matched_ids'] = list(orders)
+        return data
+
+
 class InvoiceSerializer(serializers.ModelSerializer):
     order = OrderSerializer(read_only=True)
     cancellation = serializers.SerializerMethodField()
@@ -1012,13 +1080,30 @@ class InvoiceSerializer(serializers.ModelSerializer):
         fields = ['id', 'order', 'booking', 'invoice_number', 'total_amount', 'status', 'issued_at', 'paid_at','cancellation']
     
     def get_cancellation(self, obj):
+        # order__cancellation is select_related by get_invoices, no query per invoice
         if obj.order:
-            cancellation = Cancellation.objects.filter(order=obj.order).first()
-            if cancellation:
-                return CancellationSerializer(cancellation).data
+            try:
+                return CancellationSerializer(obj.order.cancellation).data
+            except Cancellation.DoesNotExist:
+                return None
         return None
 
 
+#? ?summary=1 on the invoice list: flat fields only, no nested order/items
+class InvoiceSummarySerializer(serializers.ModelSerializer):
+    order_status = serializers.CharField(source='order.status', read_only=True, default=None)
+    is_cancelled = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Invoice
+        fields = ['id', 'order_id', 'booking_id', 'invoice_number', 'total_amount', 'status', 'issued_at', 'paid_at', 'order_status', 'is_cancelled']
+
+    def get_is_cancelled(self, obj):
+        if obj.order:
+            return hasattr(obj.order, 'cancellation')
+        return bool(obj.booking and obj.booking.status == 'CANCELLED')
+
+
 class OrderCreateSerializer(serializers.ModelSerializer):
     cart_id = serializers.IntegerField(write_only=True)
     address_id = serializers.IntegerField(write_only=True)
@@ -1056,8 +1141,9 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         tax_amount = cart.tax_amount
         print(f'cart_subtotal:{subtotal}')
         # Create the order
+        # Scheduled orders wait as PENDING until run_order_releaser hands them to the kitchen
         order = Order.objects.create(
-            status='CONFIRMED',
+            status='PENDING' if scheduled_at and scheduled_at > timezone.now() else 'CONFIRMED',
             user=user,
             address=address,
             subtotal=subtotal,
@@ -1066,6 +1152,7 @@ class OrderCreateSerializer(serializers.ModelSerializer):
             tax_amount=tax_amount,
             total_amount=subtotal - total_discount_not_flash  + delivery_fee + tax_amount,
             scheduled_at=scheduled_at,  # Set the scheduled time
+            branch=cart.branch,
         )
 
         # Transfer offers and update usage
@@ -1123,6 +1210,9 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         cart.cartoffer_set.all().delete()
         cart.delete()
 
+        # Items exist now, add the order to the daily sales rollups
+        Order.sync_sales([order.id])
+
         return order
 
 class CarouselScheduleSerializer(serializers.ModelSerializer):
@@ -0,0 +1,72 @@
+from django.db import connection, transaction
+
+from .caching import invalidate_stock_caches
+from .models import DealBranchStock, ProductBranchStock
+
+#? Fields a bulk change may touch; anything left out of a change keeps its current value
+STOCK_CHANGE_FIELDS = ('is_available', 'is_out_of_stock', 'out_of_stock_from', 'out_of_stock_until', 'price')
+
+
+class InvalidStockChange(ValueError):
+    """A change would leave a row's out-of-stock window ending before it starts."""
+
+
+def _upsert_branch_stock(model, kind, branch_id, changes):
+    """
+    Merge `changes` (dicts keyed by model.STOCK_ITEM_FIELD) onto the existing rows of one branch
+    and write them back with a single INSERT ... ON DUPLICATE KEY UPDATE.
+    Returns the written rows as (branch_id, kind, item_id, status) changes.
+    """
+    item_field = model.STOCK_ITEM_FIELD
+    item_ids = [change[item_field] for change in changes]
+    existing = {
+        getattr(row, item_field): row
+        for row in model.objects.filter(branch_id=branch_id, **{f'{item_field}__in': item_ids})
+    }
+
+    rows = {}
+    for change in changes:
+        item_id = change[item_field]
+        # Later changes for the same item win, like successive admin saves would
+        row = rows.get(item_id) or existing.get(item_id) or model(branch_id=branch_id, **{item_field: item_id})
+        for field in STOCK_CHANGE_FIELDS:
+            if field in change:
+                setattr(row, field, change[field])
+        row.effective_status = row.compute_effective_status()
+        rows[item_id] = row
+
+    # Checked on the merged rows: a change may send only one end of the window
+    invalid = sorted(
+        item_id for item_id, row in rows.items()
+        if row.out_of_stock_from and row.out_of_stock_until and row.out_of_stock_from > row.out_of_stock_until
+    )
+    if invalid:
+        raise InvalidStockChange(f"out_of_stock_from must be before out_of_stock_until ({kind} {', '.join(map(str, invalid))})")
+
+    # MySQL's ON DUPLICATE KEY UPDATE always targets the unique keys, only pass them where the backend wants them
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ['branch', item_field.removesuffix('_id')]
+    model.objects.bulk_create(
+        list(rows.values()),
+        update_conflicts=True,
+        unique_fields=unique_fields,
+        update_fields=[*STOCK_CHANGE_FIELDS, 'effective_status'],
+    )
+    return [(branch_id, kind, item_id, row.effective_status) for item_id, row in rows.items()]
+
+
+def apply_branch_stock_changes(branch_id, products=(), deals=()):
+    """
+    Apply many product/deal availability changes for one branch in one transaction.
+    Caches are invalidated once after commit instead of once per row. Raises InvalidStockChange
+    (nothing written) when a merged row's out-of-stock window would end before it starts.
+    Returns {'products': n, 'deals': n} with the number of rows written.
+    """
+    with transaction.atomic():
+        product_changes = _upsert_branch_stock(ProductBranchStock, 'product', branch_id, products) if products else []
+        deal_changes = _upsert_branch_stock(DealBranchStock, 'deal', branch_id, deals) if deals else []
+        changes = product_changes + deal_changes
+        if changes:
+            transaction.on_commit(lambda: invalidate_stock_caches([branch_id], changes))
+    return {'products': len(product_changes), 'deals': len(deal_changes)}
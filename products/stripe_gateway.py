@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+#? Errors that say "Stripe (or the network to it) is unhealthy" and count towards opening the breaker.
+#? Card declines and bad requests are the caller's problem and never trip it.
+TRANSIENT_ERRORS = (stripe.APIConnectionError, stripe.APIError, stripe.RateLimitError)
+
+
+class PaymentGatewayUnavailable(Exception):
+    """Raised without calling Stripe while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. After `failure_threshold` consecutive transient failures it opens and
+    rejects calls for `reset_timeout` seconds, then lets a single trial call through (half-open);
+    success closes it again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                raise PaymentGatewayUnavailable('Payment provider is temporarily unavailable')
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None:
+                # The half-open trial failed, wait another reset_timeout
+                self._opened_at = time.monotonic()
+            elif self._failures >= self.failure_threshold:
+                logger.warning('stripe circuit breaker opened after %s failures', self._failures)
+                self._opened_at = time.monotonic()
+
+
+class StripeGateway:
+    """
+    The only place that talks to Stripe's API. One pooled keep-alive session per process, bounded
+    (connect, read) timeouts, the SDK's own retries (capped, with idempotency keys on POSTs) and a
+    circuit breaker so a Stripe outage fails fast instead of pinning every worker thread.
+    The a* methods are the async variants for async views on the ASGI workers.
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(
+            failure_threshold=settings.STRIPE_BREAKER_THRESHOLD,
+            reset_timeout=settings.STRIPE_BREAKER_RESET,
+        )
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _build_client(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.STRIPE_POOL_SIZE)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        http_client = stripe.RequestsClient(
+            timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+            session=session,
+        )
+        base_addresses = {'api': settings.STRIPE_API_BASE} if settings.STRIPE_API_BASE else {}
+        return stripe.StripeClient(
+            os.environ.get('STRIPE_API_KEY'),
+            http_client=http_client,
+            max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+            base_addresses=base_addresses,
+        )
+
+    @property
+    def client(self):
+        # Sockets must not be shared with a forked parent, build one client per process
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = self._build_client()
+                self._pid = os.getpid()
+            return self._client
+
+    def _call(self, operation):
+        self.breaker.before_call()
+        try:
+            result = operation(self.client)
+        except TRANSIENT_ERRORS:
+            self.breaker.record_failure()
+            raise
+        except stripe.StripeError:
+            # Stripe answered, it is healthy even if the request was rejected
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def create_payment_intent(self, **params):
+        return self._call(lambda client: client.payment_intents.create(params=params))
+
+    def retrieve_payment_intent(self, payment_intent_id):
+        return self._call(lambda client: client.payment_intents.retrieve(payment_intent_id))
+
+    def retrieve_charge(self, charge_id):
+        return self._call(lambda client: client.charges.retrieve(charge_id))
+
+    # The SDK's native async transports need httpx/aiohttp, which aren't deployed; the pooled sync
+    # client runs on a worker thread instead so the event loop never blocks on Stripe
+    async def acreate_payment_intent(self, **params):
+        return await sync_to_async(self.create_payment_intent, thread_sensitive=False)(**params)
+
+    async def aretrieve_payment_intent(self, payment_intent_id):
+        return await sync_to_async(self.retrieve_payment_intent, thread_sensitive=False)(payment_intent_id)
+
+    async def aretrieve_charge(self, charge_id):
+        return await sync_to_async(self.retrieve_charge, thread_sensitive=False)(charge_id)
+
+
+stripe_gateway = StripeGateway()
@@ -0,0 +1,63 @@
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from . import availability
+from .caching import catalog_cache_key
+from .models import DealProduct, SpecialSuggestionsBranchWise
+
+#? Which special suggestions a set of branches shows only changes with stock or the catalog (both bump
+#? the catalog version), so the visible suggestion ids are worked out once per sorted branch set and
+#? version. Serializing stays per request, cards carry the user's favorites.
+SUGGESTIONS_TIMEOUT = 10 * 60
+HIDING_STATUSES = ('unavailable',)  # Out of stock items stay listed, their cards say so
+
+
+def hidden_deal_ids(deal_ids, branch_ids, blocked_products):
+    """
+    Deals that can't be offered at any of branch_ids: the deal itself is unavailable at every branch,
+    or every one of its products is (in blocked_products). Components are fetched for all deals at once.
+    """
+    blocked_deals = availability.unavailable_everywhere_set('deal', branch_ids, HIDING_STATUSES)
+    components = defaultdict(set)
+    for deal_id, product_id in DealProduct.objects.filter(deal_id__in=deal_ids).values_list('deal_id', 'product_id'):
+        components[deal_id].add(product_id)
+    return {
+        deal_id for deal_id in deal_ids
+        if deal_id in blocked_deals or (components[deal_id] and components[deal_id] <= blocked_products)
+    }
+
+
+def build_visible_suggestion_ids(branch_ids):
+    """Ids of the suggestions to show, one per product/deal, skipping items hidden at every branch."""
+    suggestions = list(
+        SpecialSuggestionsBranchWise.objects.filter(branch_id__in=branch_ids).order_by('id').values_list('id', 'product_id', 'deal_id')
+    )
+    blocked_products = availability.unavailable_everywhere_set('product', branch_ids, HIDING_STATUSES)
+    hidden_deals = hidden_deal_ids({deal_id for _, _, deal_id in suggestions if deal_id}, branch_ids, blocked_products)
+
+    visible, seen_products, seen_deals = [], set(), set()
+    for suggestion_id, product_id, deal_id in suggestions:
+        if product_id:
+            if product_id in seen_products or product_id in blocked_products:
+                continue
+            seen_products.add(product_id)
+        elif deal_id:
+            if deal_id in seen_deals or deal_id in hidden_deals:
+                continue
+            seen_deals.add(deal_id)
+        else:
+            continue
+        visible.append(suggestion_id)
+    return visible
+
+
+def visible_suggestion_ids(branch_ids):
+    """build_visible_suggestion_ids(), cached per sorted branch set and catalog version."""
+    branch_ids = sorted({int(branch_id) for branch_id in branch_ids})
+    key = catalog_cache_key('suggestions', *branch_ids)
+    ids = cache.get(key)
+    if ids is None:
+        ids = build_visible_suggestion_ids(branch_ids)
+        cache.set(key, ids, timeout=SUGGESTIONS_TIMEOUT)
+    return ids
@@ -1,3 +1,1320 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import stripe
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.models import User
+
+from . import availability, events, exports, ids, receipts, sales, webhooks
+from .bookings import BookingUnavailable, reserve_booking
+from .exports import export_queryset
+from .management.commands.fake_stripe_events import fake_payment_event, sign_payload
+from .models import (
+    Booking, BookingSlot, Branch, Cart, CartItem, CartItemExpandableChoice, Category, CustomizationChoice,
+    CustomizationHeader, CustomizationPriceRule, DailyDealSales, DailyProductSales, Deal, DealBranchStock,
+    DealProduct, ExpandableChoices, ExpandableHeader, Favorite, Invoice, Offer, Order, OrderItem, Product,
+    ProductBranchStock, ProductChoicesUnavailablility, ProductCustomizationHeader, ProductTags, Review,
+    SpecialSuggestionsBranchWise, StripeEvent, Tags, Transaction,
+)
+from .pricing import InvalidSelection, expandable_choice_prices, price_deal_selection, price_selection
+from .serializers import CustomizationSerializer
+from .stripe_gateway import CircuitBreaker, PaymentGatewayUnavailable, StripeGateway, stripe_gateway
+
+
+class ProductListQueryCountTests(TestCase):
+    """ProductDetailSerializer's prefetch graph keeps product listings at a fixed number of queries."""
+
+    def setUp(self):
+        self.category = Category.objects.create(title='Pizza')
+        self.branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+        )
+        self.tag = Tags.objects.create(title='Popular')
+        self.header = CustomizationHeader.objects.create(title='Size')
+        self.choices = [
+            CustomizationChoice.objects.create(customization_header=self.header, title=title, price=Decimal('0.00'))
+            for title in ('Personal', 'Medium', 'Large')
+        ]
+        self.expandable_header = ExpandableHeader.objects.create(title='Make it a meal')
+        ExpandableChoices.objects.create(category=self.category, expandable_header=self.expandable_header, title='Fries', price=Decimal('2.00'))
+
+    def add_products(self, count):
+        for _ in range(count):
+            product = Product.objects.create(
+                title='Margherita', category=self.category, description='Cheese', price=Decimal('9.00'), is_customizable=True,
+            )
+            ProductCustomizationHeader.objects.create(product=product, customization_header=self.header, sort_order=1)
+            CustomizationPriceRule.objects.create(product=product, customization_choice=self.choices[0], price=Decimal('9.00'), is_base=True)
+            CustomizationPriceRule.objects.create(product=product, customization_choice=self.choices[1], price=Decimal('12.00'))
+            ProductChoicesUnavailablility.objects.create(product=product, customization_choice=self.choices[2])
+            ProductTags.objects.create(product=product, tag=self.tag)
+            ProductBranchStock.objects.create(product=product, branch=self.branch, is_available=True)
+            ExpandableChoices.objects.create(base_product=product, expandable_header=self.expandable_header, title='Coke', price=Decimal('1.50'))
+
+    def count_queries(self, path):
+        cache.clear()  # Compare cold requests, cached lookups would hide per product queries
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_product_list_queries_do_not_grow_with_catalog(self):
+        self.add_products(2)
+        small_count, small_data = self.count_queries('/products/')
+        self.add_products(8)
+        large_count, large_data = self.count_queries('/products/')
+
+        self.assertEqual((len(small_data), len(large_data)), (2, 10))
+        self.assertEqual(large_count, small_count)
+
+    def test_product_list_with_branches_queries_do_not_grow_with_catalog(self):
+        path = f'/products/?branch_id={self.branch.id}'
+        self.add_products(2)
+        small_count, _ = self.count_queries(path)
+        self.add_products(8)
+        large_count, data = self.count_queries(path)
+
+        self.assertEqual(large_count, small_count)
+        product = data[0]
+        self.assertTrue(product['is_popular'])
+        self.assertEqual(product['branch_availability']['status'], 'available')
+        self.assertEqual(
+            [(choice['customization_choice']['title'], choice['price']) for choice in product['customizations'][0]['choices']],
+            [('Personal', 9.0), ('Medium', 12.0)],
+        )
+        self.assertEqual(
+            [[choice['title'] for choice in header['choices']] for header in product['expandable_customizations']],
+            [['Fries', 'Coke']],
+        )
+
+
+class AvailabilityIndexTests(TestCase):
+    """The memory-mapped availability index answers the same as the stock tables' unavailable_everywhere."""
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings_override = override_settings(AVAILABILITY_INDEX_PATH=os.path.join(self.directory.name, 'availability.idx'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        category = Category.objects.create(title='Pizza')
+        self.branches = [
+            Branch.objects.create(name=name, address='1 Main St', city='City', state='State', postal_code='00000', country='Country')
+            for name in ('Downtown', 'Uptown', 'Harbor')
+        ]
+        self.products = [
+            Product.objects.create(title=f'Pizza {number}', category=category, description='Cheese', price=Decimal('9.00'))
+            for number in range(12)
+        ]
+        self.deals = [Deal.objects.create(title=f'Deal {number}', description='Combo', price=Decimal('15.00')) for number in range(3)]
+        rows = [
+            (0, 0, False, False), (0, 1, False, False), (0, 2, False, False),  # Unavailable everywhere
+            (1, 0, True, True), (1, 1, False, False), (1, 2, True, True),  # Out of stock or unavailable
+            (2, 0, False, False), (2, 1, False, False),  # Nothing at the third branch counts as available
+            (9, 0, True, True), (9, 1, True, True), (9, 2, True, False),
+        ]
+        now = timezone.now()
+        for product, branch, is_available, is_out_of_stock in rows:
+            ProductBranchStock.objects.create(
+                product=self.products[product], branch=self.branches[branch], is_available=is_available, is_out_of_stock=is_out_of_stock,
+                out_of_stock_from=now - timedelta(hours=1), out_of_stock_until=now + timedelta(hours=1),
+            )
+        for branch in self.branches:
+            DealBranchStock.objects.create(deal=self.deals[1], branch=branch, is_available=False)
+
+    def assert_matches_database(self):
+        branch_ids = [branch.id for branch in self.branches]
+        selections = [branch_ids[:1], branch_ids[:2], branch_ids, [branch_ids[2], branch_ids[0]], [branch_ids[0], 0]]
+        for kind, stock_model in (('product', ProductBranchStock), ('deal', DealBranchStock)):
+            for statuses in (('unavailable',), ('unavailable', 'out_of_stock')):
+                for selection in selections:
+                    expected = set(stock_model.unavailable_everywhere(selection, statuses).values_list(stock_model.STOCK_ITEM_FIELD, flat=True))
+                    self.assertEqual(availability.unavailable_everywhere_set(kind, selection, statuses), expected)
+
+    def test_index_matches_database(self):
+        version = availability.build_index()
+        index = availability.get_index()
+        self.assertIsNotNone(index)
+        self.assertEqual(index.version, version)
+        self.assert_matches_database()
+        self.assertEqual(
+            availability.unavailable_everywhere_set('product', [self.branches[0].id]),
+            {self.products[number].id for number in (0, 1, 2, 9)},
+        )
+
+    def test_stale_index_falls_back_to_database(self):
+        availability.build_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductBranchStock.objects.filter(product=self.products[0], branch=self.branches[2]).get().delete()
+        self.assertIsNone(availability.get_index())
+        self.assert_matches_database()
+        self.assertNotIn(self.products[0].id, availability.unavailable_everywhere_set('product', [branch.id for branch in self.branches]))
+
+
+class SpecialSuggestionsTests(TestCase):
+    """Suggested deals are hidden by their own stock or when none of their products is offered."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(title='Pizza')
+        self.branches = [
+            Branch.objects.create(name=name, address='1 Main St', city='City', state='State', postal_code='00000', country='Country')
+            for name in ('Downtown', 'Uptown')
+        ]
+        self.products = [
+            Product.objects.create(
+                title=f'Pizza {number}', category=category, description='Cheese', price=Decimal('9.00'), image='images/products/pizza.png',
+            )
+            for number in range(3)
+        ]
+        self.deals = [Deal.objects.create(title=f'Deal {number}', description='Combo', price=Decimal('15.00')) for number in range(4)]
+        components = {0: [0, 1], 1: [0], 2: [1, 2], 3: [2]}
+        for deal, products in components.items():
+            for product in products:
+                DealProduct.objects.create(deal=self.deals[deal], product=self.products[product])
+        for branch in self.branches:
+            ProductBranchStock.objects.create(product=self.products[2], branch=branch, is_available=False)  # Kills deal 3
+            DealBranchStock.objects.create(deal=self.deals[1], branch=branch, is_available=False)
+        DealBranchStock.objects.create(deal=self.deals[0], branch=self.branches[0], is_available=False)  # Still offered at Uptown
+        for branch in self.branches:
+            for deal in self.deals:
+                SpecialSuggestionsBranchWise.objects.create(branch=branch, deal=deal)
+            for product in self.products:
+                SpecialSuggestionsBranchWise.objects.create(branch=branch, product=product)
+        self.path = f'/special-suggestions/?branch_id={self.branches[1].id}&branch_id={self.branches[0].id}'
+
+    def suggested(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return [
+            ('deal', item['deal']['id']) if item['deal'] else ('product', item['product']['id'])
+            for item in response.json()
+        ]
+
+    def test_hidden_deals_and_products_are_left_out_once_per_item(self):
+        self.assertEqual(self.suggested(self.path), [
+            ('deal', self.deals[0].id), ('deal', self.deals[2].id),
+            ('product', self.products[0].id), ('product', self.products[1].id),
+        ])
+
+    def test_visible_suggestions_are_cached_until_the_catalog_changes(self):
+        self.suggested(self.path)
+        with CaptureQueriesContext(connection) as queries:
+            self.suggested(f'/special-suggestions/?branch_id={self.branches[0].id}&branch_id={self.branches[1].id}')
+        self.assertFalse(any('GROUP BY' in query['sql'] for query in queries.captured_queries))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            DealBranchStock.objects.get(deal=self.deals[1], branch=self.branches[1]).delete()
+        self.assertIn(('deal', self.deals[1].id), self.suggested(self.path))
+
+
+class CatalogTokenTests(TestCase):
+    """Public catalog endpoints serve everyone; a bad token only means no favorites."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+        self.user = User.objects.create(email='diner@example.com')
+        Favorite.objects.create(user=self.user, product=self.product)
+
+    def token(self, expires_in):
+        payload = {'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + expires_in}
+        return jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+
+    def test_expired_token_still_gets_the_catalog(self):
+        for header in (f'Bearer {self.token(timedelta(hours=-1))}', 'Bearer not-a-token'):
+            response = self.client.get('/products/', HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([(item['id'], item['is_favorite']) for item in response.json()], [(self.product.id, False)])
+
+    def test_expired_token_still_gets_branch_listings(self):
+        branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+        )
+        header = f'Bearer {self.token(timedelta(hours=-1))}'
+        for path in (f'/branch-products/{branch.id}', f'/branch-deals/{branch.id}', '/menu/', '/deal/'):
+            self.assertEqual(self.client.get(path, HTTP_AUTHORIZATION=header).status_code, 200, path)
+
+    def test_valid_token_flags_favorites(self):
+        response = self.client.get('/products/', HTTP_AUTHORIZATION=f'Bearer {self.token(timedelta(hours=1))}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()[0]['is_favorite'])
+
+
+@override_settings(EVENTS_BACKEND='memory')
+class BranchEventStreamTests(TestCase):
+    """SSE clients get the events of the branches they follow, and a refresh when they fall behind."""
+
+    async def test_stream_delivers_only_its_branches_events(self):
+        response = await self.async_client.get('/branch-events/?branch_ids=1,2')
+        self.assertEqual((response.status_code, response['Content-Type']), (200, 'text/event-stream'))
+        frames = response.streaming_content
+        self.assertEqual(await anext(frames), b'retry: 5000\n\n')
+
+        events.publish_stock_changes(changes=[(3, 'product', 7, 'unavailable'), (2, 'product', 5, 'out_of_stock')])
+        frame = (await asyncio.wait_for(anext(frames), timeout=1)).decode()
+        self.assertTrue(frame.startswith('event: stock\n'))
+        self.assertEqual(json.loads(frame.split('data: ')[1]), {'type': 'stock', 'branch_id': 2, 'products': {'5': 'out_of_stock'}, 'deals': {}})
+        await frames.aclose()
+
+    async def test_branch_ids_are_required(self):
+        for query in ('', '?branch_ids=1,x'):
+            self.assertEqual((await self.async_client.get(f'/branch-events/{query}')).status_code, 400)
+
+    async def test_slow_subscriber_is_told_to_refresh(self):
+        async with events.broker.subscribe([events.branch_channel(1)]) as subscription:
+            for number in range(events.SUBSCRIBER_QUEUE_SIZE + 5):
+                events.broker.dispatch(events.branch_channel(1), {'type': 'stock', 'number': number})
+            received = [await subscription.get() for _ in range(events.SUBSCRIBER_QUEUE_SIZE + 1)]
+        self.assertEqual([event.get('number') for event in received[:3]], [0, 1, 2])
+        self.assertEqual(received[-1], {'type': 'refresh'})  # The dropped events are replaced by one refetch
+
+
+@override_settings(EVENTS_BACKEND='memory')
+class OrderEventStreamTests(TestCase):
+    """Customers get a live event for each status change of their own orders, nobody else's."""
+
+    async def test_stream_follows_the_owners_orders(self):
+        owner, other = [await User.objects.acreate(email=f'{name}@example.com') for name in ('owner', 'other')]
+        token = jwt.encode({'user_id': owner.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        response = await self.async_client.get(f'/orders/events/?token={token}')
+        self.assertEqual(response.status_code, 200)
+        frames = response.streaming_content
+        await anext(frames)  # retry: hint
+
+        def place_and_confirm():
+            with self.captureOnCommitCallbacks(execute=True):
+                Order.objects.create(user=other, subtotal=Decimal('9.00'), total_amount=Decimal('9.00'))
+                order = Order.objects.create(user=owner, subtotal=Decimal('9.00'), total_amount=Decimal('9.00'))
+            with self.captureOnCommitCallbacks(execute=True):
+                order.payment_status = 'PAID'
+                order.save()  # Not a status change, no event
+            with self.captureOnCommitCallbacks(execute=True):
+                order.status = 'CONFIRMED'
+                order.save()
+            return order
+
+        order = await sync_to_async(place_and_confirm)()
+        received = []
+        for _ in range(2):
+            frame = (await asyncio.wait_for(anext(frames), timeout=1)).decode()
+            received.append(json.loads(frame.split('data: ')[1]))
+        self.assertEqual([(event['order_id'], event['status']) for event in received], [(order.id, 'PENDING'), (order.id, 'CONFIRMED')])
+        self.assertEqual(received[1]['payment_status'], 'PAID')
+        await frames.aclose()
+
+    async def test_token_is_required(self):
+        self.assertEqual((await self.async_client.get('/orders/events/')).status_code, 401)
+        self.assertEqual((await self.async_client.get('/orders/events/?token=forged')).status_code, 401)
+
+
+class FavoriteMergeTests(TestCase):
+    """Merging local favorites adds the missing ones in one insert and drops unknown ids and duplicates."""
+
+    def setUp(self):
+        category = Category.objects.create(title='Pizza')
+        self.products = [
+            Product.objects.create(title=f'Pizza {number}', category=category, description='Cheese', price=Decimal('9.00'))
+            for number in range(3)
+        ]
+        self.deal = Deal.objects.create(title='Pizza for two', description='Two pizzas', price=Decimal('15.00'))
+        self.user = User.objects.create(email='diner@example.com')
+        Favorite.objects.create(user=self.user, product=self.products[0])
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        self.header = f'Bearer {token}'
+
+    def merge(self, **ids):
+        return self.client.post('/favorites/merge/', ids, content_type='application/json', HTTP_AUTHORIZATION=self.header)
+
+    def test_merge_adds_missing_favorites_in_one_insert(self):
+        Favorite.objects.create(product=self.products[1])  # Left behind by an anonymous session
+        with CaptureQueriesContext(connection) as queries:
+            response = self.merge(product_ids=[product.id for product in self.products] + [0, 9999], deal_ids=[self.deal.id, 9999])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(query['sql'].startswith('INSERT') for query in queries), 1)
+
+        self.assertEqual(Favorite.ids_for_user(self.user.id), ({product.id for product in self.products}, {self.deal.id}))
+        self.assertFalse(Favorite.objects.filter(user__isnull=True).exists())
+        self.assertEqual(len(response.json()), 4)
+
+    def test_merging_again_changes_nothing(self):
+        self.merge(product_ids=[self.products[1].id], deal_ids=[self.deal.id])
+        response = self.merge(product_ids=[self.products[1].id], deal_ids=[self.deal.id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Favorite.objects.filter(user=self.user).count(), 3)
+
+    def test_anonymous_merge_is_rejected(self):
+        response = self.client.post('/favorites/merge/', {'product_ids': [self.products[1].id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(Favorite.objects.count(), 1)
+
+
+class StripeWebhookTests(TestCase):
+    """Only events signed with the configured webhook secret are queued, and the worker applies each payment once."""
+
+    def setUp(self):
+        self.order = Order.objects.create(subtotal=Decimal('20.00'), total_amount=Decimal('20.00'))
+        self.payload = json.dumps(fake_payment_event(self.order, 'payment_intent.succeeded'))
+
+    def post(self, signature):
+        return self.client.post('/webhook/', self.payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=signature)
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_signed_event_is_queued_once(self):
+        for _ in range(2):
+            self.assertEqual(self.post(sign_payload(self.payload, 'whsec_test')).status_code, 200)
+        self.assertEqual(StripeEvent.objects.get().event_type, 'payment_intent.succeeded')
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_wrong_signature_is_rejected(self):
+        self.assertEqual(self.post(sign_payload(self.payload, 'whsec_other')).status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='')
+    def test_empty_key_forgery_is_rejected_while_the_secret_is_unset(self):
+        self.assertEqual(self.post(sign_payload(self.payload, '')).status_code, 503)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_delivered_payment_marks_the_order_paid_once(self):
+        invoice = Invoice.objects.create(order=self.order, invoice_number='INV-1', total_amount=Decimal('20.00'))
+        resent = json.dumps(fake_payment_event(self.order, 'payment_intent.succeeded'))  # Same intent, new event id
+        late_failure = json.dumps(fake_payment_event(self.order, 'payment_intent.payment_failed'))
+        for payload in (self.payload, self.payload, resent, late_failure):
+            response = self.client.post('/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=sign_payload(payload, 'whsec_test'))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeEvent.objects.count(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(webhooks.process_stripe_events(), 3)
+
+        self.order.refresh_from_db()
+        invoice.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'PAID')
+        self.assertEqual(invoice.status, 'PAID')
+        self.assertIsNotNone(invoice.paid_at)
+        payment = Transaction.objects.get()
+        self.assertEqual(
+            (payment.transaction_id, payment.amount, payment.status, payment.invoice_id),
+            (f'pi_fake_{self.order.id}', Decimal('20.00'), 'SUCCESS', invoice.id),
+        )
+        self.assertEqual(set(StripeEvent.objects.values_list('status', flat=True)), {'PROCESSED'})
+
+    @override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+    def test_events_without_an_order_are_ignored(self):
+        event = fake_payment_event(self.order, 'payment_intent.succeeded')
+        event['data']['object']['metadata'] = {}
+        payload = json.dumps(event)
+        self.client.post('/webhook/', payload, content_type='application/json', HTTP_STRIPE_SIGNATURE=sign_payload(payload, 'whsec_test'))
+        webhooks.process_stripe_events()
+
+        self.assertEqual(StripeEvent.objects.get().status, 'IGNORED')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'PENDING')
+        self.assertFalse(Transaction.objects.exists())
+
+
+class StripeEventQueueTests(TestCase):
+    """A failing event only counts against itself, the rest of its batch is still applied."""
+
+    def setUp(self):
+        self.orders = [
+            Order.objects.create(subtotal=Decimal('20.00'), total_amount=Decimal('20.00')) for _ in range(3)
+        ]
+
+    def add_event(self, number, order, amount=2000):
+        return StripeEvent.objects.create(
+            event_id=f'evt_{number}', event_type='payment_intent.succeeded',
+            payload={'data': {'object': {
+                'object': 'payment_intent', 'id': f'pi_{number}', 'amount_received': amount, 'metadata': {'order_id': str(order.id)},
+            }}},
+        )
+
+    def test_failing_event_does_not_hold_back_its_batch(self):
+        good = [self.add_event(0, self.orders[0]), self.add_event(2, self.orders[2])]
+        poison = self.add_event(1, self.orders[1], amount='not a number')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(webhooks.process_stripe_events(), 3)
+
+        self.assertEqual({event.status for event in StripeEvent.objects.filter(pk__in=[event.pk for event in good])}, {'PROCESSED'})
+        self.assertEqual(
+            sorted(Order.objects.filter(payment_status='PAID').values_list('id', flat=True)),
+            [self.orders[0].id, self.orders[2].id],
+        )
+        self.assertEqual(Transaction.objects.count(), 2)
+        poison.refresh_from_db()
+        self.assertEqual((poison.status, poison.attempts), ('PENDING', 1))
+        self.assertTrue(poison.last_error)
+
+    def test_failing_event_is_given_up_after_max_attempts(self):
+        good = self.add_event(0, self.orders[0])
+        poison = self.add_event(1, self.orders[1], amount='not a number')
+        for _ in range(webhooks.MAX_ATTEMPTS):
+            webhooks.process_stripe_events()
+
+        poison.refresh_from_db()
+        good.refresh_from_db()
+        self.assertEqual((poison.status, poison.attempts), ('FAILED', webhooks.MAX_ATTEMPTS))
+        self.assertEqual((good.status, good.attempts), ('PROCESSED', 1))
+        self.assertEqual(webhooks.process_stripe_events(), 0)
+
+
+class IdempotencyTests(TestCase):
+    """A retried write with the same Idempotency-Key gets the first response back instead of running twice."""
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(email=f'payer{number}@example.com') for number in range(2)]
+        self.order = Order.objects.create(user=self.users[0], subtotal=Decimal('10.00'), total_amount=Decimal('10.00'))
+
+    def post(self, body, key='retry-1', user=None):
+        user = user or self.users[0]
+        token = jwt.encode({'user_id': user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        return self.client.post(
+            '/create-payment-intent/', json.dumps(body), content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {token}', HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    @mock.patch.object(stripe_gateway, 'create_payment_intent', return_value={'id': 'pi_1', 'client_secret': 'pi_1_secret'})
+    def test_replay_returns_the_first_response_without_calling_stripe_again(self, create_intent):
+        body = {'amount': 1000, 'order_id': self.order.id}
+        first, second = self.post(body), self.post(body)
+
+        create_intent.assert_called_once()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((second.status_code, second.content), (200, first.content))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replayed'))
+
+    @mock.patch.object(stripe_gateway, 'create_payment_intent', return_value={'id': 'pi_1', 'client_secret': 'pi_1_secret'})
+    def test_key_reused_for_a_different_request_is_rejected(self, create_intent):
+        self.post({'amount': 1000})
+        self.assertEqual(self.post({'amount': 5000}).status_code, 422)
+        create_intent.assert_called_once()
+
+    @mock.patch.object(stripe_gateway, 'create_payment_intent', return_value={'id': 'pi_1', 'client_secret': 'pi_1_secret'})
+    def test_keys_are_scoped_per_user(self, create_intent):
+        self.post({'amount': 1000})
+        self.assertFalse(self.post({'amount': 1000}, user=self.users[1]).has_header('Idempotent-Replayed'))
+        self.assertEqual(create_intent.call_count, 2)
+
+    def test_server_errors_are_not_stored(self):
+        with mock.patch.object(stripe_gateway, 'create_payment_intent', side_effect=PaymentGatewayUnavailable('down')):
+            self.assertEqual(self.post({'amount': 1000}).status_code, 503)
+        with mock.patch.object(stripe_gateway, 'create_payment_intent', return_value={'id': 'pi_2', 'client_secret': 'pi_2_secret'}):
+            retry = self.post({'amount': 1000})
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(json.loads(retry.content)['payment_intent_id'], 'pi_2')
+
+    @mock.patch.object(stripe_gateway, 'create_payment_intent', return_value={'id': 'pi_1', 'client_secret': 'pi_1_secret'})
+    def test_requests_without_a_key_always_run(self, create_intent):
+        for _ in range(2):
+            self.post({'amount': 1000}, key='')
+        self.assertEqual(create_intent.call_count, 2)
+
+
+class StripeGatewayBreakerTests(TestCase):
+    """Consecutive transient Stripe failures open the breaker, later calls fail fast until a trial succeeds."""
+
+    def setUp(self):
+        self.gateway = StripeGateway()
+        self.gateway.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30.0)
+        self.stripe_client = mock.Mock()
+        self.gateway._client, self.gateway._pid = self.stripe_client, os.getpid()
+        self.retrieve = self.stripe_client.payment_intents.retrieve
+
+    def fail_twice(self):
+        self.retrieve.side_effect = stripe.APIConnectionError('connection reset')
+        with self.assertLogs('products.stripe_gateway', 'WARNING'):
+            for _ in range(2):
+                with self.assertRaises(stripe.APIConnectionError):
+                    self.gateway.retrieve_payment_intent('pi_1')
+
+    def test_open_breaker_rejects_without_calling_stripe(self):
+        self.fail_twice()
+        with self.assertRaises(PaymentGatewayUnavailable):
+            self.gateway.retrieve_payment_intent('pi_1')
+        self.assertEqual(self.retrieve.call_count, 2)
+
+    def test_trial_call_after_reset_timeout_closes_the_breaker(self):
+        with mock.patch('products.stripe_gateway.time.monotonic', return_value=1000.0):
+            self.fail_twice()
+        self.retrieve.side_effect = None
+        self.retrieve.return_value = {'id': 'pi_1'}
+        with mock.patch('products.stripe_gateway.time.monotonic', return_value=1031.0):
+            self.assertEqual(self.gateway.retrieve_payment_intent('pi_1'), {'id': 'pi_1'})
+            self.assertEqual(self.gateway.retrieve_payment_intent('pi_1'), {'id': 'pi_1'})
+        self.assertEqual(self.retrieve.call_count, 4)
+
+    def test_failed_trial_reopens_the_breaker(self):
+        with mock.patch('products.stripe_gateway.time.monotonic', return_value=1000.0):
+            self.fail_twice()
+        with mock.patch('products.stripe_gateway.time.monotonic', return_value=1031.0):
+            with self.assertRaises(stripe.APIConnectionError):
+                self.gateway.retrieve_payment_intent('pi_1')
+            with self.assertRaises(PaymentGatewayUnavailable):
+                self.gateway.retrieve_payment_intent('pi_1')
+        self.assertEqual(self.retrieve.call_count, 3)
+
+    def test_rejected_requests_do_not_trip_the_breaker(self):
+        self.retrieve.side_effect = stripe.InvalidRequestError('No such payment_intent', param='id')
+        for _ in range(3):
+            with self.assertRaises(stripe.InvalidRequestError):
+                self.gateway.retrieve_payment_intent('pi_missing')
+        self.assertEqual(self.retrieve.call_count, 3)
+
+    def test_view_answers_503_while_the_breaker_is_open(self):
+        with mock.patch.object(stripe_gateway, 'breaker', CircuitBreaker(failure_threshold=1)) as breaker:
+            with self.assertLogs('products.stripe_gateway', 'WARNING'):
+                breaker.record_failure()
+            response = self.client.post('/get-payment-intent/', json.dumps({'payment_intent_id': 'pi_1'}), content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+
+
+class BookingCapacityTests(TestCase):
+    """Bookings hold seats in their slot, cancelling hands them back and rescheduling moves them."""
+
+    def setUp(self):
+        self.branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+            seating_capacity=6,
+        )
+        self.user = User.objects.create(email='diner@example.com')
+        self.evening = timezone.make_aware(datetime.combine(timezone.localdate() + timedelta(days=1), datetime.min.time())) + timedelta(hours=19)
+
+    def seats(self, when):
+        slot = BookingSlot.objects.filter(branch=self.branch, slot_start=when).first()
+        return slot.booked_seats if slot else 0
+
+    def test_full_slot_is_refused(self):
+        reserve_booking(self.user.id, self.branch, self.evening, 4)
+        with self.assertRaises(BookingUnavailable):
+            reserve_booking(self.user.id, self.branch, self.evening + timedelta(minutes=5), 3)
+        self.assertEqual((self.seats(self.evening), Booking.objects.count()), (4, 1))
+
+    def test_cancelling_hands_the_seats_back(self):
+        booking = reserve_booking(self.user.id, self.branch, self.evening, 4)
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        response = self.client.post(
+            '/cancellations/create/', {'booking_id': booking.id, 'reason': 'Plans changed'},
+            content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.seats(self.evening), 0)
+        reserve_booking(self.user.id, self.branch, self.evening, 6)
+        self.assertEqual(self.seats(self.evening), 6)
+
+    def test_booking_endpoint_answers_conflict_when_the_slot_is_full(self):
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+
+        def book(party_size):
+            return self.client.post(
+                '/bookings/create/', {'branch': self.branch.id, 'booking_date': self.evening.isoformat(), 'party_size': party_size},
+                content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}',
+            )
+
+        self.assertEqual(book(4).status_code, 201)
+        self.assertEqual(book(3).status_code, 409)
+        self.assertEqual(book(2).status_code, 201)
+        self.assertEqual((self.seats(self.evening), Booking.objects.count()), (6, 2))
+
+    def test_rescheduling_moves_the_seats(self):
+        later = self.evening + timedelta(hours=1)
+        booking = reserve_booking(self.user.id, self.branch, self.evening, 4)
+        booking = Booking.objects.get(id=booking.id)
+        booking.booking_date, booking.party_size = later, 5
+        booking.save()
+        self.assertEqual((self.seats(self.evening), self.seats(later)), (0, 5))
+        self.assertEqual(Booking.objects.get(id=booking.id).slot.slot_start, later)
+
+    def test_rescheduling_into_a_full_slot_keeps_the_old_one(self):
+        later = self.evening + timedelta(hours=1)
+        reserve_booking(self.user.id, self.branch, later, 4)
+        booking = Booking.objects.get(id=reserve_booking(self.user.id, self.branch, self.evening, 4).id)
+        booking.booking_date = later
+        with self.assertRaises(BookingUnavailable):
+            booking.save()
+        self.assertEqual((self.seats(self.evening), self.seats(later)), (4, 4))
+        self.assertEqual(Booking.objects.get(id=booking.id).booking_date, self.evening)
+
+
+class BranchStockBulkTests(TestCase):
+    """Bulk stock changes are partial: only the keys sent change, validated against the merged row."""
+
+    def setUp(self):
+        self.branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+        )
+        category = Category.objects.create(title='Pizza')
+        self.products = [
+            Product.objects.create(title=f'Pizza {number}', category=category, description='Cheese', price=Decimal('9.00'))
+            for number in range(2)
+        ]
+        self.start = timezone.now() + timedelta(hours=1)
+        self.stock = ProductBranchStock.objects.create(
+            branch=self.branch, product=self.products[0], is_out_of_stock=True,
+            out_of_stock_from=self.start, out_of_stock_until=self.start + timedelta(hours=2),
+        )
+        self.client.force_login(get_user_model().objects.create_user('manager', password='secret', is_staff=True))
+
+    def post(self, products):
+        return self.client.post(f'/branch-stock/{self.branch.id}/bulk/', {'products': products}, content_type='application/json')
+
+    def test_partial_changes_keep_the_other_fields(self):
+        response = self.post([{'product_id': self.products[0].id, 'price': '7.50'}, {'product_id': self.products[1].id, 'is_available': False}])
+        self.assertEqual((response.status_code, response.json()), (200, {'products': 2, 'deals': 0}))
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.price, self.stock.out_of_stock_from, self.stock.is_out_of_stock), (Decimal('7.50'), self.start, True))
+        self.assertEqual(ProductBranchStock.objects.get(product=self.products[1]).effective_status, 'unavailable')
+
+    def test_window_is_checked_against_the_stored_start(self):
+        until = (self.start - timedelta(minutes=30)).isoformat()
+        response = self.post([{'product_id': self.products[1].id, 'price': '5.00'}, {'product_id': self.products[0].id, 'out_of_stock_until': until}])
+        self.assertEqual(response.status_code, 400)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.out_of_stock_until, self.start + timedelta(hours=2))
+        self.assertFalse(ProductBranchStock.objects.filter(product=self.products[1]).exists())
+
+
+class SalesRollupTests(TestCase):
+    """Orders count towards the daily rollups once while in a sales status; branchless ones share a row per (day, item)."""
+
+    def setUp(self):
+        category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+
+    def branchless_order(self, quantity):
+        order = Order.objects.create(status='CONFIRMED', subtotal=Decimal('9.00') * quantity, total_amount=Decimal('9.00') * quantity)
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity, unit_price=Decimal('9.00'), subtotal=Decimal('9.00') * quantity)
+        return order
+
+    def test_duplicate_branchless_rows_are_rejected(self):
+        day = timezone.localdate()
+        DailyProductSales.objects.create(day=day, product=self.product, quantity=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            DailyProductSales.objects.create(day=day, product=self.product, quantity=1)
+
+    def test_losing_the_create_race_adds_to_the_existing_row(self):
+        sales.sync_order_sales([self.branchless_order(1).id])
+        update = QuerySet.update
+        calls = []
+
+        def stale_update(queryset, **kwargs):
+            calls.append(kwargs)
+            # The first lookup runs before the other recorder's row is visible
+            return 0 if len(calls) == 1 else update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', autospec=True, side_effect=stale_update):
+            sales.sync_order_sales([self.branchless_order(2).id])
+        row = DailyProductSales.objects.get()
+        self.assertEqual((row.branch_id, row.quantity, row.revenue), (None, 3, Decimal('27.00')))
+
+    def test_orders_are_counted_once_while_in_a_sales_status(self):
+        branch = Branch.objects.create(name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country')
+        deal = Deal.objects.create(title='Pizza for two', description='Two pizzas', price=Decimal('15.00'))
+        order = Order.objects.create(branch=branch, subtotal=Decimal('33.00'), total_amount=Decimal('33.00'))
+        OrderItem.objects.create(order=order, product=self.product, quantity=2, unit_price=Decimal('9.00'), subtotal=Decimal('18.00'))
+        OrderItem.objects.create(order=order, deal=deal, quantity=1, unit_price=Decimal('15.00'), subtotal=Decimal('15.00'))
+
+        def totals():
+            product_row = DailyProductSales.objects.filter(branch=branch, product=self.product).first()
+            deal_row = DailyDealSales.objects.filter(branch=branch, deal=deal).first()
+            return [(row.quantity, row.revenue) if row else None for row in (product_row, deal_row)]
+
+        def move_to(status):
+            with self.captureOnCommitCallbacks(execute=True):
+                order.status = status
+                order.save()
+
+        self.assertEqual(totals(), [None, None])  # Pending orders are not sales yet
+        move_to('CONFIRMED')
+        self.assertEqual(totals(), [(2, Decimal('18.00')), (1, Decimal('15.00'))])
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.set_status([order.id], 'DELIVERED')
+        self.assertEqual(totals(), [(2, Decimal('18.00')), (1, Decimal('15.00'))])
+        self.assertEqual(sales.window_sales(DailyProductSales, 'product'), {self.product.id: 2})
+
+        order.refresh_from_db()
+        move_to('CANCELLED')
+        self.assertEqual(totals(), [(0, Decimal('0.00')), (0, Decimal('0.00'))])
+        self.assertEqual(sales.window_sales(DailyProductSales, 'product'), {})
+        self.assertEqual(sales.sync_order_sales([order.id]), (0, 0))
+
+
+class OrderExportTests(TestCase):
+    """Finance exports: whole local days on a plain created_at range, one CSV line per order item."""
+
+    def test_range_covers_whole_days_without_casting_created_at(self):
+        day = datetime(2026, 3, 10).date()
+        start = timezone.make_aware(datetime(2026, 3, 10))
+        stamps = [
+            start - timedelta(microseconds=1), start, start + timedelta(days=2) - timedelta(microseconds=1), start + timedelta(days=2),
+        ]
+        orders = []
+        for stamp in stamps:
+            order = Order.objects.create(subtotal=Decimal('9.00'), total_amount=Decimal('9.00'))
+            Order.objects.filter(id=order.id).update(created_at=stamp)
+            orders.append(order)
+        queryset = export_queryset(since=day, until=day + timedelta(days=1))
+        self.assertEqual([order.id for order in queryset], [orders[1].id, orders[2].id])
+        self.assertNotIn('cast_date', str(queryset.query))
+
+    def test_csv_has_one_line_per_item_with_the_order_columns_repeated(self):
+        staff = get_user_model().objects.create_user('finance', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        category = Category.objects.create(title='Pizza')
+        products = [
+            Product.objects.create(title=title, category=category, description='Cheese', price=Decimal('9.00'))
+            for title in ('Margherita', 'Pepperoni')
+        ]
+        order = Order.objects.create(subtotal=Decimal('27.00'), total_amount=Decimal('27.00'))
+        for product, quantity in zip(products, (1, 2)):
+            OrderItem.objects.create(order=order, product=product, quantity=quantity, unit_price=Decimal('9.00'), subtotal=Decimal('9.00') * quantity)
+        Transaction.objects.create(order=order, amount=Decimal('27.00'), status='SUCCESS', transaction_id='pi_1')
+        empty = Order.objects.create(subtotal=Decimal('0.00'), total_amount=Decimal('0.00'))
+        older = Order.objects.create(subtotal=Decimal('9.00'), total_amount=Decimal('9.00'))
+        Order.objects.filter(id=older.id).update(created_at=timezone.now() - timedelta(days=3))  # Outside the range
+
+        today = timezone.localdate().isoformat()
+        response = self.client.get(f'/exports/orders/?type=csv&from={today}&to={today}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(b''.join(response.streaming_content).decode().splitlines()))
+
+        self.assertEqual(
+            [(row['order_id'], row['item_title'], row['quantity'], row['transactions']) for row in rows],
+            [
+                (str(order.id), 'Margherita', '1', 'pi_1:SUCCESS:27.00'),
+                (str(order.id), 'Pepperoni', '2', 'pi_1:SUCCESS:27.00'),
+                (str(empty.id), '', '', ''),
+            ],
+        )
+
+    def test_export_is_staff_only_and_checks_its_parameters(self):
+        self.assertEqual(self.client.get('/exports/orders/?type=csv').status_code, 302)
+        staff = get_user_model().objects.create_user('finance', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/exports/orders/?type=xlsx').status_code, 400)
+        self.assertEqual(self.client.get('/exports/orders/?type=csv&from=10-03-2026').status_code, 400)
+
+
+class OrderExportStreamingTests(TransactionTestCase):
+    """Under ASGI the export goes out while orders are still being read, not after all of them."""
+
+    def test_asgi_export_sends_before_reading_every_order(self):
+        staff = get_user_model().objects.create_user('finance', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        orders = [Order.objects.create(subtotal=Decimal('9.00'), total_amount=Decimal('9.00')) for _ in range(5)]
+        built, built_at_first_body, body = [], [], []
+        order_record = exports.order_record
+
+        def counting_record(order):
+            built.append(order.id)
+            return order_record(order)
+
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            return await asyncio.get_running_loop().create_future()  # Client never disconnects
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                self.assertEqual(message['status'], 200)
+            elif message.get('body'):
+                if not built_at_first_body:
+                    built_at_first_body.append(len(built))
+                body.append(message['body'])
+
+        cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/exports/orders/', 'raw_path': b'/exports/orders/', 'query_string': b'type=ndjson', 'root_path': '',
+            'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        }
+        with mock.patch.object(exports, 'order_record', counting_record), mock.patch.object(exports, 'LINES_PER_SEND', 1):
+            async_to_sync(ASGIHandler())(scope, receive, send)
+
+        self.assertEqual(built_at_first_body, [1])
+        lines = b''.join(body).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [order.id for order in orders])
+
+
+class IdWorkerLeaseTests(TestCase):
+    """Every live id generator holds its own worker id; running out of them fails instead of reusing one."""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        os.environ.pop('ID_WORKER_ID', None)
+        self.addCleanup(patcher.stop)
+
+    def worker_id(self, generator):
+        return (generator.next_id() >> ids.SEQUENCE_BITS) & ids.MAX_WORKER_ID
+
+    def test_live_generators_never_share_a_worker_id(self):
+        first, second = ids.IdGenerator(), ids.IdGenerator()
+        first_worker_id = self.worker_id(first)
+        # 1024 more processes have come and gone, the counter wraps onto the live first generator's id
+        cache.set(ids.WORKER_COUNTER_KEY, first_worker_id + ids.MAX_WORKER_ID)
+        self.assertNotEqual(self.worker_id(second), first_worker_id)
+
+    def test_released_and_lost_leases_are_reclaimed(self):
+        generator = ids.IdGenerator()
+        worker_id = self.worker_id(generator)
+        cache.set(ids.WORKER_LEASE_KEY.format(worker_id), 'another process', timeout=None)  # Ours expired, re-leased
+        generator._renew_at = 0
+        self.assertNotEqual(self.worker_id(generator), worker_id)
+
+        generator._release()
+        self.assertIsNone(cache.get(ids.WORKER_LEASE_KEY.format(generator._worker_id)))
+
+    @mock.patch.object(ids, 'MAX_WORKER_ID', 3)
+    def test_no_free_worker_id_raises(self):
+        cache.set_many({ids.WORKER_LEASE_KEY.format(worker_id): 'busy' for worker_id in range(4)}, timeout=None)
+        with self.assertRaises(ids.WorkerIdUnavailable):
+            ids.IdGenerator().next_id()
+
+
+class KitchenTransitionTests(TestCase):
+    """Kitchen staff can only move orders forward, and can't cancel them."""
+
+    def setUp(self):
+        self.branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+        )
+        staff = get_user_model().objects.create_user('kitchen', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        self.path = f'/branch/{self.branch.id}/kitchen-queue/transition/'
+
+    def order(self, order_status):
+        return Order.objects.create(branch=self.branch, status=order_status, subtotal=Decimal('20.00'), total_amount=Decimal('20.00'))
+
+    def transition(self, orders, order_status):
+        return self.client.post(self.path, {'order_ids': [order.id for order in orders], 'status': order_status}, content_type='application/json')
+
+    def test_forward_moves_are_applied(self):
+        orders = [self.order('CONFIRMED'), self.order('PREPARING'), self.order('DISPATCHED')]
+        response = self.transition(orders, 'DISPATCHED')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'matched': 3, 'changed': 2})
+        self.assertEqual(set(Order.objects.values_list('status', flat=True)), {'DISPATCHED'})
+
+    def test_backward_moves_reject_the_whole_request(self):
+        confirmed, delivered, cancelled = self.order('CONFIRMED'), self.order('DELIVERED'), self.order('CANCELLED')
+        response = self.transition([confirmed, delivered, cancelled], 'PREPARING')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json()['order_ids']), 2)
+        self.assertEqual(Order.objects.get(id=confirmed.id).status, 'CONFIRMED')
+
+    def test_polling_with_a_limit_below_one_returns_one_order(self):
+        first, second = self.order('CONFIRMED'), self.order('CONFIRMED')
+        Order.objects.filter(id=first.id).update(change_seq=1)  # Changes old enough to have settled
+        Order.objects.filter(id=second.id).update(change_seq=2)
+        response = self.client.get(f'/branch/{self.branch.id}/kitchen-queue/?since=0&limit=0')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(([order['id'] for order in data['orders']], data['next_cursor']), ([first.id], 1))
+
+    def test_kitchen_cannot_cancel(self):
+        order = self.order('PREPARING')
+        self.assertEqual(self.transition([order], 'CANCELLED').status_code, 400)
+        self.assertEqual(Order.objects.get(id=order.id).status, 'PREPARING')
+
+
+class DealCompositionCacheTests(TestCase):
+    """Cached deal compositions are rebuilt when anything they embed is edited."""
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(title='Pizza')
+        product = Product.objects.create(
+            title='Margherita', category=category, description='Cheese', price=Decimal('9.00'),
+            image='images/products/pizza.png', is_customizable=True,
+        )
+        self.header = CustomizationHeader.objects.create(title='Toppings', max_selection=1)
+        choice = CustomizationChoice.objects.create(customization_header=self.header, title='Olives', price=Decimal('1.00'))
+        ProductCustomizationHeader.objects.create(product=product, customization_header=self.header, sort_order=1)
+        CustomizationPriceRule.objects.create(product=product, customization_choice=choice, price=Decimal('1.00'))
+        deal = Deal.objects.create(title='Pizza night', description='Combo', price=Decimal('15.00'))
+        DealProduct.objects.create(deal=deal, product=product)
+
+    def header_data(self):
+        response = self.client.get('/deal/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()[0]['products'][0]['customizations'][0]['customization_header']
+
+    def test_editing_a_customization_header_refreshes_deal_listings(self):
+        self.assertEqual(self.header_data()['max_selection'], 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.header.max_selection = 3
+            self.header.is_required = True
+            self.header.save()
+        data = self.header_data()
+        self.assertEqual((data['max_selection'], data['is_required']), (3, True))
+
+
+class PriceSelectionTests(TestCase):
+    """Cart pricing (pricing.py) charges what CustomizationSerializer.get_choices shows the customer."""
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(
+            title='Margherita', category=self.category, description='Cheese', price=Decimal('9.00'), is_customizable=True,
+        )
+        size = CustomizationHeader.objects.create(title='Size', is_required=True)
+        toppings = CustomizationHeader.objects.create(title='Toppings', max_selection=3)
+        self.small, self.large = [
+            CustomizationChoice.objects.create(customization_header=size, title=title, price=Decimal('0.00')) for title in ('Small', 'Large')
+        ]
+        self.olives, self.ham, self.anchovies = [
+            CustomizationChoice.objects.create(customization_header=toppings, title=title, price=price)
+            for title, price in (('Olives', Decimal('1.50')), ('Ham', Decimal('2.00')), ('Anchovies', Decimal('2.50')))
+        ]
+        self.size_header = ProductCustomizationHeader.objects.create(product=self.product, customization_header=size, sort_order=1)
+        self.toppings_header = ProductCustomizationHeader.objects.create(
+            product=self.product, customization_header=toppings, sort_order=2, max_discount=Decimal('10.00'), is_percentage=True,
+        )
+        CustomizationPriceRule.objects.create(product=self.product, customization_choice=self.small, price=Decimal('9.00'), is_base=True)
+        large = CustomizationPriceRule.objects.create(product=self.product, customization_choice=self.large, price=Decimal('13.00'))
+        # Ham costs more on a large pizza; olives and anchovies keep the choice's own price
+        CustomizationPriceRule.objects.create(product=self.product, customization_choice=self.ham, price=Decimal('2.00'))
+        CustomizationPriceRule.objects.create(
+            product=self.product, customization_choice=self.ham, price=Decimal('3.00'), customization_price_rules_self=large,
+        )
+        ProductChoicesUnavailablility.objects.create(product=self.product, customization_choice=self.anchovies)
+
+    def start_flash_sale(self, discount, is_percentage=True):
+        now = timezone.now()
+        offer = Offer.objects.create(
+            code='FLASH', offer_type='FLASH_SALE', description='Flash sale', discount_value=discount, is_percentage=is_percentage,
+            valid_from=now - timedelta(hours=1), valid_until=now + timedelta(hours=1),
+        )
+        offer.applicable_products.add(self.product)
+        offer.applicable_headers.add(self.size_header, self.toppings_header)
+        cache.clear()  # M2M edits don't bump the catalog version
+
+    def assert_matches_menu(self):
+        headers = ProductCustomizationHeader.objects.filter(product=self.product).order_by('id')
+        shown = [choice for header in CustomizationSerializer(headers, many=True).data for choice in header['choices']]
+        self.assertEqual(len(shown), 5)  # Small, Large, Ham alone and under Large, Olives
+        for choice in shown:
+            choice_id = choice['customization_choice']['id']
+            selection = [choice_id] + ([choice['parent_choice']] if choice['parent_choice'] else [])
+            price, original_price = price_selection(self.product, selection)[choice_id]
+            self.assertEqual((price, original_price), (Decimal(str(choice['price'])), Decimal(str(choice['original_price']))))
+
+    def test_prices_match_the_menu(self):
+        self.assert_matches_menu()
+        prices = price_selection(self.product, [self.large.id, self.ham.id, self.olives.id])
+        self.assertEqual(prices[self.ham.id], (Decimal('3.00'), Decimal('3.00')))
+        self.assertEqual(prices[self.olives.id], (Decimal('1.50'), Decimal('1.50')))
+
+    def test_flash_sale_prices_match_the_menu(self):
+        self.start_flash_sale(Decimal('25.00'))
+        self.assert_matches_menu()
+        prices = price_selection(self.product, [self.large.id, self.ham.id])
+        self.assertEqual(prices[self.large.id], (Decimal('9.75'), Decimal('13.00')))
+        self.assertEqual(prices[self.ham.id], (Decimal('2.70'), Decimal('3.00')))  # Capped at the header's 10%
+
+    def test_flat_flash_sale_prices_match_the_menu(self):
+        self.start_flash_sale(Decimal('1.00'), is_percentage=False)
+        self.assert_matches_menu()
+
+    def test_choices_the_product_does_not_offer_are_rejected(self):
+        foreign_header = CustomizationHeader.objects.create(title='Sauce')
+        foreign = CustomizationChoice.objects.create(customization_header=foreign_header, title='Garlic', price=Decimal('0.50'))
+        for selection in ([self.anchovies.id], [foreign.id], [12345]):
+            with self.assertRaises(InvalidSelection):
+                price_selection(self.product, selection)
+
+    def test_deal_components_are_priced_like_the_product(self):
+        deal = Deal.objects.create(title='Pizza night', description='Combo', price=Decimal('15.00'))
+        component = DealProduct.objects.create(deal=deal, product=self.product)
+        prices = price_deal_selection(deal, [(component.id, self.large.id), (component.id, self.ham.id)])
+        self.assertEqual(prices, {
+            (component.id, choice_id): price for choice_id, price in price_selection(self.product, [self.large.id, self.ham.id]).items()
+        })
+        with self.assertRaises(InvalidSelection):
+            price_deal_selection(deal, [(None, self.large.id)])
+
+    def test_expandable_choices_are_priced_from_the_catalog(self):
+        header = ExpandableHeader.objects.create(title='Make it a meal')
+        fries = ExpandableChoices.objects.create(category=self.category, expandable_header=header, title='Fries', price=Decimal('2.00'))
+        coke = ExpandableChoices.objects.create(base_product=self.product, expandable_header=header, title='Coke', price=Decimal('1.50'))
+        deal = Deal.objects.create(title='Pizza night', description='Combo', price=Decimal('15.00'), is_expandable=True)
+        dip = ExpandableChoices.objects.create(deal=deal, expandable_header=header, title='Dip', price=Decimal('0.75'))
+
+        self.assertEqual(expandable_choice_prices([fries.id, coke.id], product=self.product), {fries.id: Decimal('2.00'), coke.id: Decimal('1.50')})
+        self.assertEqual(expandable_choice_prices([dip.id], deal=deal), {dip.id: Decimal('0.75')})
+        with self.assertRaises(InvalidSelection):
+            expandable_choice_prices([dip.id], product=self.product)
+        with self.assertRaises(InvalidSelection):
+            expandable_choice_prices([coke.id], deal=deal)
+
+
+    def test_deal_lines_are_priced_from_the_catalog_not_the_request(self):
+        branch = Branch.objects.create(
+            name='Downtown', address='1 Main St', city='City', state='State', postal_code='00000', country='Country',
+        )
+        header = ExpandableHeader.objects.create(title='Make it a meal')
+        deal = Deal.objects.create(
+            title='Pizza night', description='Combo', price=Decimal('15.00'), is_expandable=True, image='images/deals/pizza.png',
+        )
+        self.product.image = 'images/products/pizza.png'
+        self.product.save()
+        dip = ExpandableChoices.objects.create(deal=deal, expandable_header=header, title='Dip', price=Decimal('0.75'))
+        component = DealProduct.objects.create(deal=deal, product=self.product)
+        DealBranchStock.objects.create(branch=branch, deal=deal, price=Decimal('14.00'))
+        cart = Cart.objects.create(branch=branch)
+
+        response = self.client.post(f'/carts/{cart.id}/add-item/', {
+            'deal_id': deal.id, 'quantity': 2, 'total_price': '0.01',
+            'customizations': [{'deal_product_id': component.id, 'customization_choice_id': self.large.id, 'price': 0}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        item = CartItem.objects.get(cart=cart)
+        # The branch price plus Large at this product's price
+        self.assertEqual((item.unit_price, item.unit_sale_price), (Decimal('27.00'), None))
+        self.assertEqual(Decimal(str(response.json()['subtotal'])), Decimal('54.00'))
+
+        # Expandable choices are part of the unit price and counted once in the line totals
+        CartItemExpandableChoice.objects.create(cart_item=item, expandable_choice=dip, price=Decimal('0.75'))
+        item.calculate_unit_prices()
+        self.assertEqual(item.unit_price, Decimal('27.75'))
+        self.assertEqual((item.subtotal, item.original_subtotal), (Decimal('55.50'), Decimal('55.50')))
+
+class InvoicePaginationTests(TestCase):
+    """The invoice list pages by id over order and booking invoices; limit is clamped to at least one invoice per page."""
+
+    def setUp(self):
+        self.user = User.objects.create(email='diner@example.com')
+        self.invoices = [
+            Invoice.objects.create(
+                order=Order.objects.create(user=self.user, subtotal=Decimal('20.00'), total_amount=Decimal('20.00')),
+                invoice_number=f'INV-{number}', total_amount=Decimal('20.00'),
+            )
+            for number in range(3)
+        ]
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        self.header = f'Bearer {token}'
+
+    def page(self, query):
+        return self.client.get(f'/invoices/?summary=1&{query}', HTTP_AUTHORIZATION=self.header)
+
+    def test_limit_below_one_returns_one_invoice_per_page(self):
+        for limit in ('0', '-1'):
+            data = self.page(f'limit={limit}').json()
+            self.assertEqual([invoice['id'] for invoice in data['results']], [self.invoices[2].id])
+            self.assertEqual(data['next_cursor'], self.invoices[2].id)
+        data = self.page(f'limit=0&cursor={self.invoices[1].id}').json()
+        self.assertEqual(([invoice['id'] for invoice in data['results']], data['next_cursor']), ([self.invoices[0].id], None))
+
+    def test_non_integer_limit_is_rejected(self):
+        self.assertEqual(self.page('limit=ten').status_code, 400)
+
+    def test_cursors_walk_order_and_booking_invoices_newest_first(self):
+        booking = Booking.objects.create(user=self.user, booking_date=timezone.now(), party_size=2)
+        self.invoices.append(Invoice.objects.create(booking=booking, invoice_number='INV-B', total_amount=Decimal('5.00')))
+        stranger = User.objects.create(email='stranger@example.com')
+        Invoice.objects.create(
+            order=Order.objects.create(user=stranger, subtotal=Decimal('20.00'), total_amount=Decimal('20.00')),
+            invoice_number='INV-X', total_amount=Decimal('20.00'),
+        )
+
+        seen, cursor = [], None
+        while True:
+            data = self.page(f'limit=2&cursor={cursor}' if cursor else 'limit=2').json()
+            seen.extend(invoice['id'] for invoice in data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [invoice.id for invoice in reversed(self.invoices)])
+
+    def test_full_listing_runs_a_fixed_number_of_queries(self):
+        category = Category.objects.create(title='Pizza')
+        product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+
+        def listing_queries():
+            for invoice in self.invoices:
+                OrderItem.objects.create(order=invoice.order, product=product, quantity=1, unit_price=Decimal('9.00'), subtotal=Decimal('9.00'))
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/invoices/', HTTP_AUTHORIZATION=self.header)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        listing_queries()  # Warm the flash sale and best seller caches
+        self.assertEqual(listing_queries(), listing_queries())
+
+
+class ReceiptTests(TestCase):
+    """Paid invoices get their receipt rendered once; downloads are served from the stored file by hash."""
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(email='diner@example.com')
+        order = Order.objects.create(user=self.user, subtotal=Decimal('18.00'), total_amount=Decimal('18.00'))
+        product = Product.objects.create(
+            title='Margherita', category=Category.objects.create(title='Pizza'), description='Cheese', price=Decimal('9.00'),
+        )
+        OrderItem.objects.create(order=order, product=product, quantity=2, unit_price=Decimal('9.00'), subtotal=Decimal('18.00'))
+        self.invoice = Invoice.objects.create(order=order, invoice_number='INV-1', total_amount=Decimal('18.00'), status='PAID')
+
+    def download(self, user=None, **headers):
+        token = jwt.encode({'user_id': (user or self.user).id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        return self.client.get(f'/invoices/{self.invoice.id}/receipt/', HTTP_AUTHORIZATION=f'Bearer {token}', **headers)
+
+    def test_receipt_is_rendered_once_and_served_by_hash(self):
+        self.assertEqual(self.download().status_code, 202)
+        self.assertEqual(receipts.render_pending_receipts(), 1)
+        self.assertEqual(receipts.render_pending_receipts(), 0)
+
+        response = self.download()
+        content = b''.join(response.streaming_content)
+        response.close()
+        self.invoice.refresh_from_db()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.invoice.receipt_sha256}"')
+        self.assertIn(b'Margherita', content)
+        self.assertIn(b'INV-1', content)
+
+        with self.assertNumQueries(0):
+            cached = self.download(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_other_users_get_not_found(self):
+        receipts.render_pending_receipts()
+        stranger = User.objects.create(email='stranger@example.com')
+        self.assertEqual(self.download(user=stranger).status_code, 404)
+
+    def test_unpaid_invoices_are_not_rendered(self):
+        Invoice.objects.filter(pk=self.invoice.pk).update(status='PENDING')
+        self.assertEqual(receipts.render_pending_receipts(), 0)
+        self.assertEqual(self.download().status_code, 202)
+
+
+class ProductReviewPaginationTests(TestCase):
+    """Review pages follow their cursors through every review, even with a limit below one."""
+
+    def setUp(self):
+        category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+        self.reviews = [
+            Review.objects.create(user=User.objects.create(email=f'diner{number}@example.com'), product=self.product, rating=5)
+            for number in range(3)
+        ]
+
+    def test_limit_below_one_pages_one_review_at_a_time(self):
+        seen, cursor = [], None
+        for _ in range(len(self.reviews)):
+            query = f'limit=0&cursor={cursor}' if cursor else 'limit=-1'
+            response = self.client.get(f'/products/{self.product.id}/reviews/?{query}')
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(len(data['results']), 1)
+            seen.append(data['results'][0]['id'])
+            cursor = data['next_cursor']
+        self.assertIsNone(cursor)
+        self.assertEqual(seen, [review.id for review in reversed(self.reviews)])
+
+class ReviewCreationTests(TestCase):
+    """A user reviews a product once, even when two posts race past the "already reviewed" check."""
+
+    def setUp(self):
+        category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+        self.user = User.objects.create(email='diner@example.com')
+        token = jwt.encode({'user_id': self.user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+        self.header = f'Bearer {token}'
+
+    def post(self, rating):
+        return self.client.post(
+            '/reviews/create/', {'product': self.product.id, 'rating': rating}, content_type='application/json', HTTP_AUTHORIZATION=self.header,
+        )
+
+    def test_racing_duplicate_is_rejected_and_not_counted(self):
+        self.assertEqual(self.post(4).status_code, 201)
+        with mock.patch.object(QuerySet, 'exists', return_value=False):  # The other post checked before this insert
+            response = self.post(2)
+        self.assertEqual(response.status_code, 400)
+        self.product.refresh_from_db()
+        self.assertEqual((Review.objects.count(), self.product.rating_count, self.product.rating_avg), (1, 1, Decimal('4.00')))
+
+
+class ReviewRatingTests(TestCase):
+    """A product's rating_count/rating_avg follow its reviews as they are posted, edited and deleted."""
+
+    def setUp(self):
+        category = Category.objects.create(title='Pizza')
+        self.product = Product.objects.create(title='Margherita', category=category, description='Cheese', price=Decimal('9.00'))
+        self.headers = []
+        for name in ('alice', 'bob'):
+            user = User.objects.create(email=f'{name}@example.com')
+            token = jwt.encode({'user_id': user.id, 'exp': datetime.now(dt_timezone.utc) + timedelta(hours=1)}, settings.SECRET_KEY, algorithm='HS256')
+            self.headers.append(f'Bearer {token}')
+
+    def rating(self):
+        self.product.refresh_from_db()
+        return self.product.rating_count, self.product.rating_avg
+
+    def test_aggregates_follow_posts_edits_and_deletes(self):
+        review_ids = [
+            self.client.post(
+                '/reviews/create/', {'product': self.product.id, 'rating': rating}, content_type='application/json', HTTP_AUTHORIZATION=header,
+            ).json()['id']
+            for header, rating in zip(self.headers, (4, 5))
+        ]
+        self.assertEqual(self.rating(), (2, Decimal('4.50')))
+
+        response = self.client.patch(f'/reviews/{review_ids[0]}/', {'rating': 2}, content_type='application/json', HTTP_AUTHORIZATION=self.headers[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rating(), (2, Decimal('3.50')))
+
+        response = self.client.patch(f'/reviews/{review_ids[0]}/', {'comment': 'Crispy'}, content_type='application/json', HTTP_AUTHORIZATION=self.headers[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rating(), (2, Decimal('3.50')))
+
+        self.assertEqual(self.client.delete(f'/reviews/{review_ids[1]}/', HTTP_AUTHORIZATION=self.headers[1]).status_code, 204)
+        self.assertEqual(self.rating(), (1, Decimal('2.00')))
+        self.assertEqual(self.client.delete(f'/reviews/{review_ids[0]}/', HTTP_AUTHORIZATION=self.headers[0]).status_code, 204)
+        self.assertEqual(self.rating(), (0, Decimal('0.00')))
+
+    def test_only_the_author_can_change_a_review(self):
+        review_id = self.client.post(
+            '/reviews/create/', {'product': self.product.id, 'rating': 5}, content_type='application/json', HTTP_AUTHORIZATION=self.headers[0],
+        ).json()['id']
+        response = self.client.patch(f'/reviews/{review_id}/', {'rating': 1}, content_type='application/json', HTTP_AUTHORIZATION=self.headers[1])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.delete(f'/reviews/{review_id}/', HTTP_AUTHORIZATION=self.headers[1]).status_code, 404)
+        self.assertEqual(self.rating(), (1, Decimal('5.00')))
@@ -5,7 +5,8 @@ from rest_framework.routers import DefaultRouter
 urlpatterns = [
     # Booking endpoints
     path('bookings/create/', create_booking, name='create_booking'), 
-    path('bookings/', get_bookings, name='get_bookings'), 
+    path('bookings/', get_bookings, name='get_bookings'),
+    path('booking-availability/', booking_availability_view, name='booking_availability'), 
     
     path('payments/add/', add_payment_method, name='add_payment_method'), 
     path('payments/process/', process_payment, name='process_payment'), 
@@ -14,6 +15,8 @@ urlpatterns = [
     path('refunds/check/', check_refund_amount, name='check_refund_amount'), 
     path('cancellations/create/', cancel_order_or_booking, name='cancel_order_or_booking'), 
     path('invoices/', get_invoices, name='get_invoices'), 
+    path('invoices/<int:invoice_id>/receipt/', invoice_receipt_view, name='invoice_receipt'),
+    path('exports/orders/', export_orders_view, name='export_orders'),
     
     #stripe payments
     path('create-payment-intent/', create_payment_intent, name='create_payment_intent'),
@@ -26,10 +29,14 @@ urlpatterns = [
     path('branch/<int:branch_id>', branch_detail_view, name='branch_detail_view'),
     
     path('branch-status-bulk/', branch_status_bulk_view, name='branch_status_bulk_view'),
+    path('branch-events/', branch_events_view, name='branch_events_view'),
     
     path('branch-deals/<int:branch_id>', branch_deals_view, name='branch_deals_view'),
     path('branch-stock/<int:branch_id>', branch_stock_status_view, name='branch_stock_status_view'),
+    path('branch-stock/<int:branch_id>/bulk/', branch_stock_bulk_update_view, name='branch_stock_bulk_update_view'),
     path('branch-products/<int:branch_id>', branch_products_view, name='branch_products_view'),
+    path('branch/<int:branch_id>/kitchen-queue/', kitchen_queue_view, name='kitchen_queue_view'),
+    path('branch/<int:branch_id>/kitchen-queue/transition/', kitchen_transition_view, name='kitchen_transition_view'),
     
     path('carousel-cards/', carousel_list_view, name='carousel_list_view'),
     path('offers/by-code/', get_offer_by_code, name='get_offer_by_code'),
@@ -62,8 +69,12 @@ urlpatterns = [
     # Order endpoints
     path('orders/', get_orders, name='get_orders'),  # List user's orders
     path('orders/create/', create_order, name='create_order'),  # Create an order
+    path('orders/events/', order_events_view, name='order_events'),  # Live order status stream
     path('products/',product_list_view),
     path('products/<int:product_id>/',product_detail_view),
+    path('products/<int:product_id>/reviews/', product_reviews_view, name='product_reviews'),
+    path('reviews/create/', create_review, name='create_review'),
+    path('reviews/<int:review_id>/', review_detail_view, name='review_detail'),
     path('menu/',menu_list_view),
     path('deal/',deal_list_view),
     path('deal/<int:deal_id>',deal_detail_view),
@@ -1,15 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone as dt_timezone
 from core.models import User
 from core.views import decode_jwt
 from .serializers import *
 from .models import *
 from rest_framework import viewsets, status
-from rest_framework.decorators import api_view, action
+from rest_framework.decorators import api_view, action, authentication_classes, permission_classes
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from django.utils import timezone
 import stripe
-from vroom_backend import settings
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.views.decorators.http import require_GET
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 import json
 from django.db import models
@@ -17,12 +23,39 @@ from django.core.cache import cache
 from django.db import transaction
 import os
 from django.db import close_old_connections
+from django.db import IntegrityError
 from dotenv import load_dotenv
+from .stock import InvalidStockChange, apply_branch_stock_changes
+from .ids import min_id_at, new_reference
+from .idempotency import idempotent
+from .bookings import BookingUnavailable, find_open_slots, reserve_booking
+from .carousel import get_active_carousel
+from . import availability
+from .suggestions import visible_suggestion_ids
+from .deals import load_deal_compositions
+from .pricing import InvalidSelection, expandable_choice_prices, price_deal_selection, price_selection
+from .exports import EXPORT_FORMATS, aiter_export, iter_export
+from .stripe_gateway import PaymentGatewayUnavailable, stripe_gateway
+from .receipts import RECEIPT_CONTENT_TYPE, get_receipt_pointer, receipt_path
+from .events import CATALOG_CHANNEL, branch_channel, sse_stream, user_channel
 
 load_dotenv()
 
 stripe.api_key = os.environ.get('STRIPE_API_KEY')
 
+def favorite_context(request):
+    """
+    Serializer context with the user's favorite product/deal ids, so cards can show is_favorite.
+    The token is decoded here instead of going through request.user: an expired or invalid token
+    just means no favorites, the catalog is still served.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    user_id = decode_jwt(auth_header.split(' ')[1]) if auth_header.startswith('Bearer ') else None
+    if not user_id:
+        return {}
+    product_ids, deal_ids = Favorite.ids_for_user(user_id)
+    return {'favorite_product_ids': product_ids, 'favorite_deal_ids': deal_ids}
+
 @api_view(['GET'])
 def category_list_view(request):
     try:
@@ -38,6 +71,7 @@ def category_list_view(request):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 @api_view(['GET'])
+@authentication_classes([])
 def product_list_view(request):
     try:
         products = Product.objects.all()
@@ -51,37 +85,16 @@ def product_list_view(request):
         branch_ids = request.query_params.getlist('branch_id')
         
         if branch_ids:
-                # Get all product IDs in the current queryset
-                product_ids = products.values_list('id', flat=True)
-
-                # Fetch stock records for these products and branches
-                stock_records = ProductBranchStock.objects.filter(
-                    branch_id__in=branch_ids,
-                    product_id__in=product_ids
-                ).values('product_id', 'branch_id', 'is_available')
-
-                # Group by product to determine availability
-                product_availability = {}
-                for product_id in product_ids:
-                    product_stocks = [r for r in stock_records if r['product_id'] == product_id]
-                    total_branches_with_stock = len(product_stocks)
-                    unavailable_branches = sum(1 for stock in product_stocks if not stock['is_available'])
-
-                    # Product is unavailable only if it's unavailable at all branches
-                    if total_branches_with_stock == len(branch_ids) and unavailable_branches == len(branch_ids):
-                        product_availability[product_id] = False
-                    else:
-                        product_availability[product_id] = True
+            # Filter out products not offered at any of the branches, on the materialized status
+            products = products.exclude(
+                id__in=availability.unavailable_everywhere('product', branch_ids, statuses=('unavailable',))
+            )
 
-                # Filter out products unavailable at all branches
-                unavailable_product_ids = [pid for pid, available in product_availability.items() if not available]
-                products = products.exclude(id__in=unavailable_product_ids)
-                
         # Pass branch_ids to serializer context
         serializer = ProductDetailSerializer(
             products,
             many=True,
-            context={'branch_ids': branch_ids if branch_ids else None}
+            context={'branch_ids': branch_ids if branch_ids else None, **favorite_context(request)}
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
     except ValueError as ve:
@@ -91,6 +104,7 @@ def product_list_view(request):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
 @api_view(['GET'])
+@authentication_classes([])
 def product_detail_view(request, product_id):
     try:
         product = Product.objects.get(id=product_id)
@@ -102,7 +116,7 @@ def product_detail_view(request, product_id):
         # Pass branch_ids to serializer context
         serializer = ProductDetailSerializer(
             product,
-            context={'branch_ids': branch_ids if branch_ids else None}
+            context={'branch_ids': branch_ids if branch_ids else None, **favorite_context(request)}
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Product.DoesNotExist:
@@ -114,7 +128,99 @@ def product_detail_view(request, product_id):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
 
+REVIEW_PAGE_SIZE = 20
+REVIEW_MAX_PAGE_SIZE = 100
+REVIEW_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _review_cursor(review):
+    # (created_at in epoch microseconds, id) of the last review on a page
+    return f"{(review.created_at - REVIEW_CURSOR_EPOCH) // timedelta(microseconds=1)}.{review.id}"
+
+
+def _parse_review_cursor(cursor):
+    created_us, review_id = cursor.split('.')
+    return REVIEW_CURSOR_EPOCH + timedelta(microseconds=int(created_us)), int(review_id)
+
+
+@api_view(['GET'])
+def product_reviews_view(request, product_id):
+    """A product's reviews newest first, keyset paginated on (created_at, id): ?cursor=&limit="""
+    try:
+        limit = max(1, min(int(request.query_params.get('limit', REVIEW_PAGE_SIZE)), REVIEW_MAX_PAGE_SIZE))
+        cursor = request.query_params.get('cursor')
+        cursor = _parse_review_cursor(cursor) if cursor else None
+    except ValueError:
+        return Response({'error': 'Invalid cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+    reviews = Review.objects.filter(product_id=product_id).select_related('user').order_by('-created_at', '-id')
+    if cursor:
+        created_at, review_id = cursor
+        reviews = reviews.filter(models.Q(created_at__lt=created_at) | models.Q(created_at=created_at, id__lt=review_id))
+    page = list(reviews[:limit + 1])
+    next_cursor = _review_cursor(page[limit - 1]) if len(page) > limit else None
+    return Response({'results': ReviewSerializer(page[:limit], many=True).data, 'next_cursor': next_cursor})
+
+
+@api_view(['POST'])
+def create_review(request):
+    """Review a product or an order (exactly one of them)."""
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    user_id = decode_jwt(auth_header.split(' ')[1])
+    if not user_id:
+        return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    serializer = ReviewSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    order = serializer.validated_data.get('order')
+    if order is not None and order.user_id != user_id:
+        return Response({'error': 'Order not found'}, status=status.HTTP_404_NOT_FOUND)
+    if Review.objects.filter(
+        user_id=user_id, product=serializer.validated_data.get('product'), order=order,
+    ).exists():
+        return Response({'error': 'You have already reviewed this'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        serializer.save(user_id=user_id)
+    except IntegrityError:
+        # A concurrent post of the same review won the insert
+        return Response({'error': 'You have already reviewed this'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['PATCH', 'DELETE'])
+def review_detail_view(request, review_id):
+    """Edit (rating/comment) or delete your own review."""
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    user_id = decode_jwt(auth_header.split(' ')[1])
+    if not user_id:
+        return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        review = Review.objects.get(id=review_id, user_id=user_id)
+    except Review.DoesNotExist:
+        return Response({'error': 'Review not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    if request.method == 'DELETE':
+        review.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    data = {key: request.data[key] for key in ('rating', 'comment') if key in request.data}
+    serializer = ReviewSerializer(review, data=data, partial=True)
+    if serializer.is_valid():
+        serializer.save()
+        return Response(serializer.data)
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(['GET'])
+@authentication_classes([])
 def menu_list_view(request):
     try:
         # Get multiple branch_ids from query parameters
@@ -127,7 +233,7 @@ def menu_list_view(request):
             menus = menus.filter(title__icontains=title)
         
         # Pass branch_ids to serializer context for filtering items
-        serializer = MenuSerializer(menus, many=True, context={'branch_ids': branch_ids if branch_ids else None})
+        serializer = MenuSerializer(menus, many=True, context={'branch_ids': branch_ids if branch_ids else None, **favorite_context(request)})
         
         # Filter out menus with no items
         filtered_data = [menu_data for menu_data in serializer.data if menu_data['items']]
@@ -158,6 +264,7 @@ def deal_create_view(request):
     
 
 @api_view(['GET'])
+@authentication_classes([])
 def special_suggestions_list_view(request):
     """
     List special suggestions, filtered by branch_ids, excluding items unavailable at all branches.
@@ -173,76 +280,19 @@ def special_suggestions_list_view(request):
         if not branch_ids:
             return Response({'error': 'Invalid branch_id format'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Fetch all special suggestions with related product and deal data
-        suggestions = SpecialSuggestionsBranchWise.objects.select_related('product', 'deal', 'branch').filter(branch_id__in=branch_ids)
-
-        # Get unique product and deal IDs from suggestions
-        product_ids = suggestions.filter(product__isnull=False).values_list('product_id', flat=True).distinct()
-        deal_ids = suggestions.filter(deal__isnull=False).values_list('deal_id', flat=True).distinct()
-
-        # Fetch stock records for products and deals across the specified branches
-        product_stocks = ProductBranchStock.objects.filter(
-            branch_id__in=branch_ids,
-            product_id__in=product_ids
-        ).values('product_id', 'branch_id', 'is_available')
-
-        # For deals, assume availability is tied to their products (adjust if Deal has its own stock model)
-        deal_product_stocks = ProductBranchStock.objects.filter(
-            branch_id__in=branch_ids,
-            product__dealproduct__deal_id__in=deal_ids
-        ).values('product_id', 'branch_id', 'is_available')
-
-        # Determine availability for products
-        product_availability = {}
-        for product_id in product_ids:
-            stocks = [s for s in product_stocks if s['product_id'] == product_id]
-            total_branches_with_stock = len(stocks)
-            unavailable_branches = sum(1 for s in stocks if not s['is_available'])
-
-            # Product is unavailable if it's out of stock at all branches
-            if total_branches_with_stock == len(branch_ids) and unavailable_branches == len(branch_ids):
-                product_availability[product_id] = False
-            else:
-                product_availability[product_id] = True
-
-        # Determine availability for deals (based on their products)
-        deal_availability = {}
-        for deal_id in deal_ids:
-            # Get all product stocks related to this deal
-            deal_products = Product.objects.filter(dealproduct__deal_id=deal_id).values_list('id', flat=True)
-            deal_stocks = [s for s in deal_product_stocks if s['product_id'] in deal_products]
-            total_branches_with_stock = len(set(s['branch_id'] for s in deal_stocks))
-            unavailable_branches = sum(1 for s in deal_stocks if not s['is_available'])
-
-            # Deal is unavailable if all its products are unavailable at all branches
-            if total_branches_with_stock == len(branch_ids) and unavailable_branches == len(deal_stocks):
-                deal_availability[deal_id] = False
-            else:
-                deal_availability[deal_id] = True
-
-        # Filter suggestions to exclude unavailable products and deals
-        filtered_suggestions = []
-        seen_products = set()
-        seen_deals = set()
-
-        for suggestion in suggestions:
-            if suggestion.product:
-                if suggestion.product_id in seen_products or not product_availability.get(suggestion.product_id, True):
-                    continue
-                seen_products.add(suggestion.product_id)
-                filtered_suggestions.append(suggestion)
-            elif suggestion.deal:
-                if suggestion.deal_id in seen_deals or not deal_availability.get(suggestion.deal_id, True):
-                    continue
-                seen_deals.add(suggestion.deal_id)
-                filtered_suggestions.append(suggestion)
-
-        # Serialize the filtered suggestions
-        serializer = SpecialSuggestionsBranchWiseSerializer(
-            filtered_suggestions,
-            many=True,
-            context={'branch_ids': branch_ids}
-        )
+        # Suggestions still offered at one of the branches, worked out once per branch set and catalog version
+        suggestion_ids = visible_suggestion_ids(branch_ids)
+        suggestions = SpecialSuggestionsBranchWise.objects.select_related('product', 'deal', 'branch').in_bulk(suggestion_ids)
+        filtered_suggestions = [suggestions[suggestion_id] for suggestion_id in suggestion_ids if suggestion_id in suggestions]
+
+        # Serialize the filtered suggestions, with the nested products' and deals' relations loaded in bulk
+        context = {
+            'branch_ids': branch_ids,
+            'deal_compositions': load_deal_compositions([s.deal for s in filtered_suggestions if s.deal_id]),
+            **favorite_context(request),
+        }
+        ProductDetailSerializer.apply_prefetch_graph([s.product for s in filtered_suggestions if s.product_id], context)
+        serializer = SpecialSuggestionsBranchWiseSerializer(filtered_suggestions, many=True, context=context)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     except ValueError as ve:
@@ -254,13 +304,15 @@ def special_suggestions_list_view(request):
             close_old_connections()
 
 @api_view(['GET'])
+@authentication_classes([])
 def deal_list_view(request):
     try:
-        deals = Deal.objects.prefetch_related('dealproduct_set__product').all()
+        deals = Deal.objects.all()
         
         category_id = request.query_params.get('category_id', None)
         if category_id:
             deals = deals.filter(category=category_id)
+        deals = list(deals)
             
             
             
@@ -274,7 +326,11 @@ def deal_list_view(request):
         serializer = DealSerializer(
             deals,
             many=True,
-            context={'branch_ids': branch_ids if branch_ids else None}
+            context={
+                'branch_ids': branch_ids if branch_ids else None,
+                'deal_compositions': load_deal_compositions(deals),  # Components/expandables of every deal, cached
+                **favorite_context(request),
+            }
         )
         
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -284,10 +340,11 @@ def deal_list_view(request):
 
 
 @api_view(['GET'])
+@authentication_classes([])
 def deal_detail_view(request, deal_id):
     try:
         # Fetch the specific deal by ID
-        deal = Deal.objects.prefetch_related('dealproduct_set__product').get(id=deal_id)
+        deal = Deal.objects.get(id=deal_id)
         # Get multiple branch_ids from query parameters
         branch_ids = request.query_params.getlist('branch_id')
         if branch_ids:
@@ -295,7 +352,11 @@ def deal_detail_view(request, deal_id):
         serializer = DealSerializer(
             deal,
             many=False,
-            context={'branch_ids': branch_ids if branch_ids else None}
+            context={
+                'branch_ids': branch_ids if branch_ids else None,
+                'deal_compositions': load_deal_compositions([deal]),
+                **favorite_context(request),
+            }
         )
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Deal.DoesNotExist:
@@ -367,7 +428,7 @@ def favorite_list_view(request):
                 product__id__in=product_ids, user__isnull=True
             ) | Favorite.objects.filter(deal__id__in=deal_ids, user__isnull=True)
         
-        serializer = FavoriteSerializer(favorites, many=True, context={'request': request})
+        serializer = FavoriteSerializer(favorites, many=True, context={'request': request, **favorite_context(request)})
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Exception as e:
         print(f"Error in favorite_list_view: {e}")
@@ -423,37 +484,29 @@ def merge_favorites_view(request):
     Merge local favorites (product_ids, deal_ids) into the user's favorites.
     """
     try:
-        product_ids = request.data.get('product_ids', [])
-        deal_ids = request.data.get('deal_ids', [])
+        if not request.user.is_authenticated:
+            return Response({'error': 'Authentication required'}, status=status.HTTP_401_UNAUTHORIZED)
         user = request.user
+        product_ids = [pid for pid in request.data.get('product_ids', []) if pid]
+        deal_ids = [did for did in request.data.get('deal_ids', []) if did]
+
+        # Unknown ids are dropped; already favorited ones are skipped by the unique constraints
+        product_ids = list(Product.objects.only('id').in_bulk(product_ids))
+        deal_ids = list(Deal.objects.only('id').in_bulk(deal_ids))
+        Favorite.objects.bulk_create(
+            [Favorite(user=user, product_id=pid) for pid in product_ids]
+            + [Favorite(user=user, deal_id=did) for did in deal_ids],
+            ignore_conflicts=True,
+        )
 
-        # Create favorites for each product/deal ID
-        print('merging')
-        
-        for pid in product_ids:
-            if pid and Product.objects.filter(id=pid).exists():
-                Favorite.objects.get_or_create(user=user, product_id=pid)
-        for did in deal_ids:
-            if did and Deal.objects.filter(id=did).exists():
-                Favorite.objects.get_or_create(user=user, deal_id=did)
-        print('merging 2')
-        
         # Delete user=null favorites for these IDs to avoid duplicates
-        print(Favorite.objects.filter(user__isnull=True,product__id__in=product_ids))
-        print(Favorite.objects.filter(user__isnull=True))
-        print(Favorite.objects.filter(product__id__in=product_ids))
         Favorite.objects.filter(
-            user__isnull=True, product__id__in=product_ids
+            models.Q(product__id__in=product_ids) | models.Q(deal__id__in=deal_ids), user__isnull=True,
         ).delete()
-        Favorite.objects.filter(
-            user__isnull=True, deal__id__in=deal_ids
-        ).delete()
-        print('merging complete')
-        
 
         # Return updated favorites
-        favorites = Favorite.objects.filter(user=user)
-        serializer = FavoriteSerializer(favorites, many=True, context={'request': request})
+        favorites = Favorite.objects.filter(user=user).select_related('product', 'deal')
+        serializer = FavoriteSerializer(favorites, many=True, context={'request': request, **favorite_context(request)})
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Exception as e:
         print(f"Error in merge_favorites_view: {e}")
@@ -635,7 +688,6 @@ def add_item_to_cart(request, cart_id):
     # Extract request data: product/deal ID, quantity, customizations, and expandable choices
     product_id = request.data.get('product_id')
     deal_id = request.data.get('deal_id')
-    total_price = request.data.get('total_price')
     quantity = request.data.get('quantity', 1)
     customizations = request.data.get('customizations', [])  # List of {'customization_choice_id': int, 'price': float}
     expandable_choices = request.data.get('expandable_choices', [])  # List of {'expandable_choice_id': int, 'price': float}
@@ -648,10 +700,17 @@ def add_item_to_cart(request, cart_id):
         if product_id:
             product = Product.objects.get(id=product_id)
             item_filter = {'product': product, 'deal': None}
+            # Customization and expandable prices come from the catalog, not from the request
+            choice_prices = price_selection(product, [int(c['customization_choice_id']) for c in customizations])
+            expandable_prices = expandable_choice_prices([int(e['expandable_choice_id']) for e in expandable_choices], product=product)
             item_id = f"Product-{product_id}"
         elif deal_id:
             deal = Deal.objects.get(id=deal_id)
             item_filter = {'deal': deal, 'product': None}
+            choice_prices = price_deal_selection(
+                deal, [(c.get('deal_product_id'), int(c['customization_choice_id'])) for c in customizations]
+            )
+            expandable_prices = expandable_choice_prices([int(e['expandable_choice_id']) for e in expandable_choices], deal=deal)
             item_id = f"Deal-{deal_id}"
 
         # Generate a signature from the request data to identify this item uniquely
@@ -715,13 +774,13 @@ def add_item_to_cart(request, cart_id):
                     
                     for customization in customizations:
                         deal_product_id = customization.get('deal_product_id')
-                        deal_product = deal_products.get(deal_product_id) if deal_product_id else None
+                        price, original_price = choice_prices[deal_product_id, int(customization['customization_choice_id'])]
                         CartItemCustomization.objects.create(
                             cart_item=cart_item,
                             customization_choice_id=customization['customization_choice_id'],
-                            deal_product=deal_product,
-                            price=Decimal(str(customization['price'])),
-                            original_price=Decimal(str(customization['original_price']))
+                            deal_product=deal_products[deal_product_id],
+                            price=price,
+                            original_price=original_price
                         )
                     for expandable in expandable_choices:
                         deal_product_id = expandable.get('deal_product_id')
@@ -730,27 +789,28 @@ def add_item_to_cart(request, cart_id):
                             cart_item=cart_item,
                             expandable_choice_id=expandable['expandable_choice_id'],
                             deal_product=deal_product,
-                            price=Decimal(str(expandable['price']))
+                            price=expandable_prices[int(expandable['expandable_choice_id'])]
                         )
                 else:
-                # Add customizations with prices from request data (ensures price consistency at add-time)
+                # Add customizations at the server-side prices resolved above
                     for customization in customizations:
+                        price, original_price = choice_prices[int(customization['customization_choice_id'])]
                         CartItemCustomization.objects.create(
                             cart_item=cart_item,
                             customization_choice_id=customization['customization_choice_id'],
-                            price=Decimal(str(customization['price'])),
-                            original_price=Decimal(str(customization['original_price']))
+                            price=price,
+                            original_price=original_price
                         )
                     
-                    # Add expandable choices with prices from request data
+                    # Add expandable choices at their catalog prices
                     for expandable in expandable_choices:
                         CartItemExpandableChoice.objects.create(
                             cart_item=cart_item,
                             expandable_choice_id=expandable['expandable_choice_id'],
-                            price=Decimal(str(expandable['price']))
+                            price=expandable_prices[int(expandable['expandable_choice_id'])]
                         )
                     
-                cart_item.calculate_unit_prices(total_price)  # Set prices after customizations
+                cart_item.calculate_unit_prices()  # Set prices after customizations
                 cart_item.save()
                 # Update the cache with the new item's signature
                 cached_signatures[cart_item.id] = cart_item.get_signature()
@@ -769,6 +829,8 @@ def add_item_to_cart(request, cart_id):
     except (Product.DoesNotExist, Deal.DoesNotExist):
         # Handle case where product or deal doesn’t exist
         return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
+    except InvalidSelection as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         # Log and return any unexpected errors
         print(f"Error in add_item_to_cart: {e}")
@@ -798,7 +860,6 @@ def update_item_in_cart(request, cart_id, item_id):
 
     # Extract request data
     product_id = request.data.get('product_id')
-    total_price = request.data.get('total_price')
     deal_id = request.data.get('deal_id')
     quantity = request.data.get('quantity', cart_item.quantity)  # Default to current if not provided
     customizations = request.data.get('customizations', [])  # List of {'customization_choice_id': int, 'price': float, 'original_price': float}
@@ -817,10 +878,17 @@ def update_item_in_cart(request, cart_id, item_id):
         if product_id:
             product = Product.objects.get(id=product_id)
             item_filter = {'product': product, 'deal': None}
+            # Customization and expandable prices come from the catalog, not from the request
+            choice_prices = price_selection(product, [int(c['customization_choice_id']) for c in customizations])
+            expandable_prices = expandable_choice_prices([int(e['expandable_choice_id']) for e in expandable_choices], product=product)
             item_id_str = f"Product-{product_id}"
         elif deal_id:
             deal = Deal.objects.get(id=deal_id)
             item_filter = {'deal': deal, 'product': None}
+            choice_prices = price_deal_selection(
+                deal, [(c.get('deal_product_id'), int(c['customization_choice_id'])) for c in customizations]
+            )
+            expandable_prices = expandable_choice_prices([int(e['expandable_choice_id']) for e in expandable_choices], deal=deal)
             item_id_str = f"Deal-{deal_id}"
 
         # Generate signature for the updated item
@@ -881,13 +949,13 @@ def update_item_in_cart(request, cart_id, item_id):
                     deal_products = {dp.id: dp for dp in DealProduct.objects.filter(deal=deal)}
                     for customization in customizations:
                         deal_product_id = customization.get('deal_product_id')
-                        deal_product = deal_products.get(deal_product_id) if deal_product_id else None
+                        price, original_price = choice_prices[deal_product_id, int(customization['customization_choice_id'])]
                         CartItemCustomization.objects.create(
                             cart_item=cart_item,
                             customization_choice_id=customization['customization_choice_id'],
-                            deal_product=deal_product,
-                            price=Decimal(str(customization['price'])),
-                            original_price=Decimal(str(customization['original_price']))
+                            deal_product=deal_products[deal_product_id],
+                            price=price,
+                            original_price=original_price
                         )
                     for expandable in expandable_choices:
                         deal_product_id = expandable.get('deal_product_id')
@@ -896,24 +964,25 @@ def update_item_in_cart(request, cart_id, item_id):
                             cart_item=cart_item,
                             expandable_choice_id=expandable['expandable_choice_id'],
                             deal_product=deal_product,
-                            price=Decimal(str(expandable['price']))
+                            price=expandable_prices[int(expandable['expandable_choice_id'])]
                         )
                 else:
                     for customization in customizations:
+                        price, original_price = choice_prices[int(customization['customization_choice_id'])]
                         CartItemCustomization.objects.create(
                             cart_item=cart_item,
                             customization_choice_id=customization['customization_choice_id'],
-                            price=Decimal(str(customization['price'])),
-                            original_price=Decimal(str(customization['original_price']))
+                            price=price,
+                            original_price=original_price
                         )
                     for expandable in expandable_choices:
                         CartItemExpandableChoice.objects.create(
                             cart_item=cart_item,
                             expandable_choice_id=expandable['expandable_choice_id'],
-                            price=Decimal(str(expandable['price']))
+                            price=expandable_prices[int(expandable['expandable_choice_id'])]
                         )
 
-                cart_item.calculate_unit_prices(total_price)  # Set prices after customizations
+                cart_item.calculate_unit_prices()  # Set prices after customizations
                 cart_item.save()
 
                 # Update cache
@@ -929,6 +998,8 @@ def update_item_in_cart(request, cart_id, item_id):
 
     except (Product.DoesNotExist, Deal.DoesNotExist):
         return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
+    except InvalidSelection as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         print(f"Error in update_item_in_cart: {e}")
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -1107,7 +1178,24 @@ def get_orders(request):
         print(e)
 
 
+#? Live order tracker, streams only the order that changed (status, delivery status, ETA).
+#? EventSource can't send headers, so the JWT may also come as ?token=
+@require_GET
+async def order_events_view(request):
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header.split(' ')[1] if auth_header.startswith('Bearer ') else request.GET.get('token')
+    user_id = decode_jwt(token) if token else None
+    if not user_id:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+
+    response = StreamingHttpResponse(sse_stream([user_channel(user_id)]), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @api_view(['POST'])
+@idempotent
 def create_order(request):
     auth_header = request.headers.get('Authorization', '')
     if not auth_header.startswith('Bearer '):
@@ -1525,10 +1613,42 @@ def create_booking(request):
 
     serializer = BookingSerializer(data=request.data)
     if serializer.is_valid():
-        serializer.save(user_id=user_id)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        data = dict(serializer.validated_data)
+        data.pop('user', None)
+        try:
+            booking = reserve_booking(
+                user_id, data.pop('branch', None), data.pop('booking_date'), data.pop('party_size'), **data
+            )
+        except BookingUnavailable as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(BookingSerializer(booking).data, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['GET'])
+def booking_availability_view(request):
+    """Open booking slots for a day across branches: ?branch_ids=1,2&date=2025-01-31&party_size=4"""
+    try:
+        branch_ids = [int(i) for i in request.query_params.get('branch_ids', '').split(',') if i]
+        day = datetime.strptime(request.query_params['date'], '%Y-%m-%d').date()
+        party_size = int(request.query_params.get('party_size', 1))
+    except (KeyError, ValueError):
+        return Response({'error': 'branch_ids, date (YYYY-MM-DD) and party_size are required'}, status=status.HTTP_400_BAD_REQUEST)
+    if not branch_ids or party_size < 1:
+        return Response({'error': 'branch_ids, date (YYYY-MM-DD) and party_size are required'}, status=status.HTTP_400_BAD_REQUEST)
+
+    open_slots = find_open_slots(branch_ids, day, party_size)
+    return Response({
+        'date': day.isoformat(),
+        'party_size': party_size,
+        'branches': [
+            {
+                'branch_id': branch_id,
+                'slots': [{'start': start.isoformat(), 'remaining_seats': remaining} for start, remaining in slots],
+            }
+            for branch_id, slots in open_slots.items()
+        ],
+    })
+
 @api_view(['GET'])
 def get_bookings(request):
     """Retrieve user's bookings."""
@@ -1586,6 +1706,7 @@ def add_payment_method(request):
 
 
 @api_view(['POST'])
+@idempotent
 def process_payment(request):
     """Process payment for an order or booking."""
     auth_header = request.headers.get('Authorization', '')
@@ -1611,7 +1732,7 @@ def process_payment(request):
                 defaults = {
                     "payment_method":payment_method,
                     "amount":amount,
-                    "transaction_id":f"TXN-{timezone.now().strftime('%Y%m%d%H%M%S')}",
+                    "transaction_id":new_reference('TXN'),
                 }
             )
             if created:
@@ -1633,7 +1754,7 @@ def process_payment(request):
                 booking=booking,
                 defaults={'payment_method':payment_method,
                 'amount':amount,
-                'transaction_id':f"TXN-{timezone.now().strftime('%Y%m%d%H%M%S')}",}
+                'transaction_id':new_reference('TXN'),}
             )
             if not created:
                 transaction.status = 'SUCCESS'
@@ -1858,6 +1979,9 @@ def calculate_refund_amount(time_elapsed_hours, original_amount):
     else:
         return Decimal('0.00')
     
+INVOICE_PAGE_SIZE = 20
+INVOICE_MAX_PAGE_SIZE = 100
+
 @api_view(['GET'])
 def get_invoices(request):
     """Retrieve user's invoices."""
@@ -1870,9 +1994,101 @@ def get_invoices(request):
     if not user_id:
         return Response({'error': 'Invalid token'}, status=status.HTTP_401_UNAUTHORIZED)
 
-    invoices = Invoice.objects.filter(models.Q(order__user_id=user_id) | models.Q(booking__user_id=user_id))
-    serializer = InvoiceSerializer(invoices, many=True)
-    return Response(serializer.data)
+    try:
+        limit = max(1, min(int(request.query_params.get('limit', INVOICE_PAGE_SIZE)), INVOICE_MAX_PAGE_SIZE))
+        cursor = request.query_params.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return Response({'error': 'Invalid cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+    summary = request.query_params.get('summary') in ('1', 'true')
+
+    # Two indexed lookups (order owner, booking owner) combined with UNION instead of an OR across
+    # joins, newest first; the id of the last invoice on a page is the cursor for the next one
+    order_invoices = Invoice.objects.filter(order__user_id=user_id)
+    booking_invoices = Invoice.objects.filter(booking__user_id=user_id)
+    if cursor:
+        order_invoices = order_invoices.filter(id__lt=cursor)
+        booking_invoices = booking_invoices.filter(id__lt=cursor)
+    page_ids = list(
+        order_invoices.values_list('id', flat=True)
+        .union(booking_invoices.values_list('id', flat=True))
+        .order_by('-id')[:limit + 1]
+    )
+    next_cursor = page_ids[limit - 1] if len(page_ids) > limit else None
+    page_ids = page_ids[:limit]
+
+    invoices = Invoice.objects.filter(id__in=page_ids).select_related('order__cancellation', 'booking').order_by('-id')
+    if summary:
+        serializer = InvoiceSummarySerializer(invoices, many=True)
+    else:
+        invoices = invoices.select_related('order__address').prefetch_related(
+            'order__orderitem_set__product',
+            'order__orderitem_set__deal',
+            'order__orderitem_set__orderitemcustomization_set',
+            'order__orderitem_set__orderitemexpandablechoice_set',
+            'order__orderoffer_set__offer',
+        )
+        # The items' products and deals are serialized in full, load their relations for the whole page at once
+        items = [item for invoice in invoices if invoice.order for item in invoice.order.orderitem_set.all()]
+        context = {'deal_compositions': load_deal_compositions([item.deal for item in items if item.deal_id])}
+        ProductDetailSerializer.apply_prefetch_graph([item.product for item in items if item.product_id], context)
+        serializer = InvoiceSerializer(invoices, many=True, context=context)
+    return Response({'results': serializer.data, 'next_cursor': next_cursor})
+
+#? Finance export for staff (admin session): ?type=csv|ndjson&from=YYYY-MM-DD&to=YYYY-MM-DD.
+#? Streams while reading, see products/exports.py
+@require_GET
+@staff_member_required
+def export_orders_view(request):
+    export_format = request.GET.get('type', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f"type must be one of {', '.join(EXPORT_FORMATS)}"}, status=400)
+    try:
+        since = datetime.strptime(request.GET['from'], '%Y-%m-%d').date() if request.GET.get('from') else None
+        until = datetime.strptime(request.GET['to'], '%Y-%m-%d').date() if request.GET.get('to') else None
+    except ValueError:
+        return JsonResponse({'error': 'from/to must be YYYY-MM-DD'}, status=400)
+
+    content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    # Under ASGI only an async iterator is streamed, under WSGI only a sync one
+    stream = aiter_export if isinstance(request, ASGIRequest) else iter_export
+    response = StreamingHttpResponse(stream(export_format, since, until), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="orders.{export_format}"'
+    return response
+
+#? Plain Django view: the token is checked without a DB hit (DRF's JWTAuthentication loads the user)
+#? and the owner/hash pointer comes from the cache, so a repeat download is cache + file only
+@require_GET
+def invoice_receipt_view(request, invoice_id):
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    user_id = decode_jwt(auth_header.split(' ')[1])
+    if not user_id:
+        return JsonResponse({'error': 'Invalid token'}, status=401)
+
+    pointer = get_receipt_pointer(invoice_id)
+    if pointer is None or pointer[0] != user_id:
+        return JsonResponse({'error': 'Invoice not found'}, status=404)
+    sha256 = pointer[1]
+    if not sha256:
+        # Not paid yet, or the render_receipts worker hasn't reached it
+        return JsonResponse({'message': 'Receipt is being prepared'}, status=202)
+
+    etag = f'"{sha256}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(
+            default_storage.open(receipt_path(sha256), 'rb'),
+            content_type=RECEIPT_CONTENT_TYPE,
+            filename=f'receipt-{invoice_id}.html',
+        )
+    response['ETag'] = etag
+    # Content addressed, the bytes behind this URL only change if the receipt is re-rendered
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
 
 @api_view(['GET'])
 def get_payment_methods(request):
@@ -1892,6 +2108,7 @@ def get_payment_methods(request):
 
 
 @api_view(['POST'])
+@idempotent
 def create_payment_intent(request):
     auth_header = request.headers.get('Authorization', '')
     if not auth_header.startswith('Bearer '):
@@ -1906,18 +2123,29 @@ def create_payment_intent(request):
             data = json.loads(request.body)
             amount = data.get('amount', 1000)  # Amount in cents (e.g., $10.00)
             currency = data.get('currency', 'usd')
+            order_id = data.get('order_id')
+
+            # order_id in the metadata lets the webhook worker find the Order/Invoice to update
+            metadata = {}
+            if order_id:
+                if not Order.objects.filter(id=order_id, user_id=user_id).exists():
+                    return JsonResponse({'error': 'Order not found'}, status=404)
+                metadata['order_id'] = str(order_id)
 
             # Create a Payment Intent
-            intent = stripe.PaymentIntent.create(
+            intent = stripe_gateway.create_payment_intent(
                 amount=amount,
                 currency=currency,
                 payment_method_types=['card'],
+                metadata=metadata,
             )
             
             return JsonResponse({
                 'payment_intent_id': intent['id'],
                 'client_secret': intent['client_secret'],
             })
+        except PaymentGatewayUnavailable as e:
+            return JsonResponse({'error': str(e)}, status=503)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
     return JsonResponse({'error': 'Invalid request'}, status=400)
@@ -1933,7 +2161,7 @@ def get_payment_intent(request):
                 return JsonResponse({'error': 'Payment Intent ID is required'}, status=400)
 
             # Retrieve Payment Intent from Stripe
-            payment_intent = stripe.PaymentIntent.retrieve(payment_intent_id)
+            payment_intent = stripe_gateway.retrieve_payment_intent(payment_intent_id)
             # Return relevant details
             return JsonResponse({
                 'id': payment_intent['id'],
@@ -1945,6 +2173,8 @@ def get_payment_intent(request):
                 'charge_id': payment_intent['latest_charge'],
                 'last_payment_error': payment_intent.get('last_payment_error', None),
             })
+        except PaymentGatewayUnavailable as e:
+            return JsonResponse({'error': str(e)}, status=503)
         except stripe.error.StripeError as e:
             return JsonResponse({'error': str(e)}, status=400)
         except Exception as e:
@@ -1963,7 +2193,7 @@ def get_charge_details(request):
                 return JsonResponse({'error': 'Charge ID is required'}, status=400)
 
             # Retrieve Payment Intent from Stripe
-            charge = stripe.Charge.retrieve(charge_id)
+            charge = stripe_gateway.retrieve_charge(charge_id)
             
             # Return relevant details
             return JsonResponse({
@@ -1979,6 +2209,8 @@ def get_charge_details(request):
                 'currency':charge['currency'],
                 'card_type':charge['payment_method_details']['card']['funding'],
             })
+        except PaymentGatewayUnavailable as e:
+            return JsonResponse({'error': str(e)}, status=503)
         except stripe.error.StripeError as e:
             return JsonResponse({'error': str(e)}, status=400)
         except Exception as e:
@@ -1986,19 +2218,36 @@ def get_charge_details(request):
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
 
+#? Only verify + persist here, Stripe gets its 200 right away and process_stripe_events
+#? applies the state changes in batches. Retries of the same event are a no-op insert.
 @api_view(["POST"])
+@authentication_classes([])
 def stripe_webhook(request):
+    if not settings.STRIPE_WEBHOOK_SECRET:
+        # An empty key would accept signatures anyone can compute; 503 so Stripe retries once it's set
+        print("Stripe webhook rejected: STRIPE_WEBHOOK_SECRET is not set")
+        return HttpResponse(status=503)
     payload = request.body
-    # Parse the event (no signature verification for now, just testing)
-    event = json.loads(payload)
-    event_type = event['type']
-    if event_type == 'charge.succeeded' or event_type == 'charge.updated':
-        print('yessss')
-    if event_type == 'payment_intent.succeeded':
-        print("Payment succeeded!")
-    elif event_type == 'payment_intent.payment_failed':
-        print("Payment failed!")
-
+    try:
+        stripe.WebhookSignature.verify_header(
+            payload.decode('utf-8'),
+            request.headers.get('Stripe-Signature', ''),
+            settings.STRIPE_WEBHOOK_SECRET,
+            tolerance=stripe.Webhook.DEFAULT_TOLERANCE,
+        )
+        event = json.loads(payload)
+        event_id, event_type = event['id'], event['type']
+    except stripe.SignatureVerificationError as e:
+        print(f"Stripe webhook signature rejected: {e}")
+        return HttpResponse(status=400)
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Invalid Stripe webhook payload: {e}")
+        return HttpResponse(status=400)
+
+    StripeEvent.objects.bulk_create(
+        [StripeEvent(event_id=event_id, event_type=event_type, payload=event)],
+        ignore_conflicts=True,
+    )
     return HttpResponse(status=200)
 
 
@@ -2045,13 +2294,32 @@ def branch_status_bulk_view(request):
         print(f"Error in branch_status_bulk_view: {e}")
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+#? Live replacement for polling branch-stock/, flash-sale-status/ and branch-status-bulk/.
+#? Plain async Django view (DRF views are sync) so an idle client only parks a coroutine on the
+#? worker's event loop. Events: stock (item statuses per branch), branch (open/close), flash_sale.
+@require_GET
+async def branch_events_view(request):
+    try:
+        branch_ids = [int(id) for id in request.GET.get('branch_ids', '').split(',') if id]
+    except ValueError:
+        return JsonResponse({'error': 'Invalid branch_ids format'}, status=400)
+    if not branch_ids:
+        return JsonResponse({'error': 'branch_ids is required'}, status=400)
+
+    channels = [CATALOG_CHANNEL, *[branch_channel(branch_id) for branch_id in branch_ids]]
+    response = StreamingHttpResponse(sse_stream(channels), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @api_view(['GET'])
+@authentication_classes([])
 def branch_deals_view(request, branch_id):
     try:
         branch = Branch.objects.get(id=branch_id, is_active=True)
         unavailable_deals = DealBranchStock.objects.filter(branch=branch, is_available=False).values_list('deal_id', flat=True)
         deals = Deal.objects.exclude(id__in=unavailable_deals)
-        serializer = DealSerializer(deals, many=True, context={'branch_id': branch_id})
+        serializer = DealSerializer(deals, many=True, context={'branch_id': branch_id, **favorite_context(request)})
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Branch.DoesNotExist:
         return Response({'error': 'Branch not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -2079,13 +2347,101 @@ def branch_stock_status_view(request, branch_id):
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
     
+#? Staff endpoint: branch managers are Django admin users, so this goes through the admin session
+@api_view(['POST'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAdminUser])
+def branch_stock_bulk_update_view(request, branch_id):
+    try:
+        if not Branch.objects.filter(id=branch_id).exists():
+            return Response({'error': 'Branch not found'}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = BranchStockBulkSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        written = apply_branch_stock_changes(
+            branch_id,
+            products=serializer.validated_data['products'],
+            deals=serializer.validated_data['deals'],
+        )
+        return Response(written, status=status.HTTP_200_OK)
+    except InvalidStockChange as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        print(f"Error in branch_stock_bulk_update_view: {e}")
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+#? Kitchen tablets poll ?since=<next_cursor> every few seconds and get only the orders changed since,
+#? one range scan on (branch, change_seq). Changes younger than KITCHEN_SETTLE_SECONDS are left for the
+#? next poll so a transaction that commits a little late can't slip behind the cursor.
+KITCHEN_ACTIVE_STATUSES = ('PENDING', 'CONFIRMED', 'PREPARING', 'DISPATCHED')
+KITCHEN_SETTLE_SECONDS = 2
+KITCHEN_PAGE_SIZE = 100
+
+
+def _kitchen_orders(queryset):
+    return queryset.prefetch_related(
+        'orderitem_set__product',
+        'orderitem_set__deal',
+        'orderitem_set__orderitemcustomization_set__customization_choice',
+        'orderitem_set__orderitemexpandablechoice_set__expandable_choice',
+    )
+
+
 @api_view(['GET'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAdminUser])
+def kitchen_queue_view(request, branch_id):
+    """Without ?since: the branch's active orders. With ?since: orders changed after that cursor."""
+    try:
+        since = request.query_params.get('since')
+        since = int(since) if since else None
+        limit = max(1, min(int(request.query_params.get('limit', KITCHEN_PAGE_SIZE)), KITCHEN_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'Invalid since or limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+    settled = min_id_at(timezone.now().timestamp() - KITCHEN_SETTLE_SECONDS)
+    if since is None:
+        orders = list(_kitchen_orders(
+            Order.objects.filter(branch_id=branch_id, status__in=KITCHEN_ACTIVE_STATUSES).order_by('created_at')
+        ))
+        next_cursor = settled
+    else:
+        orders = list(_kitchen_orders(
+            Order.objects.filter(branch_id=branch_id, change_seq__gt=since, change_seq__lte=settled).order_by('change_seq')
+        )[:limit + 1])
+        if len(orders) > limit:
+            orders = orders[:limit]
+            next_cursor = orders[-1].change_seq
+        else:
+            next_cursor = max(since, settled)
+    return Response({'orders': KitchenOrderSerializer(orders, many=True).data, 'next_cursor': next_cursor})
+
+
+@api_view(['POST'])
+@authentication_classes([SessionAuthentication])
+@permission_classes([IsAdminUser])
+def kitchen_transition_view(request, branch_id):
+    """Move many of the branch's orders forward to one status: {"order_ids": [...], "status": "PREPARING"}"""
+    with transaction.atomic():
+        serializer = KitchenTransitionSerializer(data=request.data, context={'branch_id': branch_id})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        order_ids = serializer.validated_data['matched_ids']
+        changed = Order.set_status(order_ids, serializer.validated_data['status'])
+    return Response({'matched': len(order_ids), 'changed': changed}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@authentication_classes([])
 def branch_products_view(request, branch_id):
     try:
         branch = Branch.objects.get(id=branch_id, is_active=True)
         unavailable_products = ProductBranchStock.objects.filter(branch=branch, is_available=False).values_list('product_id', flat=True)
         products = Product.objects.exclude(id__in=unavailable_products)  # Only show available products
-        serializer = ProductDetailSerializer(products, many=True, context={'branch_id': branch_id})
+        serializer = ProductDetailSerializer(products, many=True, context={'branch_id': branch_id, **favorite_context(request)})
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Branch.DoesNotExist:
         return Response({'error': 'Branch not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -2097,29 +2453,9 @@ def branch_products_view(request, branch_id):
 @api_view(['GET'])
 def carousel_list_view(request):
     try:
-        now = timezone.now()
-        queryset = CarouselCard.objects.filter(status='published').select_related('carouselschedule')
-
-        # Combine date and time into datetime ranges for accurate filtering
-        queryset = queryset.filter(
-            # Start condition: Either no start date/time or start is before or equal to now
-            models.Q(carouselschedule__start_date__isnull=True) |
-            models.Q(carouselschedule__start_date__lte=now.date()) &
-            (
-                models.Q(carouselschedule__start_time__isnull=True) |
-                models.Q(carouselschedule__start_time__lte=now.time())
-            ),
-            # End condition: Either no end date/time or end is after or equal to now
-            models.Q(carouselschedule__end_date__isnull=True) |
-            models.Q(carouselschedule__end_date__gte=now.date()) &
-            (
-                models.Q(carouselschedule__end_time__isnull=True) |
-                models.Q(carouselschedule__end_time__gte=now.time()) |
-                models.Q(carouselschedule__end_date__gt=now.date())  # Key fix: Allow if end_date is in the future
-            )
-        )
-        serializer = CarouselCardSerializer(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # Served from the cache until the next schedule boundary, see products/carousel.py
+        data = get_active_carousel(lambda cards: CarouselCardSerializer(cards, many=True).data)
+        return Response(data, status=status.HTTP_200_OK)
     except Exception as e:
         print(f"Error in carousel_list_view: {e}")
         return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,131 @@
+import logging
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Invoice, Order, StripeEvent, Transaction
+
+logger = logging.getLogger(__name__)
+
+SUCCEEDED_EVENTS = ('payment_intent.succeeded', 'charge.succeeded')
+FAILED_EVENTS = ('payment_intent.payment_failed', 'charge.failed')
+MAX_ATTEMPTS = 5
+
+
+def _order_id(event):
+    """order_id put into the PaymentIntent metadata by create_payment_intent (charges inherit it)."""
+    metadata = event.payload.get('data', {}).get('object', {}).get('metadata') or {}
+    try:
+        return int(metadata['order_id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _payment_intent(event):
+    obj = event.payload.get('data', {}).get('object', {})
+    if obj.get('object') == 'payment_intent':
+        return obj.get('id'), obj.get('amount_received') or obj.get('amount')
+    return obj.get('payment_intent'), obj.get('amount_captured') or obj.get('amount')
+
+
+def _apply_batch(events, now):
+    """Fold a batch of events into one set of UPDATEs per table. Returns {event pk: status}."""
+    results = {}
+    succeeded = {}
+    failed = {}
+    for event in events:
+        order_id = _order_id(event)
+        if order_id is None or event.event_type not in SUCCEEDED_EVENTS + FAILED_EVENTS:
+            results[event.pk] = 'IGNORED'
+            continue
+        target = succeeded if event.event_type in SUCCEEDED_EVENTS else failed
+        target.setdefault(order_id, _payment_intent(event))
+        results[event.pk] = 'PROCESSED'
+
+    # A successful payment is final, a failed attempt before (or a late retry) doesn't undo it
+    for order_id in succeeded:
+        failed.pop(order_id, None)
+    paid_order_ids = set(Order.objects.filter(payment_status='PAID').filter(id__in=failed).values_list('id', flat=True))
+    for order_id in paid_order_ids:
+        failed.pop(order_id)
+
+    if succeeded:
+        Order.objects.filter(id__in=succeeded).exclude(payment_status='PAID').update(payment_status='PAID', updated_at=now)
+        Invoice.objects.filter(order_id__in=succeeded).exclude(status='PAID').update(status='PAID', paid_at=now)
+        Transaction.objects.filter(order_id__in=succeeded).exclude(status='SUCCESS').update(status='SUCCESS', completed_at=now)
+
+        # Card payments that never went through process_payment get their Transaction here,
+        # keyed by the PaymentIntent id so a replayed batch can't create it twice
+        with_transaction = set(Transaction.objects.filter(order_id__in=succeeded).values_list('order_id', flat=True))
+        invoices = dict(Invoice.objects.filter(order_id__in=succeeded).values_list('order_id', 'id'))
+        totals = dict(Order.objects.filter(id__in=succeeded).values_list('id', 'total_amount'))
+        Transaction.objects.bulk_create([
+            Transaction(
+                order_id=order_id,
+                invoice_id=invoices.get(order_id),
+                amount=Decimal(amount) / 100 if amount else totals[order_id],
+                status='SUCCESS',
+                transaction_id=intent_id,
+                completed_at=now,
+            )
+            for order_id, (intent_id, amount) in succeeded.items()
+            if order_id in totals and order_id not in with_transaction and intent_id
+        ], ignore_conflicts=True)
+
+    if failed:
+        Order.objects.filter(id__in=failed).exclude(payment_status='PAID').update(payment_status='FAILED', updated_at=now)
+        Invoice.objects.filter(order_id__in=failed).exclude(status='PAID').update(status='FAILED')
+        Transaction.objects.filter(order_id__in=failed).exclude(status='SUCCESS').update(status='FAILED')
+
+    if succeeded or failed:
+        # payment_status is part of the live order event
+        Order.publish_status_events([*succeeded, *failed])
+    return results
+
+
+def _mark(results, now):
+    for result in ('PROCESSED', 'IGNORED'):
+        pks = [pk for pk, status in results.items() if status == result]
+        if pks:
+            StripeEvent.objects.filter(pk__in=pks).update(status=result, processed_at=now, attempts=F('attempts') + 1)
+
+
+def _record_failure(pk, error):
+    """Count a failed attempt against one event, it is given up on after MAX_ATTEMPTS."""
+    StripeEvent.objects.filter(pk=pk).update(attempts=F('attempts') + 1, last_error=str(error))
+    StripeEvent.objects.filter(pk=pk, attempts__gte=MAX_ATTEMPTS).update(status='FAILED')
+
+
+def process_stripe_events(batch_size=100):
+    """
+    Apply up to batch_size pending webhook events in one transaction.
+    If the batch fails, its events are retried one by one in their own savepoints, so only the
+    event that raises is counted as a failed attempt and the rest still go through.
+    Returns the number of events handled, 0 when the queue is empty.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # skip_locked lets several workers drain the queue without stepping on each other
+        events = list(
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(status='PENDING').order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0
+        try:
+            with transaction.atomic():
+                _mark(_apply_batch(events, now), now)
+            return len(events)
+        except Exception:
+            logger.exception('stripe event batch failed, retrying its events one by one')
+
+        for event in events:
+            try:
+                with transaction.atomic():
+                    _mark(_apply_batch([event], now), now)
+            except Exception as e:
+                logger.exception('stripe event %s failed', event.event_id)
+                _record_failure(event.pk, e)
+    return len(events)
@@ -83,6 +83,11 @@ CACHES = {
         }
     }
 }
+
+# Live push events (SSE), 'redis' pub/sub in production, 'memory' keeps everything in-process for tests
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'redis')
+EVENTS_REDIS_URL = os.environ.get('REDIS_URL')
+
 ROOT_URLCONF = 'vroom_backend.urls'
 
 TEMPLATES = [
@@ -181,6 +186,22 @@ from decouple import config
 
 STRIPE_SECRET_KEY = config('SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = config('PUBLISHABLE_KEY')
+STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
+# Stripe HTTP client (products/stripe_gateway.py). STRIPE_API_BASE points the client at a local fake
+# server (manage.py fake_stripe_server) for offline load tests, empty means the real API
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='')
+STRIPE_CONNECT_TIMEOUT = config('STRIPE_CONNECT_TIMEOUT', default=3.0, cast=float)
+STRIPE_READ_TIMEOUT = config('STRIPE_READ_TIMEOUT', default=10.0, cast=float)
+STRIPE_MAX_NETWORK_RETRIES = config('STRIPE_MAX_NETWORK_RETRIES', default=2, cast=int)
+STRIPE_POOL_SIZE = config('STRIPE_POOL_SIZE', default=20, cast=int)
+STRIPE_BREAKER_THRESHOLD = config('STRIPE_BREAKER_THRESHOLD', default=5, cast=int)
+STRIPE_BREAKER_RESET = config('STRIPE_BREAKER_RESET', default=30.0, cast=float)
+
+# Scheduled orders stay PENDING until this long before scheduled_at (manage.py run_order_releaser)
+ORDER_PREP_LEAD_MINUTES = config('ORDER_PREP_LEAD_MINUTES', default=30, cast=int)
+
+# Branch availability bitsets written by manage.py run_availability_indexer and mapped by every worker
+AVAILABILITY_INDEX_PATH = config('AVAILABILITY_INDEX_PATH', default=str(BASE_DIR / 'availability.idx'))
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (